@@ -11,6 +11,7 @@
 -------------------------------------------------
 """
 import os
+import math
 import random
 import torch
 import numpy as np
@@ -25,6 +26,7 @@ from utils.input_utils.graph_vocab import GraphVocab
 from utils.seed import set_seed
 from utils.timer import Timer
 from utils.logger import init_logger, get_logger
+from utils.distributed import init_distributed, is_main_process, barrier
 
 
 def load_trainer(args):
@@ -35,8 +37,18 @@ def load_trainer(args):
         model = BiaffineDependencyModel.from_pretrained(args, initialize_from_bertology=False)
     model.to(args.device)
 
-    # multi-gpu training (should be after apex fp16 initialization)
-    if args.n_gpu > 1:
+    # multi-gpu training，混合精度见MixedPrecision（autocast在trainer中作用于前向计算）
+    if args.distributed:
+        # 每个进程一个模型副本，反向传播时all-reduce梯度
+        # 只有freeze时存在得不到梯度的参数（构造DistributedDataParallel之后才被freeze），
+        # 此时才需要find_unused_parameters（每次前向之后遍历计算图，有额外的开销）
+        args.find_unused_parameters = args.freeze
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.local_rank] if args.n_gpu > 0 else None,
+            output_device=args.local_rank if args.n_gpu > 0 else None,
+            find_unused_parameters=args.find_unused_parameters)
+        args.parallel_train = True
+    elif args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
         print(f'Parallel Running, GPU num : {args.n_gpu}')
         args.parallel_train = True
@@ -55,8 +67,13 @@ def config_for_multi_gpu(args):
         args.n_gpu = torch.cuda.device_count()
     else:
         args.n_gpu = 0
+    # 多进程训练时每个进程使用一个GPU（或者CPU），下面的batch大小都是每个进程的
+    init_distributed(args)
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+    # 旧的配置文件中没有batch预算，使用默认值（仅在batch_budget_type不为sentences时使用）
+    args.train_batch_budget = getattr(args, 'per_gpu_train_batch_budget', 1500) * max(1, args.n_gpu)
+    args.eval_batch_budget = getattr(args, 'per_gpu_eval_batch_budget', 1500) * max(1, args.n_gpu)
 
 
 def make_output_dir(args):
@@ -87,23 +104,35 @@ def make_output_dir(args):
 def train(args):
     assert args.run_mode == 'train'
     # 创建输出文件夹，保存运行结果，配置文件，模型参数
-    make_output_dir(args)
+    # 多进程训练时只有rank 0保存输出（模型、dev结果、summary）
+    if is_main_process(args):
+        make_output_dir(args)
 
     with Timer('load input'):
         # 目前仅仅支持BERTology形式的输入
         train_data_loader, train_conllu, dev_data_loader, dev_conllu = load_bertology_input(args)
 
-    print(f'train batch size: {args.train_batch_size}')
+    batch_budget_type = getattr(args, 'batch_budget_type', 'sentences')
+    if batch_budget_type == 'sentences':
+        print(f'train batch size: {args.train_batch_size}')
+    else:
+        print(f'train batch budget: {args.train_batch_budget} {batch_budget_type}')
     print(f'train data batch num: {len(train_data_loader)}')
+    # 以下step都按参数更新的次数计算，每次更新累积gradient_accumulation_steps个batch的梯度
+    # 因此在显存不同的机器上只需调整batch大小和累积步数，warm up、dev间隔、early stop不变
+    gradient_accumulation_steps = getattr(args, 'gradient_accumulation_steps', 1)
+    train_steps_per_epoch = math.ceil(len(train_data_loader) / gradient_accumulation_steps)
+    print(f'gradient accumulation steps: {gradient_accumulation_steps}, '
+          f'update steps per epoch: {train_steps_per_epoch}')
     # 每个epoch做两次dev：
-    args.eval_interval = len(train_data_loader) // 2
+    args.eval_interval = max(1, train_steps_per_epoch // 2)
     print(f'eval interval: {args.eval_interval}')
     # 注意该参数影响学习率warm up
-    args.max_train_steps = len(train_data_loader) * args.max_train_epochs
+    args.max_train_steps = train_steps_per_epoch * args.max_train_epochs
     print(f'max steps: {args.max_train_steps}')
     # 如果6个epoch之后仍然不能提升，就停止
     if args.early_stop:
-        args.early_stop_steps = len(train_data_loader) * args.early_stop_epochs
+        args.early_stop_steps = train_steps_per_epoch * args.early_stop_epochs
         print(f'early stop steps: {args.early_stop_steps}\n')
     else:
         print(f'do not use early stop, training will last {args.max_train_epochs} epochs')
@@ -111,6 +140,7 @@ def train(args):
         trainer = load_trainer(args)
     with Timer('Train'):
         trainer.train(train_data_loader, dev_data_loader, dev_conllu)
+    barrier(args)
     print('train DONE')
 
 
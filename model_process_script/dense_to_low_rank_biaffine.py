@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+    把已训练的稠密模型中标签的双仿变换（labeled_biaffine）截断分解为低秩形式，
+    转换后的模型需要配合 low_rank_biaffine: true 以及相同的 label_biaffine_rank 使用
+
+    用法：
+        python model_process_script/dense_to_low_rank_biaffine.py --model_path output/xxx/model \
+            --output_path output/xxx/model_rank128 --rank 128
+"""
+import sys
+import shutil
+import pathlib
+import argparse
+
+import torch
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
+from modules.biaffine import low_rank_decompose
+
+LABELED_BILINEAR_PREFIX = 'labeled_biaffine.scorer.W_bilin.'
+
+
+def reconstruct(u, v, core):
+    """
+        由低秩参数还原稠密的PairwiseBilinear权重 (D1 x D2 x O)
+    """
+    rank, input1_size = u.size()
+    input2_size = v.size(1)
+    output_size = core.size(2)
+    # (D1 x r) * (r x (O x r)) -> (D1 x O x r)
+    weight = torch.matmul(u.t(), core.reshape(rank, -1)).reshape(input1_size, output_size, rank)
+    # (D1 x O x r) * (r x D2) -> (D1 x O x D2)
+    weight = torch.matmul(weight, v)
+    return weight.reshape(input1_size, input2_size, output_size)
+
+
+def dense_to_low_rank(state_dict, rank):
+    weight = state_dict.pop(LABELED_BILINEAR_PREFIX + 'weight')
+    bias = state_dict.pop(LABELED_BILINEAR_PREFIX + 'bias')
+    u, v, core = low_rank_decompose(weight, rank)
+    state_dict[LABELED_BILINEAR_PREFIX + 'U.weight'] = u
+    state_dict[LABELED_BILINEAR_PREFIX + 'V.weight'] = v
+    state_dict[LABELED_BILINEAR_PREFIX + 'core.weight'] = core
+    state_dict[LABELED_BILINEAR_PREFIX + 'core.bias'] = bias
+    error = torch.norm(reconstruct(u, v, core) - weight) / torch.norm(weight).clamp(min=1e-12)
+    print(f'labeled biaffine: {tuple(weight.size())} -> U{tuple(u.size())} V{tuple(v.size())} '
+          f'core{tuple(core.size())}')
+    print(f'parameters: {weight.numel()} -> {u.numel() + v.numel() + core.numel()}, '
+          f'relative error: {float(error):.6f}')
+    # rank不能超过输入维度
+    return state_dict, u.size(0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', required=True, help='稠密模型的文件夹')
+    parser.add_argument('--output_path', required=True, help='转换后模型的文件夹')
+    parser.add_argument('--rank', type=int, default=128)
+    parser.add_argument('--weight_file_name', default='pytorch_model.bin')
+    args = parser.parse_args()
+    model_path = pathlib.Path(args.model_path)
+    output_path = pathlib.Path(args.output_path)
+    assert model_path.is_dir()
+    assert not output_path.exists(), f'{output_path} exists!'
+
+    state_dict = torch.load(str(model_path / args.weight_file_name), map_location='cpu')
+    assert LABELED_BILINEAR_PREFIX + 'weight' in state_dict, '模型中没有稠密的标签双仿变换（fused或已经是低秩模型？）'
+    state_dict, rank = dense_to_low_rank(state_dict, args.rank)
+
+    # 复制BERTology的配置、词表等其他文件
+    shutil.copytree(str(model_path), str(output_path), ignore=shutil.ignore_patterns(args.weight_file_name))
+    torch.save(state_dict, str(output_path / args.weight_file_name))
+    print(f'low rank model saved in {output_path}')
+    print(f'set low_rank_biaffine: true and label_biaffine_rank: {rank} in the config file')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ import torch.nn as nn
 from utils.input_utils.bertology.bert_input_utils import load_bert_tokenizer, load_and_cache_examples, get_data_loader
 from utils.input_utils.graph_vocab import GraphVocab
 from modules.bertology_encoder import BERTologyEncoder
-from modules.biaffine import DeepBiaffineScorer, DirectBiaffineScorer
+from modules.biaffine import DeepBiaffineScorer, DirectBiaffineScorer, FusedDeepBiaffineScorer
 from models.base_model import BaseModel
 
 
@@ -18,7 +18,18 @@ class BiaffineDependencyModel(BaseModel):
         super().__init__()
         self.args = args
         self.graph_vocab = GraphVocab(args.graph_vocab_file)
+        # 标签的双仿变换参数量为 hidden x hidden x 标签数，可以使用低秩分解
+        low_rank_biaffine = getattr(args, 'low_rank_biaffine', False)
+        label_biaffine_rank = getattr(args, 'label_biaffine_rank', 128) if low_rank_biaffine else None
+        self.fused_biaffine = getattr(args, 'fused_biaffine', False)
+        # fused_biaffine的弧和标签共用一个MLP（线性变换），与分开的DeepBiaffineScorer是不同的模型，
+        # 只实现了DeepBiaffine的版本；在构造encoder之前检查配置
+        if self.fused_biaffine and args.direct_biaffine:
+            raise ValueError('fused_biaffine只支持DeepBiaffine，不能与direct_biaffine同时使用')
+        if self.fused_biaffine and low_rank_biaffine:
+            raise ValueError('fused_biaffine不支持low_rank_biaffine')
         if args.encoder_type == 'bertology':
+            checkpoint_bertology_layers = getattr(args, 'checkpoint_bertology_layers', [])
             # args.encoder_type 控制用什么类型的encoder（EBRTology/Transformer等等）
             # args.bertology_type 控制具体是什么类型的BERT（bert/xlnert/roberta等等）
             self.encoder = BERTologyEncoder(no_cuda=not args.cuda,
@@ -29,19 +40,28 @@ class BiaffineDependencyModel(BaseModel):
                                             max_seq_len=args.max_seq_len,
                                             bertology_after=args.bertology_after,
                                             after_layers=args.after_layers,
-                                            after_dropout=args.after_dropout)
+                                            after_dropout=args.after_dropout,
+                                            checkpoint_bertology_layers=checkpoint_bertology_layers,
+                                            checkpoint_after_layers=getattr(args, 'checkpoint_after_layers', False))
         elif args.encoder_type in ['lstm', 'gru']:
             self.encoder = None  # Do NOT support now #todo
         elif args.encoder_type == 'transformer':
             self.encoder = None  # Do NOT support now #todo
-        if args.direct_biaffine:
+        if self.fused_biaffine:
+            # 无标签弧和标签共用一次线性变换和一次双仿变换
+            self.biaffine = FusedDeepBiaffineScorer(args.encoder_output_dim,
+                                                    args.biaffine_hidden_dim,
+                                                    len(self.graph_vocab.get_labels()),
+                                                    dropout=args.biaffine_dropout)
+        elif args.direct_biaffine:
             self.unlabeled_biaffine = DirectBiaffineScorer(args.encoder_output_dim,
                                                            args.encoder_output_dim,
                                                            1, pairwise=True)
             self.labeled_biaffine = DirectBiaffineScorer(args.encoder_output_dim,
                                                          args.encoder_output_dim,
                                                          len(self.graph_vocab.get_labels()),
-                                                         pairwise=True)
+                                                         pairwise=True,
+                                                         rank=label_biaffine_rank)
         else:
             self.unlabeled_biaffine = DeepBiaffineScorer(args.encoder_output_dim,
                                                          args.encoder_output_dim,
@@ -53,20 +73,74 @@ class BiaffineDependencyModel(BaseModel):
                                                        args.biaffine_hidden_dim,
                                                        len(self.graph_vocab.get_labels()),
                                                        pairwise=True,
-                                                       dropout=args.biaffine_dropout)
+                                                       dropout=args.biaffine_dropout,
+                                                       rank=label_biaffine_rank)
         # self.dropout = nn.Dropout(args.dropout)
         if args.learned_loss_ratio:
             self.label_loss_ratio = nn.Parameter(torch.Tensor([0.5]))
         else:
             self.label_loss_ratio = args.label_loss_ratio
 
-    def forward(self, inputs):
+    def forward(self, inputs, return_label_loss_ratio=False, label_pair_index=None):
+        """
+        :param return_label_loss_ratio: 是否同时返回label_loss_ratio；
+                多进程训练（DistributedDataParallel）并且find_unused_parameters时，
+                可学习的label_loss_ratio必须出现在forward的输出中，否则会被当作未使用的参数，梯度无法正确同步
+        :param label_pair_index: (E x 3) [batch内的句子序号, dependent, head]，
+                给出时只对这些弧计算标签（训练时只需要gold弧的标签打分）
+        :return: unlabeled_scores: (B x L x L); labeled_scores: (B x C x L x L)，标签维度在前，
+                 与CrossEntropyLoss的输入格式一致；给出label_pair_index时labeled_scores为 (E x C)
+        """
         assert isinstance(inputs, dict)
-        encoder_output = self.encoder(**inputs)
-        unlabeled_scores = self.unlabeled_biaffine(encoder_output, encoder_output).squeeze(3)
-        labeled_scores = self.labeled_biaffine(encoder_output, encoder_output)
-        return unlabeled_scores, labeled_scores
+        biaffine_inputs = self.biaffine_inputs(self.encode(inputs))
+        if self.fused_biaffine and label_pair_index is None:
+            scores = self.biaffine.score(*biaffine_inputs)
+            outputs = scores[:, 0], scores[:, 1:]
+        else:
+            outputs = self.score_arcs(biaffine_inputs), self.score_labels(biaffine_inputs, label_pair_index)
+        if return_label_loss_ratio:
+            label_loss_ratio = self.label_loss_ratio
+            if isinstance(label_loss_ratio, nn.Parameter):
+                # find_unused_parameters从输出的grad_fn开始查找参与计算的参数，Parameter本身没有grad_fn
+                label_loss_ratio = label_loss_ratio.clone()
+            outputs += (label_loss_ratio,)
+        return outputs
+
+    def encode(self, inputs):
+        return self.encoder(**inputs)
+
+    def biaffine_inputs(self, encoder_output):
+        """
+            score_arcs和score_labels的输入：
+            fused_biaffine时为共用的线性变换（以及dropout）的输出 (H_dep, H_head)，弧和标签的打分都由它计算；
+            否则为encoder_output（弧和标签的DeepBiaffine各自做线性变换）
+        """
+        if self.fused_biaffine:
+            return self.biaffine.project(encoder_output)
+        return encoder_output
+
+    def score_arcs(self, biaffine_inputs):
+        """
+        :param biaffine_inputs: biaffine_inputs的输出
+        :return: 无标签弧的logits (B x L x L)
+        """
+        if self.fused_biaffine:
+            return self.biaffine.score(*biaffine_inputs, output_slice=slice(0, 1))[:, 0]
+        return self.unlabeled_biaffine(biaffine_inputs, biaffine_inputs).squeeze(3)
 
+    def score_labels(self, biaffine_inputs, pair_index=None):
+        """
+        :param biaffine_inputs: biaffine_inputs的输出
+        :param pair_index: (E x 3) [batch内的句子序号, dependent, head]，
+                           给出时只对这些弧计算标签（推理时只需要对可能被解码选中的弧计算标签）
+        :return: pair_index为None时为 (B x C x L x L)；否则为 (E x C)
+        """
+        if self.fused_biaffine:
+            return self.biaffine.score(*biaffine_inputs, pair_index=pair_index, output_slice=slice(1, None))
+        if pair_index is not None:
+            return self.labeled_biaffine(biaffine_inputs, biaffine_inputs, pair_index)
+        # (B x L x L x C) -> (B x C x L x L)
+        return self.labeled_biaffine(biaffine_inputs, biaffine_inputs).permute(0, 3, 1, 2)
 
 if __name__ == '__main__':
     class Args():
@@ -2,16 +2,22 @@
 # Created by li huayong on 2019/9/28
 import os
 import re
+import contextlib
+import numpy as np
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 from tqdm import tqdm
+from torch.utils.data import IterableDataset
 from abc import ABCMeta, abstractmethod
 
 from utils.information import debug_print
-from utils.input_utils.conll_file import CoNLLFile
+from utils.input_utils.conll_file import CoNLLFile, DepsFormatter
 from utils.input_utils.graph_vocab import GraphVocab
-from utils.model_utils.get_optimizer import get_optimizer
-from utils.model_utils.parser_funs import sdp_decoder, parse_semgraph
+from utils.model_utils.get_optimizer import get_optimizer, add_parameters_to_optimizer
+from utils.model_utils.parser_funs import sdp_decoder_from_heads_torch, semgraph_to_edges
+from utils.model_utils.make_target import make_graph_target, make_gold_arc_target, make_pair_index
+from utils.model_utils.mixed_precision import MixedPrecision
+from utils.distributed import is_main_process, broadcast_values, all_reduce_mean
 import utils.model_utils.sdp_simple_scorer as sdp_scorer
 from utils.best_result import BestResult
 from utils.seed import set_seed
@@ -28,15 +34,33 @@ class BiaffineDependencyTrainer(metaclass=ABCMeta):
         self.model = model
         self.optimizer = self.optim_scheduler = None
         self.graph_vocab = GraphVocab(args.graph_vocab_file)
+        # 预先构造"head:label"字符串表，由依存弧的边表直接得到deps
+        self.deps_formatter = DepsFormatter(self.graph_vocab.get_labels())
         self.args = args
+        if getattr(args, 'gold_arc_label_loss', False) and isinstance(model, torch.nn.DataParallel):
+            # DataParallel只按batch维切分张量参数，label_pair_index按gold弧切分之后
+            # 其中的句子序号仍是整个batch内的序号，与各个副本上的输入对不上
+            raise ValueError('gold_arc_label_loss不支持DataParallel（单进程多GPU），请使用多进程训练（torch.distributed）')
+        # 混合精度：autocast只作用于模型的前向计算
+        self.amp = MixedPrecision(args)
+
+    @property
+    def model_module(self):
+        """
+            DataParallel或者DistributedDataParallel封装的原始模型
+        """
+        return self.model.module if hasattr(self.model, 'module') else self.model
 
     @abstractmethod
     def _unpack_batch(self, args, batch):
         """
             拆分batch，得到encoder的输入和word mask，sentence length，以及dep ids
         :param args: 配置参数
-        :param batch: 输入的单个batch,类型为TensorDataset(或者torchtext.dataset)，可用索引分别取值
-        :return:返回一个元祖，[1]是inputs，类型为字典；[2]是word mask；[3]是sentence length,python 列表；[4]是dep ids
+        :param batch: DataLoader输出的单个batch（在CPU上），可用索引分别取值；
+                      句长等python列表直接由CPU上的张量得到，只把模型需要的张量移到args.device
+        :return:返回一个元祖，[1]是inputs，类型为字典；[2]是word mask；[3]是sentence length,python 列表；
+                [4]是依存弧的边表，(E x 4)：[batch内的句子序号, dependent, head, label]；
+                [5]是每句话在原始CoNLL-U文件中的序号，python 列表
         """
         raise NotImplementedError('must implement in sub class')
 
@@ -46,7 +70,7 @@ class BiaffineDependencyTrainer(metaclass=ABCMeta):
             比如BERT类型的模型可能会在Training的时候动态freeze某些层
             为了支持这些操作同时不破坏BiaffineDependencyTrainer的普适性，我们加入这个方法
             BiaffineDependencyTrainer的子类可以选择重写该方法以支持定制化操作
-            注意这个方法会在训练的每个epoch的开始调用一次
+            注意这个方法会在训练的每个epoch的开始调用一次（第一个epoch的调用在构造optimizer之前）
             本方法默认不会做任何事情
         :return:
         """
@@ -54,32 +78,39 @@ class BiaffineDependencyTrainer(metaclass=ABCMeta):
 
     def _update_and_predict(self, unlabeled_scores, labeled_scores, unlabeled_target, labeled_target, word_pad_mask,
                             label_loss_ratio=None, sentence_lengths=None,
-                            calc_loss=True, update=True, calc_prediction=False):
+                            calc_loss=True, update=True, calc_prediction=False,
+                            words_num=None, optimizer_step=True):
         """
             针对一个batch输入：计算loss，反向传播，计算预测结果
             :param word_pad_mask: 以word为单位，1为PAD，0为真实输入
+            :param words_num: 用于平均loss的单词数，梯度累积时为一次参数更新中所有micro-batch的单词数，
+                              None则为当前batch的单词数
+            :param optimizer_step: update为True时，反向传播之后是否更新参数（梯度累积时只在最后一个micro-batch更新）
         :return:
         """
-        weights = torch.ones(word_pad_mask.size(0), self.args.max_seq_len, self.args.max_seq_len,
-                             dtype=unlabeled_scores.dtype,
-                             device=unlabeled_scores.device)
-        # 将PAD的位置权重设为0，其余位置为1
-        weights = weights.masked_fill(word_pad_mask.unsqueeze(1), 0)
-        weights = weights.masked_fill(word_pad_mask.unsqueeze(2), 0)
-        # words_num 记录batch中的单词数量
-        # torch.eq(word_pad_mask, False) 得到word_mask
-        words_num = torch.sum(torch.eq(word_pad_mask, False)).item()
+        # 混合精度下模型输出为fp16/bf16，loss和解码中的概率乘积都在fp32下计算
+        unlabeled_scores = unlabeled_scores.float()
+        labeled_scores = labeled_scores.float()
+        if words_num is None:
+            # words_num 记录batch中的单词数量，句长已经在CPU上，不需要与device同步
+            words_num = sum(sentence_lengths) if sentence_lengths else torch.sum(torch.eq(word_pad_mask, False))
         if calc_loss:
             assert label_loss_ratio
             assert unlabeled_target is not None and labeled_target is not None
-            dep_arc_loss_func = nn.BCEWithLogitsLoss(weight=weights, reduction='sum')
-            dep_arc_loss = dep_arc_loss_func(unlabeled_scores, unlabeled_target)
+            assert sentence_lengths
+            # 只在有效的(dependent, head)位置计算弧的loss（单词维度已经在_unpack_batch中截取到batch中最长句子的单词数），
+            # 计算量与实际句长的平方成正比，不需要构造PAD位置的权重矩阵
+            pair_index = make_pair_index(sentence_lengths, word_pad_mask.size(1), unlabeled_scores.device)
+            dep_arc_loss = F.binary_cross_entropy_with_logits(unlabeled_scores.reshape(-1)[pair_index],
+                                                              unlabeled_target.reshape(-1)[pair_index],
+                                                              reduction='sum')
 
-            dep_label_loss_func = nn.CrossEntropyLoss(ignore_index=-1, reduction='sum')
-            dependency_mask = labeled_target.eq(0)
-            labeled_target = labeled_target.masked_fill(dependency_mask, -1)
-            labeled_scores = labeled_scores.contiguous().view(-1, len(self.graph_vocab.get_labels()))
-            dep_label_loss = dep_label_loss_func(labeled_scores, labeled_target.view(-1))
+            if labeled_scores.dim() == 4:
+                # labeled_scores: (B x C x L x L)，labeled_target: (B x L x L)，只有gold弧的位置计算loss
+                dependency_mask = labeled_target.eq(0)
+                labeled_target = labeled_target.masked_fill(dependency_mask, -1)
+            # 否则只在gold弧上计算了标签：labeled_scores: (E x C)，labeled_target: (E)
+            dep_label_loss = self._label_loss(labeled_scores, labeled_target)
 
             loss = 2 * ((1 - label_loss_ratio) * dep_arc_loss + label_loss_ratio * dep_label_loss)
 
@@ -93,80 +124,133 @@ class BiaffineDependencyTrainer(metaclass=ABCMeta):
                 loss = loss.mean()  # mean() to average on multi-gpu parallel training
 
             if update:
-                loss.backward()
-                if self.args.max_grad_norm > 0:
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
+                self.amp.backward(loss)
+            if update and optimizer_step:
                 if self.optim_scheduler:
                     self.optim_scheduler.step()  # Update learning rate schedule
-                self.optimizer.step()
+                # 梯度裁剪和参数更新（使用loss缩放时先还原梯度）
+                self.amp.step(self.optimizer, self.model.parameters(), self.args.max_grad_norm)
                 self.model.zero_grad()
-            loss = loss.detach().cpu().item()
+            # 返回device上的loss，由调用者在需要时（summary、日志）再取值，避免每一步都与device同步
+            loss = loss.detach()
         else:
             loss = None
         if calc_prediction:
             assert sentence_lengths
-            weights = weights.unsqueeze(3)
-            head_probs = torch.sigmoid(unlabeled_scores).unsqueeze(3)
-            label_probs = torch.softmax(labeled_scores, dim=3)
-            batch_probs = head_probs * label_probs * weights
-            batch_probs = batch_probs.detach().cpu().numpy()
-            # debug_print(batch_probs)
-            sem_graph = sdp_decoder(batch_probs, sentence_lengths)
-            sem_sents = parse_semgraph(sem_graph, sentence_lengths)
-            batch_prediction = self.graph_vocab.parse_to_sent_batch(sem_sents)
+            # 直接由logits在设备上做决定：弧的概率>=0.5（logit>=0），标签取logits的argmax，
+            # 不构造 B x L x L x C 的概率，只把依存弧的边表传回CPU
+            pad_mask = word_pad_mask.unsqueeze(1) | word_pad_mask.unsqueeze(2)
+            head_probs = torch.sigmoid(unlabeled_scores.detach()).masked_fill(pad_mask, 0)
+            # (B x C x L x L) -> (B x L x L)
+            label_preds = torch.argmax(labeled_scores.detach(), dim=1)
+            sem_graph = sdp_decoder_from_heads_torch(head_probs, label_preds, sentence_lengths)
+            # 预测结果为依存弧的边表 (E x 4)：[batch内的句子序号, dependent, head, label_id]
+            # 写出时由CoNLLFile直接转换为deps、head、deprel（见CoNLLFile.set_deps_from_edges）
+            batch_prediction = semgraph_to_edges(sem_graph, sentence_lengths).cpu().numpy()
         else:
             batch_prediction = None
         return loss, batch_prediction
 
+    def _label_loss(self, labeled_scores, labeled_target):
+        """
+            标签的loss，labeled_target为-1的位置不计算loss
+        :param labeled_scores: (B x C x L x L) 或 (E x C)
+        :param labeled_target: (B x L x L) 或 (E)
+        """
+        if not getattr(self.args, 'label_smoothing_loss', False):
+            return F.cross_entropy(labeled_scores, labeled_target, ignore_index=-1, reduction='sum')
+        class_num = labeled_scores.size(1)
+        if labeled_scores.dim() == 4:
+            labeled_scores = labeled_scores.permute(0, 2, 3, 1).reshape(-1, class_num)
+            labeled_target = labeled_target.reshape(-1)
+        return label_smoothed_kl_div_loss(labeled_scores, labeled_target, class_num, self.args.label_smoothing,
+                                          reduction='sum', ignore_index=-1)
+
     def train(self, train_data_loader, dev_data_loader=None, dev_CoNLLU_file=None):
+        # 第一个epoch的定制化操作（例如freeze）在构造optimizer之前进行，optimizer只包含需要训练的参数
+        self._custom_train_operations(1)
         self.optimizer, self.optim_scheduler = get_optimizer(self.args, self.model)
         global_step = 0
         best_result = BestResult()
         self.model.zero_grad()
         set_seed(self.args)  # Added here for reproductibility (even between python 2 and 3)
         train_stop = False
-        summary_writer = SummaryWriter(log_dir=self.args.summary_dir)
+        # 多进程训练时只有rank 0做dev、保存模型和summary，dev结果广播到所有进程
+        main_process = is_main_process(self.args)
+        summary_writer = SummaryWriter(log_dir=self.args.summary_dir) if main_process else None
         for epoch in range(1, self.args.max_train_epochs + 1):
             epoch_ave_loss = 0
-            train_data_loader = tqdm(train_data_loader, desc=f'Training epoch {epoch}')
+            epoch_steps = 0
+            # 多进程训练时每个epoch重新划分数据
+            for sampler in (train_data_loader.sampler, train_data_loader.batch_sampler):
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch)
+            epoch_iterator = tqdm(train_data_loader, desc=f'Training epoch {epoch}', disable=not main_process)
             # 某些模型在训练时可能需要一些定制化的操作，默认什么都不做
             # 具体参考子类中_custom_train_operations的实现
-            self._custom_train_operations(epoch)
-            for step, batch in enumerate(train_data_loader):
-                batch = tuple(t.to(self.args.device) for t in batch)
+            if epoch > 1:
+                self._custom_train_operations(epoch)
+            # 每次参数更新使用gradient_accumulation_steps个micro-batch，global_step按参数更新的次数计算
+            for micro_batches in self._accumulation_groups(epoch_iterator):
                 self.model.train()
                 # debug_print(batch)
                 # word_mask:以word为单位，1为真实输入，0为PAD
-                inputs, word_mask, _, dep_ids = self._unpack_batch(self.args, batch)
-                # word_pad_mask:以word为单位，1为PAD，0为真实输入
-                word_pad_mask = torch.eq(word_mask, 0)
-                unlabeled_scores, labeled_scores = self.model(inputs)
-                labeled_target = dep_ids
-                unlabeled_target = labeled_target.ge(1).to(unlabeled_scores.dtype)
-                # Calc loss and update:
-                loss, _ = self._update_and_predict(unlabeled_scores, labeled_scores, unlabeled_target, labeled_target,
-                                                   word_pad_mask,
-                                                   label_loss_ratio=self.model.label_loss_ratio if not self.args.parallel_train else self.model.module.label_loss_ratio,
-                                                   calc_loss=True, update=True, calc_prediction=False)
+                micro_batches = [self._unpack_batch(self.args, batch) for batch in micro_batches]
+                # loss按照所有micro-batch的总单词数平均，与不做梯度累积的大batch一致
+                words_num = sum(sum(sent_len) for _, _, sent_len, _, _ in micro_batches)
+                loss = 0
+                for micro_step, (inputs, word_mask, sent_len, arcs, _) in enumerate(micro_batches):
+                    optimizer_step = micro_step == len(micro_batches) - 1
+                    # 多进程训练时只在最后一个micro-batch同步梯度
+                    sync_context = self.model.no_sync() if self.args.distributed and not optimizer_step \
+                        else contextlib.ExitStack()
+                    with sync_context:
+                        # word_pad_mask:以word为单位，1为PAD，0为真实输入
+                        word_pad_mask = torch.eq(word_mask, 0)
+                        # 稠密的目标矩阵按batch在device上构造
+                        labeled_target = make_graph_target(arcs, word_mask.size(0), word_mask.size(1))
+                        unlabeled_target = labeled_target.ge(1).float()
+                        model_kwargs = {}
+                        if getattr(self.args, 'gold_arc_label_loss', False):
+                            # 只在gold弧上计算标签打分和标签loss，labeled_target变为每条gold弧的标签 (E)
+                            model_kwargs['label_pair_index'], labeled_target = make_gold_arc_target(
+                                arcs, word_mask.size(1))
+                        with self.amp.autocast():
+                            if self.args.distributed and self.args.find_unused_parameters:
+                                unlabeled_scores, labeled_scores, label_loss_ratio = self.model(
+                                    inputs, return_label_loss_ratio=True, **model_kwargs)
+                            else:
+                                unlabeled_scores, labeled_scores = self.model(inputs, **model_kwargs)
+                                label_loss_ratio = self.model_module.label_loss_ratio
+                        # Calc loss and update:
+                        micro_loss, _ = self._update_and_predict(unlabeled_scores, labeled_scores, unlabeled_target,
+                                                                 labeled_target, word_pad_mask,
+                                                                 label_loss_ratio=label_loss_ratio,
+                                                                 sentence_lengths=sent_len,
+                                                                 calc_loss=True, update=True, calc_prediction=False,
+                                                                 words_num=words_num,
+                                                                 optimizer_step=optimizer_step)
+                    loss += micro_loss
                 global_step += 1
+                epoch_steps += 1
                 if loss is not None:
                     epoch_ave_loss += loss
 
                 if global_step % self.args.eval_interval == 0:
-                    summary_writer.add_scalar('loss/train', loss, global_step)
+                    loss, = all_reduce_mean(self.args, float(loss))
+                    if main_process:
+                        summary_writer.add_scalar('loss/train', loss, global_step)
                     if dev_data_loader:
-                        UAS, LAS = self.dev(dev_data_loader, dev_CoNLLU_file)
-                        summary_writer.add_scalar('metrics/uas', UAS, global_step)
-                        summary_writer.add_scalar('metrics/las', LAS, global_step)
-                        if best_result.is_new_record(LAS=LAS, UAS=UAS, global_step=global_step):
+                        UAS, LAS = self.dev(dev_data_loader, dev_CoNLLU_file) if main_process else (0, 0)
+                        UAS, LAS = broadcast_values(self.args, UAS, LAS)
+                        if main_process:
+                            summary_writer.add_scalar('metrics/uas', UAS, global_step)
+                            summary_writer.add_scalar('metrics/las', LAS, global_step)
+                        if best_result.is_new_record(LAS=LAS, UAS=UAS, global_step=global_step) and main_process:
                             print(f"\n## NEW BEST RESULT in epoch {epoch} ##")
                             print(best_result)
                             # 保存最优模型：
-                            if hasattr(self.model, 'module'):
-                                # 多卡,torch.nn.DataParallel封装model
-                                self.model.module.save_pretrained(self.args.output_model_dir)
-                            else:
-                                self.model.save_pretrained(self.args.output_model_dir)
+                            self.model_module.save_pretrained(self.args.output_model_dir)
 
                 if self.args.early_stop and global_step - best_result.best_LAS_step > self.args.early_stop_steps:
                     print(f'\n## Early stop in step:{global_step} ##')
@@ -175,126 +259,215 @@ class BiaffineDependencyTrainer(metaclass=ABCMeta):
             if train_stop:
                 break
             # print(f'\n- Epoch {epoch} average loss : {epoch_ave_loss / len(train_data_loader)}')
-            summary_writer.add_scalar('epoch_loss', epoch_ave_loss / len(train_data_loader), epoch)
+            epoch_ave_loss, = all_reduce_mean(self.args, float(epoch_ave_loss) / max(1, epoch_steps))
+            if main_process:
+                summary_writer.add_scalar('epoch_loss', epoch_ave_loss, epoch)
+        if not main_process:
+            return
         with open(self.args.dev_result_path, 'w', encoding='utf-8')as f:
             f.write(str(best_result) + '\n')
         print("\n## BEST RESULT in Training ##")
         print(best_result)
         summary_writer.close()
 
+    def _accumulation_groups(self, data_loader):
+        """
+            把data loader的batch按gradient_accumulation_steps个一组输出，每组对应一次参数更新；
+            epoch末尾不足一组的batch也单独更新一次
+        """
+        micro_batches = []
+        for batch in data_loader:
+            micro_batches.append(batch)
+            if len(micro_batches) == getattr(self.args, 'gradient_accumulation_steps', 1):
+                yield micro_batches
+                micro_batches = []
+        if micro_batches:
+            yield micro_batches
+
     def dev(self, dev_data_loader, dev_CoNLLU_file, input_conllu_path=None, output_conllu_path=None):
         assert isinstance(dev_CoNLLU_file, CoNLLFile)
         if input_conllu_path is None:
             input_conllu_path = os.path.join(self.args.data_dir, self.args.dev_file)
         if output_conllu_path is None:
             output_conllu_path = self.args.dev_output_path
-        dev_data_loader = tqdm(dev_data_loader, desc='Evaluation')
-        predictions = []
-        for step, batch in enumerate(dev_data_loader):
+        self._write_predictions(dev_data_loader, dev_CoNLLU_file, output_conllu_path, desc='Evaluation')
+        UAS, LAS = sdp_scorer.score(output_conllu_path, input_conllu_path)
+        return UAS, LAS
+
+    def inference(self, inference_data_loader, inference_CoNLLU_file, output_conllu_path):
+        return self._write_predictions(inference_data_loader, inference_CoNLLU_file, output_conllu_path,
+                                       desc='Inference')
+
+    def _iter_predictions(self, data_loader, desc):
+        """
+            逐个batch预测
+        :return: 生成器，每个元素为 (batch中每句话在原始CoNLL-U文件中的序号, batch的预测结果)，
+                 预测结果为依存弧的边表，ndarray (E x 4)：[batch内的句子序号, dependent, head, label_id]
+        """
+        for step, batch in enumerate(tqdm(data_loader, desc=desc)):
             self.model.eval()
-            batch = tuple(t.to(self.args.device) for t in batch)
-            inputs, word_mask, sent_lens, dep_ids = self._unpack_batch(self.args, batch)
+            inputs, word_mask, sent_lens, _, batch_sent_ids = self._unpack_batch(self.args, batch)
             word_mask = torch.eq(word_mask, 0)
-            unlabeled_scores, labeled_scores = self.model(inputs)
+            if getattr(self.args, 'sparse_label_scoring', False):
+                with torch.no_grad():
+                    batch_prediction = self._sparse_predict(inputs, word_mask, sent_lens)
+                yield batch_sent_ids, batch_prediction
+                continue
+            # 多进程训练时只有rank 0做dev，不能经过DistributedDataParallel（前向时会和其他进程同步）
+            model = self.model_module if self.args.distributed else self.model
+            with self.amp.autocast():
+                unlabeled_scores, labeled_scores = model(inputs)
             try:
                 with torch.no_grad():
                     _, batch_prediction = self._update_and_predict(unlabeled_scores, labeled_scores, None, None,
                                                                    word_mask,
-                                                                   label_loss_ratio=self.model.label_loss_ratio if not self.args.parallel_train else self.model.module.label_loss_ratio,
+                                                                   label_loss_ratio=self.model_module.label_loss_ratio,
                                                                    sentence_lengths=sent_lens,
                                                                    calc_loss=False, update=False, calc_prediction=True)
             except Exception as e:
                 for b in batch:
                     print(b.shape)
                 raise e
-            predictions += batch_prediction
-            # batch_sent_lens += sent_lens
+            yield batch_sent_ids, batch_prediction
 
-        dev_CoNLLU_file.set(['deps'], [dep for sent in predictions for dep in sent])
-        dev_CoNLLU_file.write_conll(output_conllu_path)
-        UAS, LAS = sdp_scorer.score(output_conllu_path, input_conllu_path)
-        return UAS, LAS
+    def _sparse_predict(self, inputs, word_pad_mask, sentence_lengths):
+        """
+            先在设备上解码无标签弧（解码结果与标签无关），只对解码得到的弧计算标签，
+            标签部分的计算量从 O(L^2*C) 降为 O(弧的数量*C)，传回CPU的只有依存弧的边表
+            :param word_pad_mask: 以word为单位，1为PAD，0为真实输入
+        """
+        model = self.model_module
+        with self.amp.autocast():
+            # fused_biaffine时弧和标签共用的线性变换只计算一次
+            biaffine_inputs = model.biaffine_inputs(model.encode(inputs))
+            unlabeled_scores = model.score_arcs(biaffine_inputs)
+        # 将PAD的位置概率设为0
+        pad_mask = word_pad_mask.unsqueeze(1) | word_pad_mask.unsqueeze(2)
+        head_probs = torch.sigmoid(unlabeled_scores.float()).masked_fill(pad_mask, 0)
+        sem_graph = sdp_decoder_from_heads_torch(head_probs, None, sentence_lengths)
+        # (E x 4) [句子序号, dependent, head, label]
+        edges = semgraph_to_edges(sem_graph, sentence_lengths)
+        # (E x C) -> (E)
+        with self.amp.autocast():
+            label_scores = model.score_labels(biaffine_inputs, edges[:, :3])
+        edges[:, 3] = label_scores.float().argmax(-1)
+        return edges.cpu().numpy()
 
-    def inference(self, inference_data_loader, inference_CoNLLU_file, output_conllu_path):
-        inference_data_loader = tqdm(inference_data_loader, desc='Inference')
-        predictions = []
-        for step, batch in enumerate(inference_data_loader):
-            self.model.eval()
-            inputs, word_mask, sent_lens, _ = self._unpack_batch(self.args, batch)
-            word_mask = torch.eq(word_mask, 0)
-            unlabeled_scores, labeled_scores = self.model(inputs)
-            with torch.no_grad():
-                _, batch_prediction = self._update_and_predict(unlabeled_scores, labeled_scores, None, None, word_mask,
-                                                               label_loss_ratio=self.model.label_loss_ratio if not self.args.parallel_train else self.model.module.label_loss_ratio,
-                                                               sentence_lengths=sent_lens,
-                                                               calc_loss=False, update=False, calc_prediction=True)
-            predictions += batch_prediction
-        inference_CoNLLU_file.set(['deps'], [dep for sent in predictions for dep in sent])
-        inference_CoNLLU_file.write_conll(output_conllu_path)
-        return predictions
+    def _write_predictions(self, data_loader, CoNLLU_file, output_conllu_path, desc):
+        assert isinstance(CoNLLU_file, CoNLLFile)
+        if isinstance(data_loader.dataset, IterableDataset):
+            # 流式输入：batch按原始顺序输出，边预测边写入，不在内存中保存整个文件和所有预测结果
+            CoNLLU_file.write_conll_with_edges(self._iter_predictions(data_loader, desc), output_conllu_path,
+                                               self.deps_formatter)
+            return None
+        edges = []
+        sent_ids = []
+        for batch_sent_ids, batch_edges in self._iter_predictions(data_loader, desc):
+            # batch内的句子序号换成原始CoNLL-U文件中的序号，
+            # batch可能按句长划分（见BucketBatchSampler），边表不需要排序，直接按句子序号写入对应的行
+            batch_edges[:, 0] = np.asarray(batch_sent_ids, dtype=np.int64)[batch_edges[:, 0]]
+            edges.append(batch_edges)
+            sent_ids += batch_sent_ids
+        edges = np.concatenate(edges) if edges else np.zeros((0, 4), dtype=np.int64)
+        CoNLLU_file.set_deps_from_edges(sent_ids, edges, self.deps_formatter)
+        CoNLLU_file.write_conll(output_conllu_path)
+        # (E x 4)：[句子序号, dependent, head, label_id]
+        return edges
 
 
 class BERTologyBiaffineTrainer(BiaffineDependencyTrainer):
     def __init__(self, config, *args, **kwargs):
         super().__init__(config, *args, **kwargs)
         if config.freeze:
-            assert config.freeze_bertology_layers >= -1 and config.freeze_epochs in ['all', 'first']
+            assert config.freeze_bertology_layers >= -1 and config.freeze_epochs in ['all', 'first', 'progressive']
+            assert getattr(config, 'unfreeze_layers_per_epoch', 1) > 0
         self._freeze = config.freeze
         self._freeze_layers = config.freeze_bertology_layers
         self._freeze_epochs = config.freeze_epochs
-        # 记录被freeze的参数名称
-        # 在第一个epoch时刻写入
-        # 之后直接读取这个list中的参数
-        self._freeze_parameter_names = []
+        self._unfreeze_layers_per_epoch = getattr(config, 'unfreeze_layers_per_epoch', 1)
+        # 被freeze的参数按层分组（从下往上），_num_frozen_groups记录当前仍被freeze的组数
+        self._freeze_groups = self._get_freeze_groups() if self._freeze else []
+        self._num_frozen_groups = 0
 
     def _unpack_batch(self, args, batch):
+        # word_mask:以word为单位，1为真实输入，0为PAD
+        # 单词位置的PAD为batch中字序列的长度-1（见BERTologyDataset.collate）
+        # 句长、句子序号在移到device之前由CPU上的张量得到，不需要与device同步
+        word_mask = (batch[3] != (batch[0].size(1) - 1)).to(torch.long)
+        sent_len = torch.sum(word_mask, 1).tolist()
+        sent_ids = batch[6].tolist()
+        # 单词维度只保留到batch中最长句子的单词数（包括ROOT），
+        # 之后的encoder输出、biaffine打分、loss和解码的规模都只与实际句长有关，而不是max_seq_len
+        max_word_len = max(sent_len)
         inputs = {
-            'input_ids': batch[0],
-            'attention_mask': batch[1],
-            'token_type_ids': batch[2] if args.encoder_type in ['bertology', 'xlnet'] else None,
-            'start_pos': batch[3],
-            'end_pos': batch[4],
+            'input_ids': batch[0].to(args.device),
+            'attention_mask': batch[1].to(args.device),
+            'token_type_ids': batch[2].to(args.device) if args.encoder_type in ['bertology', 'xlnet'] else None,
+            'start_pos': batch[3][:, :max_word_len].to(args.device),
+            'end_pos': batch[4][:, :max_word_len].to(args.device),
         }
-        dep_ids = batch[5]
-        # word_mask:以word为单位，1为真实输入，0为PAD
-        word_mask = (batch[3] != (args.max_seq_len - 1)).to(torch.long).to(args.device)
-        sent_len = torch.sum(word_mask, 1).cpu().tolist()
-        return inputs, word_mask, sent_len, dep_ids
+        arcs = batch[5].to(args.device)
+        return inputs, word_mask[:, :max_word_len].to(args.device), sent_len, arcs, sent_ids
 
     def _custom_train_operations(self, epoch):
         """
             重写BiaffineDependencyTrainer的_custom_train_operations方法，
             提供定制化的训练操作
-            这里我们做BERTology中某些层的freeze
+            这里我们做BERTology中某些层的freeze：
+            第一个epoch（在构造optimizer之前）freeze，被freeze的参数不进入optimizer，也不需要反向计算；
+            之后按照freeze_epochs解冻，解冻的参数加入optimizer
         :param epoch:
         :return:
         """
-        if self._freeze:
-            if epoch == 1:
-                # 首个epoch一定会freeze
-                # 利用正则识别参数名，对其进行freeze
-                for name, para in self.model.named_parameters():
-                    # Freeze BERTology embedding layer
-                    if re.match(f'^.+encoder\.bertology\.embeddings\..+', name):
-                        para.requires_grad = False
-                        self._freeze_parameter_names.append(name)
-                    # Freeze other BERTology Layers
-                    # 如果self._freeze_layers > -1；则说明除了freeze embedding层之外，还要freeze别的层
-                    if self._freeze_layers > -1:
-                        if re.match(
-                                f'^.+encoder\.bertology\.encoder\.layer\.[0-{self._freeze_layers}]\..+',
-                                name):
-                            para.requires_grad = False
-                        self._freeze_parameter_names.append(name)
-            else:
-                # 如果_freeze_epochs == ‘all’,则此时不需要做任何事情，因为第一个epoch已经freeze过了
-                if self._freeze_epochs == 'first':
-                    # 仅在第一个epoch freeze参数
-                    # epoch大于1的时候不再需要freeze了
-                    # 此时将_freeze_parameter_names中的参数重新设置为需要计算梯度
-                    for name, para in self.model.named_parameters():
-                        if name in self._freeze_parameter_names:
-                            para.requires_grad = True
+        if not self._freeze:
+            return
+        if epoch == 1:
+            # 首个epoch一定会freeze
+            for group in self._freeze_groups:
+                for _, para in group:
+                    para.requires_grad = False
+            self._num_frozen_groups = len(self._freeze_groups)
+            print(f'freeze {sum(len(group) for group in self._freeze_groups)} parameters')
+            return
+        # 如果_freeze_epochs == ‘all’,则此时不需要做任何事情，因为第一个epoch已经freeze过了
+        if self._freeze_epochs == 'first':
+            # 仅在第一个epoch freeze参数
+            num_frozen_groups = 0
+        elif self._freeze_epochs == 'progressive':
+            # 从上往下逐层解冻，被freeze的总是最底下的若干层，反向传播在最上面一个被freeze的层停止
+            num_frozen_groups = max(0, len(self._freeze_groups) - (epoch - 1) * self._unfreeze_layers_per_epoch)
+        else:
+            return
+        if num_frozen_groups >= self._num_frozen_groups:
+            return
+        unfreeze_parameters = []
+        for group in self._freeze_groups[num_frozen_groups:self._num_frozen_groups]:
+            for name, para in group:
+                para.requires_grad = True
+                unfreeze_parameters.append((name, para))
+        self._num_frozen_groups = num_frozen_groups
+        add_parameters_to_optimizer(self.args, self.optimizer, self.optim_scheduler, unfreeze_parameters)
+        print(f'epoch {epoch}: unfreeze {len(unfreeze_parameters)} parameters, '
+              f'{self._num_frozen_groups} groups are still frozen')
+
+    def _get_freeze_groups(self):
+        """
+            需要freeze的参数按层分组，从下往上：[embeddings, layer 0, layer 1, ..., layer freeze_bertology_layers]
+            只在构造时匹配一次参数名
+        :return: list of list of (name, parameter)
+        """
+        groups = [[] for _ in range(self._freeze_layers + 2)]
+        for name, para in self.model_module.named_parameters():
+            # Freeze BERTology embedding layer
+            if re.match(r'^encoder\.bertology\.embeddings\.', name):
+                groups[0].append((name, para))
+                continue
+            # Freeze other BERTology Layers
+            # 如果self._freeze_layers > -1；则说明除了freeze embedding层之外，还要freeze别的层
+            layer = re.match(r'^encoder\.bertology\.encoder\.layer\.(\d+)\.', name)
+            if layer and int(layer.group(1)) <= self._freeze_layers:
+                groups[int(layer.group(1)) + 1].append((name, para))
+        return groups
 
 
 class TransformerBiaffineTrainer(BiaffineDependencyTrainer):
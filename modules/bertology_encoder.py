@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 # Created by li huayong on 2019/9/24
+import inspect
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from pytorch_transformers import (BertConfig,
                                   BertTokenizer,
@@ -12,6 +15,7 @@ from pytorch_transformers import (BertConfig,
                                   XLMTokenizer, XLNetConfig,
                                   XLNetForSequenceClassification,
                                   XLNetTokenizer, BertModel)
+from pytorch_transformers.modeling_bert import BertEncoder
 
 from utils.information import debug_print
 from utils.input_utils.bertology.bert_input_utils import load_bert_tokenizer, get_data_loader, load_and_cache_examples
@@ -40,6 +44,74 @@ def batched_index_select(t, dim, inds):
     return out
 
 
+# torch>=1.11 支持不依赖输入梯度的checkpoint（use_reentrant=False）
+_NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+
+def checkpoint_forward(function, hidden_states, *args):
+    """
+        前向时不保存function内部的激活值，反向时重新计算（dropout的随机状态会被恢复）
+        旧版本的checkpoint要求输入需要梯度，否则function中的参数得不到梯度，
+        此时（例如前面的层被freeze）直接计算，不做checkpoint
+    """
+    if _NON_REENTRANT_CHECKPOINT:
+        return checkpoint(function, hidden_states, *args, use_reentrant=False)
+    if not hidden_states.requires_grad:
+        return function(hidden_states, *args)
+    # 旧版本（reentrant）的checkpoint在反向时对每个输入调用detach，None等非Tensor参数会出错，
+    # 只把Tensor作为checkpoint的输入，其余参数在闭包中按原位置补回
+    tensor_positions = [i for i, a in enumerate(args) if torch.is_tensor(a)]
+
+    def tensor_function(hidden_states, *tensors):
+        full_args = list(args)
+        for i, t in zip(tensor_positions, tensors):
+            full_args[i] = t
+        return function(hidden_states, *full_args)
+
+    return checkpoint(tensor_function, hidden_states, *[args[i] for i in tensor_positions])
+
+
+class CheckpointedBertEncoder(BertEncoder):
+    """
+        对指定的BERT层使用activation checkpointing，用计算换显存
+        直接使用已有BertEncoder中的层，参数名称不变，可以直接加载预训练的参数
+    """
+
+    def __init__(self, encoder, checkpoint_layers=()):
+        # 不调用BertEncoder.__init__，避免重新构造（并随机初始化）所有的层
+        nn.Module.__init__(self)
+        self.output_attentions = encoder.output_attentions
+        self.output_hidden_states = encoder.output_hidden_states
+        self.layer = encoder.layer
+        self.checkpoint_layers = set(checkpoint_layers)
+
+    def forward(self, hidden_states, attention_mask, head_mask=None):
+        all_hidden_states = ()
+        all_attentions = ()
+        for i, layer_module in enumerate(self.layer):
+            if self.output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+
+            if i in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                layer_outputs = checkpoint_forward(layer_module, hidden_states, attention_mask, head_mask[i])
+            else:
+                layer_outputs = layer_module(hidden_states, attention_mask, head_mask[i])
+            hidden_states = layer_outputs[0]
+
+            if self.output_attentions:
+                all_attentions = all_attentions + (layer_outputs[1],)
+
+        if self.output_hidden_states:
+            all_hidden_states = all_hidden_states + (hidden_states,)
+
+        outputs = (hidden_states,)
+        if self.output_hidden_states:
+            outputs = outputs + (all_hidden_states,)
+        if self.output_attentions:
+            outputs = outputs + (all_attentions,)
+        return outputs
+
+
 class BERTologyEncoder(nn.Module):
     def __init__(
             self,
@@ -53,7 +125,13 @@ class BERTologyEncoder(nn.Module):
             after_layers=0,
             max_seq_len=None,
             after_dropout=0.1,
+            checkpoint_bertology_layers=None,
+            checkpoint_after_layers=False,
     ):
+        """
+        :param checkpoint_bertology_layers: 使用activation checkpointing的BERT层序号（list），'all'表示所有层
+        :param checkpoint_after_layers: after_encoder的每一层是否使用activation checkpointing
+        """
         super().__init__()
         self.device = torch.device("cuda" if torch.cuda.is_available() and not no_cuda else "cpu")
         self.n_gpu = torch.cuda.device_count()
@@ -69,6 +147,16 @@ class BERTologyEncoder(nn.Module):
         # 注意这里不加载BERT的预训练参数
         # BERT的参数通过Model.from_pretrained方法加载
         self.bertology = self.bertology_model_class(config=self.bertology_config)
+        # pooler的输出（[CLS]的句向量）不参与计算，不需要训练
+        pooler = getattr(self.bertology, 'pooler', None)
+        if pooler is not None:
+            pooler.requires_grad_(False)
+        if checkpoint_bertology_layers:
+            assert self.bertology_type == 'bert', 'activation checkpointing仅支持BERT'
+            if checkpoint_bertology_layers == 'all':
+                checkpoint_bertology_layers = range(self.bertology_config.num_hidden_layers)
+            self.bertology.encoder = CheckpointedBertEncoder(self.bertology.encoder, checkpoint_bertology_layers)
+        self.checkpoint_after_layers = checkpoint_after_layers
         self.dropout = nn.Dropout(self.bertology_config.hidden_dropout_prob)
         self.bertology_output_mode = bertology_output_mode
         self.bertology_word_select_mode = bertology_word_select_mode
@@ -132,14 +220,18 @@ class BERTologyEncoder(nn.Module):
         # transformer输入需要attention pad，也就是需要指出哪些是pad的输入
         # 注意这里不能直接使用attention mask作为transformer的输入，这是因为attention mask是原来的字序列的mask
         # 这里我们需要词序列的mask：
-        word_attention_pad_mask = torch.eq(start_pos, self.max_seq_len - 1)
+        # 单词位置的PAD为batch中字序列的长度-1（见BERTologyDataset.collate）
+        word_attention_pad_mask = torch.eq(start_pos, input_ids.size(1) - 1)
         # 确保pad位置向量为0
         encoder_output *= (1 - word_attention_pad_mask.unsqueeze(-1).type_as(encoder_output))
         if self.after_encoder is not None:
             # batch X Seq_len X dim -> Seq_len X batch X dim
             encoder_output = encoder_output.transpose(0, 1)
             for layer in self.after_encoder:
-                encoder_output, _ = layer(encoder_output, self_attn_padding_mask=word_attention_pad_mask)
+                if self.checkpoint_after_layers and self.training and torch.is_grad_enabled():
+                    encoder_output, _ = checkpoint_forward(layer, encoder_output, None, word_attention_pad_mask)
+                else:
+                    encoder_output, _ = layer(encoder_output, self_attn_padding_mask=word_attention_pad_mask)
             # Seq_len X batch X dim -> batch X Seq_len X dim
             encoder_output = encoder_output.transpose(0, 1)
         return self.dropout(encoder_output)
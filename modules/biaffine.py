@@ -3,12 +3,22 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def gather_pairs(input1, input2, pair_index):
+    """
+        取出指定的 (input1, input2) 位置对
+    :param pair_index: (E x 3) [batch内的句子序号, input1中的位置, input2中的位置]
+    :return: (E x D1), (E x D2)
+    """
+    return input1[pair_index[:, 0], pair_index[:, 1]], input2[pair_index[:, 0], pair_index[:, 2]]
+
+
 class PairwiseBilinear(nn.Module):
     '''
     使用版本
     A bilinear module that deals with broadcasting for efficient memory usage.
     Input: tensors of sizes (N x L1 x D1) and (N x L2 x D2)
-    Output: tensor of size (N x L1 x L2 x O)'''
+    Output: tensor of size (N x L1 x L2 x O)
+    如果给出pair_index (E x 3)，则只计算这E个位置对，Output: tensor of size (E x O)'''
 
     def __init__(self, input1_size, input2_size, output_size, bias=True):
         super().__init__()
@@ -20,9 +30,13 @@ class PairwiseBilinear(nn.Module):
         # 无标签弧分类时 output_size=1
         # 标签分类时 output_size=len(labels)
         self.weight = nn.Parameter(torch.Tensor(input1_size, input2_size, output_size))
-        self.bias = nn.Parameter(torch.Tensor(output_size)) if bias else 0
+        # forward中不使用bias（偏置由输入末尾补的1和weight表示），保留该参数只是为了兼容已保存的模型；
+        # 不需要训练，多进程训练时也不会被当作未使用的参数
+        self.bias = nn.Parameter(torch.Tensor(output_size), requires_grad=False) if bias else 0
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, pair_index=None):
+        if pair_index is not None:
+            return self._forward_pairs(input1, input2, pair_index)
         input1_size = list(input1.size())
         input2_size = list(input2.size())
         output_size = [input1_size[0], input1_size[1], input2_size[1], self.output_size]
@@ -49,6 +63,65 @@ class PairwiseBilinear(nn.Module):
 
         return output
 
+    def _forward_pairs(self, input1, input2, pair_index):
+        # (E x D1), (E x D2)
+        input1, input2 = gather_pairs(input1, input2, pair_index)
+        # 与forward中的计算方式一致：(E x D1) * (D1 x (O x D2)) -> (E x O x D2)
+        intermediate = torch.mm(input1, self.weight.view(-1, self.input2_size * self.output_size))
+        intermediate = intermediate.view(-1, self.output_size, self.input2_size)
+        # (E x O x D2) * (E x D2 x 1) -> (E x O)
+        return intermediate.bmm(input2.unsqueeze(2)).squeeze(2)
+
+
+class LowRankPairwiseBilinear(nn.Module):
+    '''
+    低秩分解的PairwiseBilinear（Tucker分解）：
+        W[:, o, :] = U · G[:, o, :] · V^T
+    先把两个输入分别投影到rank维，再做rank x rank的PairwiseBilinear，
+    参数量从 D1 x D2 x O 降为 (D1 + D2) x rank + rank x rank x O
+    Input: tensors of sizes (N x L1 x D1) and (N x L2 x D2)
+    Output: tensor of size (N x L1 x L2 x O)，给出pair_index时为 (E x O)'''
+
+    def __init__(self, input1_size, input2_size, output_size, rank, bias=True):
+        super().__init__()
+        self.input1_size = input1_size
+        self.input2_size = input2_size
+        self.output_size = output_size
+        self.rank = rank
+        self.U = nn.Linear(input1_size, rank, bias=False)
+        self.V = nn.Linear(input2_size, rank, bias=False)
+        self.core = PairwiseBilinear(rank, rank, output_size, bias=bias)
+
+    @property
+    def weight(self):
+        return self.core.weight
+
+    @property
+    def bias(self):
+        return self.core.bias
+
+    def forward(self, input1, input2, pair_index=None):
+        return self.core(self.U(input1), self.V(input2), pair_index)
+
+
+def low_rank_decompose(weight, rank):
+    """
+        把稠密的PairwiseBilinear权重截断分解（HOSVD）为LowRankPairwiseBilinear的参数
+    :param weight: PairwiseBilinear.weight (D1 x D2 x O)
+    :return: U.weight (rank x D1), V.weight (rank x D2), core.weight (rank x rank x O)
+    """
+    input1_size, input2_size, output_size = weight.size()
+    # PairwiseBilinear中权重按照 (D1 x O x D2) 使用，见forward
+    weight = weight.reshape(input1_size, output_size, input2_size).double()
+    # 第一维和第三维展开后分别做SVD，取前rank个左奇异向量
+    u = torch.svd(weight.reshape(input1_size, -1))[0][:, :rank]
+    v = torch.svd(weight.permute(2, 0, 1).reshape(input2_size, -1))[0][:, :rank]
+    # G[a, o, b] = sum_ij U[i, a] W[i, o, j] V[j, b]，(rank x O x rank)
+    core = torch.matmul(torch.matmul(u.t(), weight.reshape(input1_size, -1)).reshape(-1, input2_size), v)
+    # 与PairwiseBilinear.weight的存储方式一致：(rank x O x rank) 的内存按 (rank x rank x O) 保存
+    core = core.reshape(u.size(1), v.size(1), output_size)
+    return u.t().contiguous().float(), v.t().contiguous().float(), core.float()
+
 
 class BiaffineScorer(nn.Module):
     def __init__(self, input1_size, input2_size, output_size):
@@ -62,7 +135,9 @@ class BiaffineScorer(nn.Module):
         self.W_bilin.weight.data.zero_()
         self.W_bilin.bias.data.zero_()
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, pair_index=None):
+        if pair_index is not None:
+            input1, input2 = gather_pairs(input1, input2, pair_index)
         # input1 size：[batch_size, seq_len, feature_size]
         # input1.new_ones(*input1.size()[:-1], 1)'s size: [batch_size, seq_len, 1]
         input1 = torch.cat([input1, input1.new_ones(*input1.size()[:-1], 1)], len(input1.size()) - 1)
@@ -72,12 +147,13 @@ class BiaffineScorer(nn.Module):
 
 
 class PairwiseBiaffineScorer(nn.Module):
-    def __init__(self, input1_size, input2_size, output_size):
+    def __init__(self, input1_size, input2_size, output_size, rank=None):
         """
         使用版本
         :param input1_size:
         :param input2_size:
         :param output_size:双仿的分类空间
+        :param rank: 不为None时使用低秩分解的双仿变换（LowRankPairwiseBilinear）
         """
         super().__init__()
         # 为什么+1:
@@ -90,35 +166,38 @@ class PairwiseBiaffineScorer(nn.Module):
         #       bmm-> [batch_size, (seq_len*output_size), seq_len]
         # [batch_size, (seq_len*output_size), seq_len]
         #       view-> [batch_size, seq_len, seq_len, output_size]
-        self.W_bilin = PairwiseBilinear(input1_size + 1, input2_size + 1, output_size)
+        if rank:
+            self.W_bilin = LowRankPairwiseBilinear(input1_size + 1, input2_size + 1, output_size, rank)
+        else:
+            self.W_bilin = PairwiseBilinear(input1_size + 1, input2_size + 1, output_size)
 
         self.W_bilin.weight.data.zero_()
         self.W_bilin.bias.data.zero_()
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, pair_index=None):
         # input1 size：[batch_size, seq_len, feature_size]
         # input1.new_ones(*input1.size()[:-1], 1)'s size: [batch_size, seq_len, 1]
         input1 = torch.cat([input1, input1.new_ones(*input1.size()[:-1], 1)], len(input1.size()) - 1)
         # 拼接后的size:[batch_size, seq_len, (feature_size+1)]
         input2 = torch.cat([input2, input2.new_ones(*input2.size()[:-1], 1)], len(input2.size()) - 1)
-        return self.W_bilin(input1, input2)
+        return self.W_bilin(input1, input2, pair_index)
 
 
 class DirectBiaffineScorer(nn.Module):
-    def __init__(self, input1_size, input2_size, output_size, pairwise=True):
+    def __init__(self, input1_size, input2_size, output_size, pairwise=True, rank=None):
         super().__init__()
         if pairwise:
-            self.scorer = PairwiseBiaffineScorer(input1_size, input2_size, output_size)
+            self.scorer = PairwiseBiaffineScorer(input1_size, input2_size, output_size, rank)
         else:
             self.scorer = BiaffineScorer(input1_size, input2_size, output_size)
 
-    def forward(self, input1, input2):
-        return self.scorer(input1, input2)
+    def forward(self, input1, input2, pair_index=None):
+        return self.scorer(input1, input2, pair_index)
 
 
 class DeepBiaffineScorer(nn.Module):
     def __init__(self, input1_size, input2_size, hidden_size, output_size, hidden_func=F.relu, dropout=0,
-                 pairwise=True):
+                 pairwise=True, rank=None):
         """
         使用版本
         :param input1_size:
@@ -128,6 +207,7 @@ class DeepBiaffineScorer(nn.Module):
         :param hidden_func:
         :param dropout:
         :param pairwise:
+        :param rank: 不为None时双仿变换使用低秩分解（仅pairwise）
         """
         super().__init__()
         # 先对输入做两个线性变换得到两个H_dep、H_head
@@ -136,15 +216,83 @@ class DeepBiaffineScorer(nn.Module):
         # 默认经过relu激活函数：
         self.hidden_func = hidden_func
         if pairwise:
-            self.scorer = PairwiseBiaffineScorer(hidden_size, hidden_size, output_size)
+            self.scorer = PairwiseBiaffineScorer(hidden_size, hidden_size, output_size, rank)
         else:
             self.scorer = BiaffineScorer(hidden_size, hidden_size, output_size)
         # 进入双仿前dropout:
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, pair_index=None):
+        """
+            pair_index为None时输出 (N x L1 x L2 x O)；否则只计算给出的E个位置对，输出 (E x O)
+        """
         return self.scorer(self.dropout(self.hidden_func(self.W1(input1))),
-                           self.dropout(self.hidden_func(self.W2(input2))))
+                           self.dropout(self.hidden_func(self.W2(input2))),
+                           pair_index)
+
+
+class FusedDeepBiaffineScorer(nn.Module):
+    def __init__(self, input_size, hidden_size, label_size, hidden_func=F.relu, dropout=0):
+        """
+        无标签弧和标签共用一个DeepBiaffine：
+        一个拼接的线性变换同时得到H_dep、H_head，一次双仿变换同时得到弧的打分（第0维）和标签的打分（第1~label_size维）
+        Input: tensor of size (N x L x D)
+        Output: tensor of size (N x (1 + label_size) x L x L)，通道在前，
+                [:, 0]为无标签弧的logits，[:, 1:]为标签的logits，可以直接输入CrossEntropyLoss，不需要view；
+                如果给出pair_index (E x 3)，则只计算这E个位置对，Output: tensor of size (E x (1 + label_size))；
+                output_slice用于只计算部分输出通道（例如只计算无标签弧：slice(0, 1)）
+        分别计算弧和标签时，先用project得到H_dep、H_head，再用score分别计算，线性变换和dropout只做一次
+        :param input_size:
+        :param hidden_size:
+        :param label_size: 标签的分类空间
+        :param hidden_func:
+        :param dropout:
+        """
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.output_size = 1 + label_size
+        # [W_dep; W_head]
+        self.W = nn.Linear(input_size, 2 * hidden_size)
+        self.hidden_func = hidden_func
+        # 为什么+1：见PairwiseBiaffineScorer
+        self.weight = nn.Parameter(torch.zeros(self.output_size, hidden_size + 1, hidden_size + 1))
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, input1, input2=None, pair_index=None, output_slice=None):
+        return self.score(*self.project(input1, input2), pair_index=pair_index, output_slice=output_slice)
+
+    def project(self, input1, input2=None):
+        """
+            input2为None时（input1和input2相同）只做一次线性变换
+        :return: (H_dep, H_head)，末尾补1，(N x L x (hidden_size + 1))
+        """
+        if input2 is None or input2 is input1:
+            hidden = self.dropout(self.hidden_func(self.W(input1)))
+            dep, head = hidden.split(self.hidden_size, dim=-1)
+        else:
+            w_dep, w_head = self.W.weight.split(self.hidden_size, dim=0)
+            b_dep, b_head = self.W.bias.split(self.hidden_size, dim=0)
+            dep = self.dropout(self.hidden_func(F.linear(input1, w_dep, b_dep)))
+            head = self.dropout(self.hidden_func(F.linear(input2, w_head, b_head)))
+        dep = torch.cat([dep, dep.new_ones(*dep.size()[:-1], 1)], -1)
+        head = torch.cat([head, head.new_ones(*head.size()[:-1], 1)], -1)
+        return dep, head
+
+    def score(self, dep, head, pair_index=None, output_slice=None):
+        """
+        :param dep, head: project的输出
+        """
+        weight = self.weight if output_slice is None else self.weight[output_slice]
+        if pair_index is not None:
+            dep, head = gather_pairs(dep, head, pair_index)
+            # (1 x E x D1) * (O x D1 x D2) -> (O x E x D2)
+            intermediate = torch.matmul(dep.unsqueeze(0), weight)
+            # (O x E x D2) (*) (E x D2) -> (E x O)
+            return (intermediate * head.unsqueeze(0)).sum(-1).t()
+        # (N x 1 x L1 x D1) * (O x D1 x D2) -> (N x O x L1 x D2)
+        intermediate = torch.matmul(dep.unsqueeze(1), weight)
+        # (N x O x L1 x D2) * (N x 1 x D2 x L2) -> (N x O x L1 x L2)
+        return torch.matmul(intermediate, head.transpose(1, 2).unsqueeze(1))
 
 
 if __name__ == "__main__":
@@ -154,3 +302,5 @@ if __name__ == "__main__":
     print(scorer(x1, x2))
     res = scorer(x1, x2)
     print(res.size())
+    fused_scorer = FusedDeepBiaffineScorer(4, 6, 7)
+    print(fused_scorer(x1).size())
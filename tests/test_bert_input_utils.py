@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    特征转换的结果与预处理的进程数无关（包括训练时随机的input_mask）；流式输入的句子数不包括被跳过的过长句子
+"""
+import argparse
+import os
+
+import pytest
+from pytorch_transformers import BertTokenizer
+
+import utils.input_utils.bertology.bert_input_utils as bert_input_utils
+from utils.input_utils.conll_file import load_conllu_file
+from utils.input_utils.graph_vocab import GraphVocab
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GRAPH_VOCAB = os.path.join(ROOT_DIR, 'dataset', 'graph_vocab.txt')
+CONLLU = os.path.join(ROOT_DIR, 'dataset', 'dev', 'sdp_text_dev.conllu')
+SENTS_NUM = 60
+
+
+@pytest.fixture(scope='module')
+def conllu_data():
+    _, data = load_conllu_file(CONLLU, fields=bert_input_utils.TRAIN_CONLLU_FIELDS)
+    return data[:SENTS_NUM]
+
+
+@pytest.fixture(scope='module')
+def tokenizer(conllu_data, tmp_path_factory):
+    # 由语料中的字构造一个小词表
+    chars = sorted({c for sent in conllu_data for line in sent for c in line[0]})
+    vocab_file = tmp_path_factory.mktemp('bert') / 'vocab.txt'
+    vocab_file.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '[unused1]'] + chars) + '\n',
+                          encoding='utf-8')
+    return BertTokenizer(str(vocab_file), do_lower_case=False)
+
+
+def _args(num_preprocess_workers=1, input_mask_granularity='char', **kwargs):
+    args = argparse.Namespace(encoder_type='bertology', root_representation='unused', max_seq_len=256,
+                              input_mask=True, input_mask_prob=0.3, input_mask_granularity=input_mask_granularity,
+                              skip_too_long_input=True, seed=1234, num_preprocess_workers=num_preprocess_workers)
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+@pytest.mark.parametrize('input_mask_granularity', ['char', 'word'])
+def test_features_independent_of_workers(monkeypatch, conllu_data, tokenizer, input_mask_granularity):
+    # 小的chunk，使得每个进程处理多个chunk
+    monkeypatch.setattr(bert_input_utils, 'PREPROCESS_CHUNK_SIZE', 7)
+    graph_vocab = GraphVocab(GRAPH_VOCAB)
+    mask_id = tokenizer.convert_tokens_to_ids(['[MASK]'])[0]
+    features = {}
+    for workers in (1, 2):
+        features[workers] = [vars(f) for f in bert_input_utils._chunked_convert_to_features(
+            _args(workers, input_mask_granularity), conllu_data, graph_vocab, tokenizer, training=True)]
+    assert len(features[1]) == SENTS_NUM
+    assert features[1] == features[2]
+    assert any(mask_id in f['input_ids'] for f in features[1])
+
+
+@pytest.mark.parametrize('skip_too_long_input', [True, False])
+def test_streaming_len_excludes_skipped_sents(tmp_path, tokenizer, skip_too_long_input):
+    conllu_file = tmp_path / 'stream.conllu'
+    with open(CONLLU, encoding='utf-8') as f:
+        conllu_file.write_text('\n\n'.join(f.read().strip().split('\n\n')[:SENTS_NUM]) + '\n\n', encoding='utf-8')
+    # 较小的max_seq_len，使部分句子过长
+    args = _args(max_seq_len=30, skip_too_long_input=skip_too_long_input, streaming_chunk_size=16)
+    dataset, _ = bert_input_utils.load_streaming_examples(args, str(conllu_file), GraphVocab(GRAPH_VOCAB),
+                                                          tokenizer, training=True)
+    num_items = sum(1 for _ in dataset)
+    if skip_too_long_input:
+        assert 0 < num_items < SENTS_NUM
+    else:
+        assert num_items == SENTS_NUM
+    assert len(dataset) == num_items
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""
+    BiaffineDependencyModel对不兼容配置的检查
+"""
+import argparse
+import os
+
+import pytest
+
+from models.biaffine_model import BiaffineDependencyModel
+
+GRAPH_VOCAB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset', 'graph_vocab.txt')
+
+
+@pytest.mark.parametrize('direct_biaffine,low_rank_biaffine', [(True, False), (False, True)])
+def test_fused_biaffine_rejects_incompatible_scorers(direct_biaffine, low_rank_biaffine):
+    # 在构造encoder之前报错，因此不需要BERT模型
+    args = argparse.Namespace(graph_vocab_file=GRAPH_VOCAB, encoder_type='bertology', fused_biaffine=True,
+                              direct_biaffine=direct_biaffine, low_rank_biaffine=low_rank_biaffine)
+    with pytest.raises(ValueError, match='fused_biaffine'):
+        BiaffineDependencyModel(args)
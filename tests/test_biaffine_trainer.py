@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+    BiaffineDependencyTrainer对并行方式和配置组合的检查
+"""
+import argparse
+import os
+
+import pytest
+import torch
+
+from models.biaffine_trainer import BERTologyBiaffineTrainer
+
+GRAPH_VOCAB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset', 'graph_vocab.txt')
+
+
+def _args(**kwargs):
+    args = argparse.Namespace(graph_vocab_file=GRAPH_VOCAB, device=torch.device('cpu'), freeze=False,
+                              freeze_bertology_layers=-1, freeze_epochs='all')
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def test_gold_arc_label_loss_rejects_data_parallel():
+    # DataParallel会按gold弧切分label_pair_index，其中的句子序号对不上各个副本的输入
+    model = torch.nn.DataParallel(torch.nn.Linear(2, 2))
+    with pytest.raises(ValueError, match='gold_arc_label_loss'):
+        BERTologyBiaffineTrainer(_args(gold_arc_label_loss=True), model)
+    # 不使用gold_arc_label_loss，或者不使用DataParallel时正常构造
+    BERTologyBiaffineTrainer(_args(gold_arc_label_loss=False), model)
+    BERTologyBiaffineTrainer(_args(gold_arc_label_loss=True), torch.nn.Linear(2, 2))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    由依存弧的边表写出deps、head、deprel（CoNLLFile.set_deps_from_edges、write_conll_with_edges），以及sents的缓存和set
+"""
+import numpy as np
+import pytest
+
+from utils.input_utils.conll_file import CoNLLFile, DepsFormatter
+
+LABELS = ['Agt', 'Pat', 'Root', 'mPrep']
+
+INPUT = (
+    "1\t妈妈\t_\tNN\tNN\t_\t_\t_\t_\t_\n"
+    "2\t把\t_\tP\tP\t_\t_\t_\t_\t_\n"
+    "3\t撕成\t_\tVV\tVV\t_\t_\t_\t_\t_\n"
+    "\n"
+    "1-2\t长句\t_\t_\t_\t_\t_\t_\t_\t_\n"
+    "1\t长\t_\tJJ\tJJ\t_\t_\t_\t_\t_\n"
+    "2\t句\t_\tNN\tNN\t_\t_\t_\t_\t_\n"
+    "\n"
+    "1\t跳过\t_\tVV\tVV\t_\t9\tX\t9:X\t_\n"
+    "\n"
+)
+
+
+def _edges(rows):
+    return np.asarray(rows, dtype=np.int64).reshape(-1, 4)
+
+
+def test_deps_formatter():
+    formatter = DepsFormatter(LABELS)
+    # 同一个单词的弧按head排序，head和deprel取第一条弧；输入顺序任意
+    keys, (deps, head, deprel) = formatter.format([5, 2, 5, 5], [3, 0, 1, 300], [1, 2, 0, 3])
+    assert keys.tolist() == [2, 5]
+    assert deps.tolist() == ['0:Root', '1:Agt|3:Pat|300:mPrep']
+    assert head.tolist() == ['0', '1']
+    assert deprel.tolist() == ['Root', 'Agt']
+    keys, columns = formatter.format([], [], [])
+    assert len(keys) == 0 and all(len(c) == 0 for c in columns)
+
+
+def test_set_deps_from_edges():
+    conll = CoNLLFile(input_str=INPUT)
+    # 第0句的单词2没有依存弧，写为'_'；第2句没有预测结果，保持不变
+    edges = _edges([[0, 3, 0, 2], [0, 1, 3, 0], [0, 1, 2, 3],
+                    [1, 2, 0, 2], [1, 1, 2, 1]])
+    conll.set_deps_from_edges([0, 1], edges, DepsFormatter(LABELS))
+    assert conll.get(['deps', 'head', 'deprel'], as_sentences=True) == [
+        [['2:mPrep|3:Agt', '2', 'mPrep'], ['_', '_', '_'], ['0:Root', '0', 'Root']],
+        [['2:Pat', '2', 'Pat'], ['0:Root', '0', 'Root']],
+        [['9:X', '9', 'X']],
+    ]
+    # 多词token行不变
+    assert conll.sents[1][0][8] == '_'
+
+
+def test_write_conll_with_edges_matches_set(tmp_path):
+    formatter = DepsFormatter(LABELS)
+    # 边表中的句子序号为batch内的序号
+    batches = [([0], _edges([[0, 3, 0, 2], [0, 1, 3, 0], [0, 1, 2, 3]])),
+               ([1], _edges([[0, 2, 0, 2], [0, 1, 2, 1]]))]
+    streamed = tmp_path / 'streamed.conllu'
+    CoNLLFile(input_str=INPUT).write_conll_with_edges(iter(batches), str(streamed), formatter)
+
+    conll = CoNLLFile(input_str=INPUT)
+    edges = np.concatenate([np.column_stack([np.asarray(sent_ids)[e[:, 0]], e[:, 1:]]) for sent_ids, e in batches])
+    conll.set_deps_from_edges([0, 1], edges, formatter)
+    in_memory = tmp_path / 'in_memory.conllu'
+    conll.write_conll(str(in_memory))
+    assert streamed.read_text(encoding='utf-8') == in_memory.read_text(encoding='utf-8')
+
+
+def test_sents_cached_until_modified():
+    conll = CoNLLFile(input_str=INPUT)
+    sents = conll.sents
+    assert conll.sents is sents
+    conll.set(['lemma'], ['妈', '把', '撕', '长', '句', '跳'])
+    assert conll.sents is not sents
+    assert [ln[2] for ln in conll.sents[1]] == ['_', '长', '句']
+    sents = conll.sents
+    conll.set_deps_from_edges([0], _edges([[0, 1, 0, 2]]), DepsFormatter(LABELS))
+    assert conll.sents is not sents
+    assert conll.sents[0][0][8] == '0:Root'
+
+
+def test_set_rejects_length_mismatch():
+    conll = CoNLLFile(input_str=INPUT)
+    with pytest.raises(ValueError):
+        conll.set(['lemma'], ['妈', '把'])
+    # 不会部分写入
+    assert conll.get(['lemma']) == ['_'] * 6
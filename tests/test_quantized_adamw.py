@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+    adamw-8bit（QuantizedAdamW）与adamw-bertology在parser上的对比：
+    用一个很小的随机初始化BERT训练若干epoch，比较两者的训练loss曲线和dev的UAS、LAS
+"""
+import os
+import sys
+
+import pytest
+import torch
+import yaml
+from pytorch_transformers import BertConfig, BertModel
+import pytorch_transformers.optimization as huggingfaceOptim
+
+import main
+import models.biaffine_trainer as biaffine_trainer
+from utils.arguments import parse_args
+from utils.model_utils.quantized_adamw import QuantizedAdamW
+from utils.seed import set_seed
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONLLU = os.path.join(ROOT_DIR, 'dataset', 'dev', 'sdp_text_dev.conllu')
+TRAIN_SENTS, DEV_SENTS = 200, 60
+
+
+class _ScalarRecorder(object):
+    """
+        代替SummaryWriter，记录训练中的loss和dev结果
+    """
+    records = None
+
+    def __init__(self, log_dir=None):
+        _ScalarRecorder.records = {}
+
+    def add_scalar(self, tag, value, step):
+        self.records.setdefault(tag, []).append(float(value))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope='module')
+def tiny_setup(tmp_path_factory):
+    """
+        训练集和dev集（取自dataset中的dev语料），以及一个很小的随机初始化BERT（词表为语料中的字）
+    """
+    root = tmp_path_factory.mktemp('tiny_parser')
+    with open(CONLLU, encoding='utf-8') as f:
+        sents = f.read().strip().split('\n\n')
+    (root / 'train').mkdir()
+    (root / 'dev').mkdir()
+    (root / 'train' / 'train.conllu').write_text('\n\n'.join(sents[:TRAIN_SENTS]) + '\n\n', encoding='utf-8')
+    (root / 'dev' / 'dev.conllu').write_text(
+        '\n\n'.join(sents[TRAIN_SENTS:TRAIN_SENTS + DEV_SENTS]) + '\n\n', encoding='utf-8')
+    chars = sorted({c for sent in sents[:TRAIN_SENTS + DEV_SENTS] for line in sent.split('\n')
+                    for c in line.split('\t')[1]})
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '[unused1]'] + chars
+    bert_dir = root / 'bert'
+    bert_dir.mkdir()
+    (bert_dir / 'vocab.txt').write_text('\n'.join(vocab) + '\n', encoding='utf-8')
+    torch.manual_seed(0)
+    config = BertConfig(len(vocab), hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                        intermediate_size=64, max_position_embeddings=128)
+    BertModel(config).save_pretrained(str(bert_dir))
+    return root
+
+
+def _train(root, optimizer, monkeypatch):
+    with open(os.path.join(ROOT_DIR, 'config_files', 'bert_biaffine.yaml'), encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    overrides = {
+        'cuda': False, 'cpu': True, 'max_train_epochs': 8, 'learning_rate': 1.0e-3, 'optimizer': optimizer,
+        'quantization_block_size': 256, 'data_dir': str(root), 'train_file': 'train/train.conllu',
+        'dev_file': 'dev/dev.conllu', 'per_gpu_train_batch_size': 16, 'per_gpu_eval_batch_size': 32,
+        'output_dir': str(root / f'output_{optimizer}'), 'saved_model_path': str(root / 'bert'),
+        'encoder_output_dim': 32, 'biaffine_hidden_dim': 32, 'use_feature_cache': False,
+        'graph_vocab_file': os.path.join(ROOT_DIR, 'dataset', 'graph_vocab.txt'),
+    }
+    for section in config.values():
+        for k in section or {}:
+            if k in overrides:
+                section[k] = overrides[k]
+    (root / f'output_{optimizer}').mkdir()
+    config_file = root / f'{optimizer}.yaml'
+    config_file.write_text(yaml.safe_dump(config, allow_unicode=True), encoding='utf-8')
+    monkeypatch.setattr(sys, 'argv', ['main.py', '-c', str(config_file)])
+    monkeypatch.setattr(biaffine_trainer, 'SummaryWriter', _ScalarRecorder)
+    args = parse_args()
+    main.config_for_multi_gpu(args)
+    set_seed(args)
+    main.train(args)
+    return _ScalarRecorder.records
+
+
+def test_8bit_matches_adamw_on_parser(tiny_setup, monkeypatch):
+    adamw = _train(tiny_setup, 'adamw-bertology', monkeypatch)
+    quantized = _train(tiny_setup, 'adamw-8bit', monkeypatch)
+    # 训练loss：两者都在下降，并且训练过程中每次记录的loss和每个epoch的平均loss差距都不超过5%
+    for records in (adamw, quantized):
+        assert records['epoch_loss'][-1] < 0.5 * records['epoch_loss'][0]
+    for tag in ('loss/train', 'epoch_loss'):
+        assert len(adamw[tag]) == len(quantized[tag])
+        for loss, quantized_loss in zip(adamw[tag], quantized[tag]):
+            assert abs(quantized_loss - loss) <= 0.05 * loss
+    # 最优的dev结果
+    for metric in ('metrics/uas', 'metrics/las'):
+        assert abs(max(quantized[metric]) - max(adamw[metric])) <= 0.03
+
+
+def _sparse_spike(optimizer_class):
+    # 一个块内有一个很大的梯度，其余梯度很小（二阶动量低于码字的下限），之后梯度为0
+    p = torch.nn.Parameter(torch.zeros(8192))
+    optimizer = optimizer_class([p], lr=1e-3, eps=1e-8)
+    grad = torch.full((8192,), 1e-5)
+    grad[0] = 1.0
+    for g in [grad, torch.zeros(8192), torch.zeros(8192)]:
+        p.grad = g.clone()
+        optimizer.step()
+    return p.data[1:].abs().max().item()
+
+
+def test_sparse_spike_update_is_bounded():
+    # 二阶动量反量化之后不低于码字的下限，梯度很小的元素不会因为除以接近0的值而得到很大的更新
+    assert _sparse_spike(QuantizedAdamW) <= 1.5 * _sparse_spike(huggingfaceOptim.AdamW)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    sdp_decoder_torch / sdp_decoder_from_heads_torch（batch版本）与numpy版本的一致性，以及边表的转换
+"""
+import numpy as np
+import pytest
+import torch
+
+from utils.model_utils.parser_funs import (sdp_decoder, sdp_decoder_torch, sdp_decoder_from_heads,
+                                           sdp_decoder_from_heads_torch, semgraph_to_edges, parse_semgraph)
+
+
+def _decode_both(probs, rels, sentlens):
+    expected, expected_counts = sdp_decoder_from_heads(probs.copy(), rels, sentlens, return_counts=True)
+    result, counts = sdp_decoder_from_heads_torch(torch.from_numpy(probs), torch.from_numpy(rels), sentlens,
+                                                  return_counts=True)
+    assert np.array_equal(result.numpy(), expected)
+    assert {k: int(v) for k, v in counts.items()} == expected_counts
+    return result.numpy(), expected_counts
+
+
+def _edges_to_arcs(edges, sentlens):
+    # 与parse_semgraph的格式相同：每句话每个单词的依存弧 [[head, label_id], ...]
+    sents = [[[] for _ in range(length - 1)] for length in sentlens]
+    for sent_idx, dependent, head, label in edges.tolist():
+        sents[sent_idx][dependent - 1].append([head, label])
+    return sents
+
+
+def _random_batch(rng, case):
+    batch_size, max_len, label_num = rng.randint(1, 6), rng.randint(2, 20), rng.randint(1, 5)
+    sentlens = rng.randint(2, max_len + 1, size=batch_size).tolist()
+    # 以不同的比例稀疏化，控制弧的数量；部分概率取离散值，制造argmax时的相等
+    probs = np.clip(rng.rand(batch_size, max_len, max_len).astype(np.float32) * rng.choice([0.6, 1.0, 2.0]), 0, 1)
+    if case % 3 == 0:
+        probs = np.round(probs * 4) / 4
+    # 一半的batch不mask PAD的概率
+    if case % 2 == 0:
+        for i, length in enumerate(sentlens):
+            probs[i, length:, :] = 0
+            probs[i, :, length:] = 0
+    rels = rng.randint(0, label_num, size=probs.shape)
+    return probs, rels, sentlens, label_num
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_from_heads_matches_numpy(seed):
+    rng = np.random.RandomState(seed)
+    total_counts = {'no_root': 0, 'multi_root': 0, 'no_head': 0, 'self_circle': 0}
+    for case in range(100):
+        probs, rels, sentlens, _ = _random_batch(rng, case)
+        _, counts = _decode_both(probs, rels, sentlens)
+        for k, v in counts.items():
+            total_counts[k] += v
+    # 随机的batch覆盖了所有的修复情况
+    assert all(v > 0 for v in total_counts.values()), total_counts
+
+
+def test_counts_are_device_tensors():
+    # n_counts由张量的规约得到，留在解码所在的设备上，不逐句同步
+    probs = torch.rand(3, 6, 6)
+    _, counts = sdp_decoder_from_heads_torch(probs, None, [6, 4, 2], return_counts=True)
+    assert all(torch.is_tensor(v) and v.dim() == 0 and v.device == probs.device for v in counts.values())
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sdp_decoder_matches_numpy(seed):
+    rng = np.random.RandomState(seed)
+    for case in range(100):
+        probs, _, sentlens, label_num = _random_batch(rng, case)
+        # 完整的概率 (n x m x m x c)
+        graph_probs = rng.rand(*probs.shape, label_num).astype(np.float32) / label_num * 1.5
+        for i, length in enumerate(sentlens):
+            graph_probs[i, length:] = 0
+            graph_probs[i, :, length:] = 0
+        assert np.array_equal(sdp_decoder_torch(torch.from_numpy(graph_probs), sentlens).numpy(),
+                              sdp_decoder(graph_probs.copy(), sentlens))
+
+
+def test_no_root():
+    # 没有指向ROOT的弧：补上指向ROOT概率最大的单词
+    probs = np.zeros((1, 4, 4), dtype=np.float32)
+    probs[0, 1, 0], probs[0, 2, 0], probs[0, 3, 0] = 0.2, 0.4, 0.3
+    probs[0, 1, 2], probs[0, 3, 2] = 0.9, 0.9
+    result, counts = _decode_both(probs, np.zeros_like(probs, dtype=np.int64), [4])
+    assert result[0, :, 0].tolist() == [0, 0, 1, 0]
+    assert counts['no_root'] == 1 and counts['multi_root'] == 0
+
+
+def test_multi_root():
+    # 多个单词指向ROOT：只保留概率最大的
+    probs = np.zeros((1, 4, 4), dtype=np.float32)
+    probs[0, 1, 0], probs[0, 2, 0], probs[0, 3, 0] = 0.6, 0.8, 0.7
+    result, counts = _decode_both(probs, np.zeros_like(probs, dtype=np.int64), [4])
+    assert result[0, :, 0].tolist() == [0, 0, 1, 0]
+    # 失去root的单词各自补上一个head
+    assert result[0, 1:].astype(bool).sum(-1).tolist() == [1, 1, 1]
+    assert counts == {'no_root': 0, 'multi_root': 1, 'no_head': 2, 'self_circle': 0}
+
+
+def test_no_head():
+    # 没有head的单词选择概率最大的head，不包括ROOT、自身和超出句长的位置
+    probs = np.zeros((1, 5, 5), dtype=np.float32)
+    probs[0, 1, 0] = 0.9
+    probs[0, 2, 0], probs[0, 2, 2], probs[0, 2, 1], probs[0, 2, 3] = 0.45, 0.48, 0.3, 0.2
+    probs[0, 3, 1] = 0.9
+    probs[0, 2, 4] = 0.49  # 超出句长
+    result, counts = _decode_both(probs, np.zeros_like(probs, dtype=np.int64), [4])
+    assert result[0, 2].tolist() == [0, 1, 0, 0, 0]
+    assert counts['no_head'] == 1
+
+
+def test_self_loop():
+    # 自环被去掉，去掉之后没有head的单词重新选择head
+    probs = np.zeros((1, 4, 4), dtype=np.float32)
+    probs[0, 1, 0] = 0.9
+    probs[0, 2, 2], probs[0, 2, 1] = 0.95, 0.1
+    probs[0, 3, 3], probs[0, 3, 1] = 0.95, 0.7
+    result, counts = _decode_both(probs, np.zeros_like(probs, dtype=np.int64), [4])
+    assert np.diagonal(result[0]).sum() == 0
+    assert result[0, 2].tolist() == [0, 1, 0, 0]
+    assert result[0, 3].tolist() == [0, 1, 0, 0]
+    assert counts['self_circle'] == 2 and counts['no_head'] == 1
+
+
+def test_labels():
+    # 有依存弧的位置为标签+1
+    probs = np.zeros((1, 3, 3), dtype=np.float32)
+    probs[0, 1, 0], probs[0, 2, 1] = 0.9, 0.9
+    rels = np.full(probs.shape, 3, dtype=np.int64)
+    rels[0, 2, 1] = 0
+    result, _ = _decode_both(probs, rels, [3])
+    assert result[0].tolist() == [[0, 0, 0], [4, 0, 0], [0, 1, 0]]
+
+
+def test_semgraph_to_edges_round_trip():
+    rng = np.random.RandomState(0)
+    for case in range(200):
+        probs, rels, sentlens, _ = _random_batch(rng, case)
+        semgraph = sdp_decoder_from_heads_torch(torch.from_numpy(probs), torch.from_numpy(rels), sentlens)
+        edges = semgraph_to_edges(semgraph, sentlens)
+        assert _edges_to_arcs(edges.numpy(), sentlens) == parse_semgraph(semgraph.numpy(), sentlens)
+
+
+def test_semgraph_to_edges_skips_root_dependent_and_padding():
+    semgraph = torch.zeros(1, 4, 4, dtype=torch.long)
+    semgraph[0, 0, 1] = 1  # ROOT作为dependent
+    semgraph[0, 1, 0] = 3
+    semgraph[0, 2, 1] = 1
+    semgraph[0, 3, 2] = 2  # 超出句长
+    edges = semgraph_to_edges(semgraph, [3])
+    assert edges.tolist() == [[0, 1, 0, 2], [0, 2, 1, 0]]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    ShardedOptimizer（CPU + gloo，2个进程）：各进程的参数相同，与不切分的AdamW结果相同，
+    每个进程只保存自己负责的参数的optimizer状态
+"""
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from utils.model_utils.sharded_optimizer import ShardedOptimizer
+
+WORLD_SIZE = 2
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.ReLU(), torch.nn.Linear(32, 4))
+
+
+def _train(model, optimizer, steps=5):
+    torch.manual_seed(1)
+    for step in range(steps):
+        if step == 2:
+            # 第一层的参数在第3步时才加入optimizer（模拟训练中解冻）
+            optimizer.add_param_group({'params': [model[0].weight, model[0].bias], 'weight_decay': 0.01,
+                                       'lr': optimizer.param_groups[0]['lr']})
+        x = torch.randn(8, 16)
+        optimizer.zero_grad()
+        model(x).pow(2).sum().backward()
+        optimizer.step()
+        for group in optimizer.param_groups:
+            group['lr'] *= 0.5
+
+
+def _param_groups(model):
+    return [{'params': [model[2].weight], 'weight_decay': 0.01},
+            {'params': [model[2].bias], 'weight_decay': 0.0}]
+
+
+def _worker(rank, port, output_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=WORLD_SIZE)
+    try:
+        model = _make_model()
+        optimizer = ShardedOptimizer(_param_groups(model), torch.optim.AdamW, lr=1e-2)
+        _train(model, optimizer)
+        params = list(model.parameters())
+        index = {id(p): i for i, p in enumerate(params)}
+        torch.save({'params': [p.detach() for p in params],
+                    'owners': [optimizer._param_owners[id(p)] for p in params],
+                    'state_params': sorted(index[id(p)] for p in optimizer.optimizer.state),
+                    'local_state_numel': optimizer.local_state_numel()},
+                   os.path.join(output_dir, f'rank{rank}.pt'))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_sharded_optimizer_matches_adamw(tmp_path):
+    mp.spawn(_worker, args=(_free_port(), str(tmp_path)), nprocs=WORLD_SIZE)
+    results = [torch.load(str(tmp_path / f'rank{rank}.pt')) for rank in range(WORLD_SIZE)]
+
+    reference = _make_model()
+    _train(reference, torch.optim.AdamW(_param_groups(reference), lr=1e-2))
+    reference_params = [p.detach() for p in reference.parameters()]
+
+    for result in results:
+        # 各进程的参数完全相同（由负责的进程广播），并且与不切分的AdamW相同
+        assert all(torch.equal(p, q) for p, q in zip(result['params'], results[0]['params']))
+        assert all(torch.allclose(p, q, atol=1e-6) for p, q in zip(result['params'], reference_params))
+        # 所有进程的参数划分相同
+        assert result['owners'] == results[0]['owners']
+
+    owners = results[0]['owners']
+    # 每个参数都有负责的进程，新增的param group也分给了两个进程
+    assert set(owners) == set(range(WORLD_SIZE))
+    for rank, result in enumerate(results):
+        # 每个进程只保存自己负责的参数的状态（exp_avg和exp_avg_sq）
+        own = [i for i, owner in enumerate(owners) if owner == rank]
+        assert result['state_params'] == own
+        assert result['local_state_numel'] == 2 * sum(reference_params[i].numel() for i in own)
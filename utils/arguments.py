@@ -25,6 +25,9 @@ def parse_args():
     parser.add_argument('--input', default=None, help='输入的CONLL-U文件，用来dev或者inference')
     parser.add_argument('--output', default=None, help='dev或者inference的输出文件')
     parser.add_argument('--use_cuda', action='store_true', default=False, help='仅仅影响dev或者inference模式。train模式下用yaml控制')
+    # 多进程训练时由torch.distributed.launch传入（torchrun则通过环境变量LOCAL_RANK传入）
+    parser.add_argument('--local_rank', type=int, default=int(os.environ.get('LOCAL_RANK', -1)),
+                        help='多进程（DistributedDataParallel）训练时当前进程的序号，-1表示不使用')
     args = parser.parse_args()
     if args.run in ['dev', 'inference']:
         assert args.model_path and args.input and args.output
@@ -40,6 +43,9 @@ def parse_args():
                 args_dict[k] = v
     args_dict['config_file'] = args.config_file
     args_dict['run_mode'] = args.run
+    args_dict['local_rank'] = args.local_rank
+    if args.local_rank != -1:
+        assert args.run == 'train', '多进程只支持train模式'
     if args.run in ['dev', 'inference']:
         args_dict['cuda'] = args.use_cuda
         args_dict['cpu'] = not args.use_cuda
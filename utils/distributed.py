@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    多进程（DistributedDataParallel）训练的辅助函数
+
+    启动方式（每个进程一个GPU；没有GPU时使用gloo后端在CPU上运行）：
+        python -m torch.distributed.launch --nproc_per_node=4 main.py -c config_files/bert_biaffine.yaml
+    多机时额外指定 --nnodes、--node_rank、--master_addr、--master_port
+"""
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """
+        初始化进程组，设置args.distributed，args.rank，args.world_size，args.device
+        args.local_rank为-1时不使用多进程训练
+    """
+    if args.local_rank == -1:
+        args.distributed = False
+        args.rank = 0
+        args.world_size = 1
+        return
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    backend = getattr(args, 'distributed_backend', 'auto')
+    if backend == 'auto':
+        backend = 'nccl' if use_cuda else 'gloo'
+    if use_cuda:
+        torch.cuda.set_device(args.local_rank)
+        args.device = torch.device('cuda', args.local_rank)
+        args.n_gpu = 1
+    else:
+        args.device = torch.device('cpu')
+        args.n_gpu = 0
+    # torch.distributed.launch通过环境变量传入MASTER_ADDR、MASTER_PORT、RANK、WORLD_SIZE
+    dist.init_process_group(backend=backend, init_method='env://')
+    args.distributed = True
+    args.rank = dist.get_rank()
+    args.world_size = dist.get_world_size()
+    print(f'Distributed Running, backend: {backend}, rank: {args.rank}/{args.world_size}, '
+          f'local rank: {args.local_rank}, pid: {os.getpid()}')
+
+
+def is_main_process(args):
+    return not getattr(args, 'distributed', False) or args.rank == 0
+
+
+def barrier(args):
+    if getattr(args, 'distributed', False):
+        dist.barrier()
+
+
+def broadcast_values(args, *values):
+    """
+        把rank 0的若干个数值广播到所有进程，保证所有进程根据相同的dev结果做决定（保存模型、early stop）
+    :return: list of float
+    """
+    if not getattr(args, 'distributed', False):
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=args.device)
+    dist.broadcast(tensor, 0)
+    return tensor.tolist()
+
+
+def all_reduce_mean(args, *values):
+    """
+        对所有进程的数值求平均（例如训练loss）
+    :return: list of float
+    """
+    if not getattr(args, 'distributed', False):
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=args.device)
+    dist.all_reduce(tensor)
+    return (tensor / args.world_size).tolist()
+
+
+if __name__ == '__main__':
+    pass
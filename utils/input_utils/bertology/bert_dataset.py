@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import math
+from collections import OrderedDict
+
+import torch
+from torch.utils.data import Dataset, IterableDataset, DataLoader
+
+
+class BERTologyDataset(Dataset):
+    """
+        BERTology输入的数据集
+        字级别的输入（input_ids，input_mask，segment_ids）长度不一，所有句子拼接保存，input_offsets记录每句话的起止位置；
+        词级别的位置（start_pos，end_pos）按句子保存为定长（max_seq_len）的Tensor，PAD为max_seq_len-1；
+        依存弧不再保存为 max_seq_len x max_seq_len 的稠密矩阵，
+        而是把所有句子的 (dependent, head, label) 边表拼接保存在arcs中，arc_offsets记录每句话的边在arcs中的起止位置；
+        sent_ids记录每句话在原始CoNLL-U文件中的序号，batch不按原始顺序划分时用来恢复预测结果的顺序
+    """
+    COLUMNS = ['input_ids', 'input_mask', 'segment_ids', 'input_offsets', 'start_pos', 'end_pos', 'arcs', 'arc_offsets',
+               'sent_ids']
+
+    def __init__(self, input_ids, input_mask, segment_ids, input_offsets, start_pos, end_pos, arcs, arc_offsets,
+                 sent_ids, pad_token=0, pad_token_segment_id=0):
+        assert input_ids.size(0) == input_mask.size(0) == segment_ids.size(0)
+        assert start_pos.size(0) == end_pos.size(0) == input_offsets.size(0) - 1 == arc_offsets.size(0) - 1
+        assert sent_ids.size(0) == start_pos.size(0)
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+        self.input_offsets = input_offsets
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        # arcs: (E x 3) [dependent, head, label]
+        self.arcs = arcs
+        self.arc_offsets = arc_offsets
+        self.sent_ids = sent_ids
+        self.pad_token = pad_token
+        self.pad_token_segment_id = pad_token_segment_id
+
+    def __len__(self):
+        return self.start_pos.size(0)
+
+    def __getitem__(self, index):
+        input_start, input_end = int(self.input_offsets[index]), int(self.input_offsets[index + 1])
+        arc_start, arc_end = int(self.arc_offsets[index]), int(self.arc_offsets[index + 1])
+        return (self.input_ids[input_start:input_end],
+                self.input_mask[input_start:input_end],
+                self.segment_ids[input_start:input_end],
+                self.start_pos[index], self.end_pos[index],
+                self.arcs[arc_start:arc_end],
+                self.sent_ids[index])
+
+    @property
+    def input_lengths(self):
+        """每句话的字级别输入长度（包括CLS、SEP等）"""
+        return (self.input_offsets[1:] - self.input_offsets[:-1]).tolist()
+
+    @property
+    def word_lengths(self):
+        """每句话的单词数（包括ROOT），单词位置的PAD为max_seq_len-1"""
+        return torch.ne(self.start_pos, self.start_pos.size(1) - 1).sum(1).tolist()
+
+    @property
+    def columns(self):
+        return OrderedDict((name, getattr(self, name)) for name in self.COLUMNS)
+
+    @property
+    def pad_values(self):
+        return {'pad_token': self.pad_token, 'pad_token_segment_id': self.pad_token_segment_id}
+
+    @classmethod
+    def from_columns(cls, columns, pad_values):
+        return cls(**{name: columns[name] for name in cls.COLUMNS}, **pad_values)
+
+    def collate(self, items):
+        """
+            DataLoader的collate_fn
+            字级别的输入只pad到batch中最长的序列，而不是max_seq_len，BERT的计算量与实际长度成正比；
+            单词位置的PAD统一为batch中字序列的长度-1（该位置在最长的句子中是[SEP]，在其余句子中是PAD，
+            encoder会把PAD单词的向量置0，并据此得到单词级别的mask）；
+            每句话的边表拼接为 (E x 4) 的Tensor：[batch内的句子序号, dependent, head, label]；
+            最后一项是每句话在原始CoNLL-U文件中的序号
+        """
+        return collate_items(items, self.pad_token, self.pad_token_segment_id)
+
+
+def collate_items(items, pad_token=0, pad_token_segment_id=0):
+    """
+        把__getitem__得到的若干个句子拼成一个batch，见BERTologyDataset.collate
+    """
+    input_ids, input_mask, segment_ids, start_pos, end_pos, arcs, sent_ids = zip(*items)
+    seq_len = max(ids.size(0) for ids in input_ids)
+
+    def pad(sequences, value):
+        padded = sequences[0].new_full((len(sequences), seq_len), value)
+        for i, seq in enumerate(sequences):
+            padded[i, :seq.size(0)] = seq
+        return padded
+
+    # 截断的句子中超出范围的位置也一并视为PAD
+    start_pos = torch.stack(start_pos, 0).clamp(max=seq_len - 1)
+    end_pos = torch.stack(end_pos, 0).clamp(max=seq_len - 1)
+    arcs = [torch.cat([sent_arcs.new_full((sent_arcs.size(0), 1), sent_idx), sent_arcs], 1)
+            for sent_idx, sent_arcs in enumerate(arcs)]
+    return (pad(input_ids, pad_token), pad(input_mask, 0), pad(segment_ids, pad_token_segment_id),
+            start_pos, end_pos, torch.cat(arcs, 0).long(), torch.stack(sent_ids, 0))
+
+
+class BERTologyIterableDataset(IterableDataset):
+    """
+        流式的BERTology输入，用于无法全部载入内存的超大语料
+        每次从句子流中读取chunk_size句话，转换为一个小的BERTologyDataset，再逐句输出，
+        因此内存占用只与chunk_size和shuffle_buffer_size有关，与文件大小无关；
+        每个epoch都会重新读取文件、重新转换（input_mask在每个epoch重新随机生成）
+    """
+
+    def __init__(self, sents_fn, featurize_fn, num_sents_fn=None, chunk_size=1000, shuffle_buffer_size=0,
+                 pad_token=0, pad_token_segment_id=0):
+        """
+        :param sents_fn: 无参数的函数，每次调用返回一个新的句子生成器（每个epoch调用一次）
+        :param featurize_fn: featurize_fn(sents, start_sent_id)，把一个chunk的句子转换为BERTologyDataset
+        :param num_sents_fn: 无参数的函数，返回句子数（不包括featurize_fn跳过的句子），用于__len__
+        :param chunk_size: 每次转换的句子数
+        :param shuffle_buffer_size: 训练时随机打乱的缓冲区大小，0表示不打乱（评估时必须为0，保持原始顺序）
+        """
+        self.sents_fn = sents_fn
+        self.featurize_fn = featurize_fn
+        self.num_sents_fn = num_sents_fn
+        self.chunk_size = chunk_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.pad_token = pad_token
+        self.pad_token_segment_id = pad_token_segment_id
+        self._num_sents = None
+
+    def _iter_items(self):
+        chunk = []
+        start_sent_id = 0
+        for sent in self.sents_fn():
+            chunk.append(sent)
+            if len(chunk) == self.chunk_size:
+                dataset = self.featurize_fn(chunk, start_sent_id)
+                for i in range(len(dataset)):
+                    yield dataset[i]
+                start_sent_id += len(chunk)
+                chunk = []
+        if chunk:
+            dataset = self.featurize_fn(chunk, start_sent_id)
+            for i in range(len(dataset)):
+                yield dataset[i]
+
+    def __iter__(self):
+        if self.shuffle_buffer_size <= 0:
+            yield from self._iter_items()
+            return
+        buffer = []
+        for item in self._iter_items():
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+            idx = int(torch.randint(len(buffer), (1,)))
+            yield buffer[idx]
+            buffer[idx] = item
+        for idx in torch.randperm(len(buffer)).tolist():
+            yield buffer[idx]
+
+    def __len__(self):
+        if self._num_sents is None:
+            assert self.num_sents_fn is not None
+            self._num_sents = self.num_sents_fn()
+        return self._num_sents
+
+    def collate(self, items):
+        return collate_items(items, self.pad_token, self.pad_token_segment_id)
+
+
+class StreamingDataLoader(DataLoader):
+    """
+        torch 1.2的DataLoader不支持对IterableDataset求len，
+        这里按照dataset的句子数（不包括被跳过的过长句子）计算batch数（用于warmup、eval_interval等参数）
+    """
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+if __name__ == '__main__':
+    pass
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 # Created by li huayong on 2019/9/24
 import os
+import itertools
 import pathlib
+import multiprocessing
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
-from utils.input_utils.conll_file import load_conllu_file
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
+from utils.input_utils.conll_file import CoNLLFile, load_conllu_file
 from utils.input_utils.graph_vocab import GraphVocab
+from utils.input_utils.bucket_sampler import BucketBatchSampler
+from utils.input_utils.bertology.bert_dataset import BERTologyDataset, BERTologyIterableDataset, StreamingDataLoader
+from utils.input_utils.bertology.feature_cache import FeatureCache, make_cache_key
+from utils.input_utils.bertology.wordpiece_cache import WordPieceCache
+from utils.distributed import is_main_process
 from pytorch_transformers import BertTokenizer, RobertaTokenizer, XLMTokenizer, XLNetTokenizer
 
 BERTology_TOKENIZER = {
@@ -17,14 +25,24 @@ BERTology_TOKENIZER = {
     'roberta': RobertaTokenizer,
 }
 
+# 训练集只用来构造输入特征，只需要载入这些字段；dev、inference的文件要写出预测结果，需要载入全部字段
+TRAIN_CONLLU_FIELDS = ['word', 'upos', 'deps']
+
+# 多进程预处理时每个chunk的句子数，固定大小保证切分方式（以及input_mask的随机种子）与进程数量无关
+PREPROCESS_CHUNK_SIZE = 1000
+
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
 
-    def __init__(self, guid, sentence, start_pos, end_pos, deps=None):
+    def __init__(self, guid, sentence, start_pos, end_pos, deps=None, sent_id=None, piece_ids=None):
         """Constructs a InputExample.
         """
         self.guid = guid
+        # piece_ids: 句子（包括ROOT的表示）逐词切分得到的word piece id，不包括CLS、SEP
+        self.piece_ids = piece_ids
+        # sent_id: 在原始CoNLL-U文件中的句子序号
+        self.sent_id = sent_id
         self.sentence = sentence
         self.start_pos = start_pos
         self.end_pos = end_pos
@@ -34,13 +52,16 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, dep_ids, start_pos=None, end_pos=None):
+    def __init__(self, input_ids, input_mask, segment_ids, arcs, start_pos=None, end_pos=None, sent_id=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
-        self.dep_ids = dep_ids
+        # arcs: 依存弧的边表，每个元素为[dependent, head, label]
+        self.arcs = arcs
         self.start_pos = start_pos
         self.end_pos = end_pos
+        # sent_id: 在原始CoNLL-U文件中的句子序号
+        self.sent_id = sent_id
 
 
 class CoNLLUProcessor(object):
@@ -48,13 +69,14 @@ class CoNLLUProcessor(object):
         依存分析BERT数据处理，输入文件必须是CoNLL-U格式
     """
 
-    def __init__(self, args, graph_vocab, word_vocab=None):
+    def __init__(self, args, graph_vocab, wordpiece_cache):
         assert isinstance(graph_vocab, GraphVocab)
+        assert isinstance(wordpiece_cache, WordPieceCache)
         self.graph_vocab = graph_vocab
         self.args = args
         assert args.encoder_type == 'bertology', "暂时不支持xlent等类似BERT的模型，输入端需要适配（ROOT,start_pos,end_pos等等）"
         # TODO：支持xlnet,roberta,xlm等模型
-        self.word_vocab = word_vocab
+        self.wordpiece_cache = wordpiece_cache
 
     # def get_train_examples(self, data_dir, file_name, max_seq_length):
     #     """Gets a collection of `InputExample`s for the train set."""
@@ -63,7 +85,7 @@ class CoNLLUProcessor(object):
 
     def get_examples(self, file_path, max_seq_length, training=False):
         """Gets a collection of `InputExample`s for the dev set."""
-        CoNLLU_file, CoNLLU_data = load_conllu_file(file_path)
+        CoNLLU_file, CoNLLU_data = load_conllu_file(file_path, fields=_conllu_fields(training))
         return self._create_bert_example(CoNLLU_data,
                                          'train' if training else 'dev',
                                          max_seq_length,
@@ -71,8 +93,13 @@ class CoNLLUProcessor(object):
                                          ), CoNLLU_file
 
     def _get_words_start_end_pos(self, words_list, max_seq_length):
+        """
+            逐词切分，同时得到每个单词的span和整句的word piece id
+        :return: (start_pos, end_pos, piece_ids)
+        """
         s = []
         e = []
+        piece_ids = []
         # 0 for ROOT if root_representation == [CLS]
         if self.args.root_representation == 'cls':
             s.append(0)
@@ -84,32 +111,30 @@ class CoNLLUProcessor(object):
         if self.args.root_representation != 'cls':
             # 如果ROOT的表示不是CLS，那么words_list第一个元素就是ROOT，应当跳过（因为前面已经用0或者1表示了）
             clear_words_list = words_list[1:]
+            piece_ids += self.wordpiece_cache(words_list[0])
         else:
             clear_words_list = words_list
         #  BERT For single sequences:
         #  tokens:   [CLS] the dog is hairy . [SEP]
         #  type_ids:   0   0   0   0  0     0   0
-        # 如果ROOT是用[CLS]表示，则从1开始计算；否则，则从2开始计算
+        # 如果ROOT是用[CLS]表示，则从1开始计算；否则，则从ROOT之后（一般为2）开始计算
         # 0永远是CLS
-        if self.args.root_representation == 'cls':
-            sum_len = 1
-        else:
-            sum_len = 2
+        sum_len = 1 + len(piece_ids)
         for w in clear_words_list:
             s.append(sum_len) if sum_len < max_seq_length else s.append(max_seq_length - 1)
-            if w.lower() not in self.word_vocab:  # 如果单词不在词表中，说明会被分割，要分开计算
-                sum_len += len(w)
-            else:
-                # 如果单词在词表中，可以视长度为1
-                # 注意[MASK],[unused1]等特殊字符都在BERT的vocab中
-                sum_len += 1
+            # 单词的长度就是切分得到的word piece数量
+            # 注意[MASK],[unused1]等特殊字符不会被切分
+            w_piece_ids = self.wordpiece_cache(w)
+            piece_ids += w_piece_ids
+            sum_len += len(w_piece_ids)
             e.append(sum_len - 1) if sum_len - 1 < max_seq_length else e.append(max_seq_length - 1)
-        return s, e
+        return s, e, piece_ids
 
-    def _create_bert_example(self, CoNLLU_data, set_type, max_seq_length, training=False):
+    def _create_bert_example(self, CoNLLU_data, set_type, max_seq_length, training=False, start_sent_id=0):
         examples = []
         # print(CoNLLU_data)
-        for i, sent in enumerate(CoNLLU_data):
+        # start_sent_id: 流式处理时CoNLLU_data只是文件的一部分，句子序号从start_sent_id开始
+        for i, sent in enumerate(CoNLLU_data, start=start_sent_id):
             guid = f"{set_type}-{i}"
             words = []
             deps = []
@@ -154,6 +179,9 @@ class CoNLLUProcessor(object):
                     chars = ['[MASK]' if (z[1] and '\u4e00' <= z[0] <= '\u9fa5') else z[0] for z in
                              zip(sentence, input_mask)]
                     sentence = ''.join(chars)
+                    # 按单词边界切回单词序列，逐词切分
+                    word_ends = np.cumsum([len(w) for w in words])
+                    words = [''.join(chars[end - len(w):end]) for w, end in zip(words, word_ends)]
                 else:
                     # 单词粒度的mask
                     # 注意单词粒度的mask破坏了句子的长度！
@@ -162,25 +190,27 @@ class CoNLLUProcessor(object):
                     words = ['[MASK]' if z[1] else z[0] for z in zip(words, input_mask)]
                     sentence = "".join(words)
 
-            start_pos, end_pos = self._get_words_start_end_pos(words, max_seq_length)
+            start_pos, end_pos, piece_ids = self._get_words_start_end_pos(words, max_seq_length)
 
             examples.append(
-                InputExample(guid=guid, sentence=sentence, start_pos=start_pos, end_pos=end_pos, deps=deps)
+                InputExample(guid=guid, sentence=sentence, start_pos=start_pos, end_pos=end_pos, deps=deps, sent_id=i,
+                             piece_ids=piece_ids)
             )
         return examples
 
 
-def _make_label_target(arcs, max_seq_length):
-    if arcs:
-        graphs = [[0] * max_seq_length for _ in range(max_seq_length)]
-        for word_idx, word in enumerate(arcs, start=1):
-            for arc in word:
-                head_idx = arc[0]
-                rel_idx = arc[1]
-                graphs[word_idx][head_idx] = rel_idx
-    else:
-        graphs = [[-1] * max_seq_length for _ in range(max_seq_length)]
-    return graphs
+def _make_arc_list(deps):
+    """
+        把每个单词的依存弧转换为 (dependent, head, label) 的边表
+        dependent从1开始计数（0为ROOT）；没有依存弧标注（inference）时返回空表
+        稠密的 seq_len x seq_len 目标矩阵在训练时按batch构造（见make_graph_target）
+    """
+    arcs = []
+    if deps:
+        for word_idx, word in enumerate(deps, start=1):
+            for head_idx, rel_idx in word:
+                arcs.append([word_idx, head_idx, rel_idx])
+    return arcs
 
 
 def convert_examples_to_features(examples, label_list, max_seq_length,
@@ -191,8 +221,6 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
                                  sep_token='[SEP]',
                                  sep_token_extra=False,
                                  pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
                                  sequence_a_segment_id=0,
                                  # sequence_b_segment_id=1,
                                  mask_padding_with_zero=True,
@@ -207,26 +235,25 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
     assert not pad_on_left, "PAD必须在句子右侧，目前不支持xlnet"
     features = []
     skip_input_num = 0
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
     for (ex_index, example) in enumerate(examples):
         assert isinstance(example, InputExample)
         # if ex_index % 10000 == 0:
         #     logger.info("Writing example %d of %d" % (ex_index, len(examples)))
         # print(example.sentence)
-        tokens_a = tokenizer.tokenize(example.sentence)
+        # 句子已经在CoNLLUProcessor中逐词切分（见WordPieceCache），这里不再对整句调用tokenize
+        tokens_a = list(example.piece_ids)
         # print('tokens:')
         # print(tokens_a)
 
-        # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-        special_tokens_count = 3 if sep_token_extra else 2
-        # 为ROOT表示等预留足够的空间(目前至少预留5个位置)
-        special_tokens_count += 3
-        if len(tokens_a) > max_seq_length - special_tokens_count:
+        max_piece_num = _max_piece_num(max_seq_length, sep_token_extra)
+        if len(tokens_a) > max_piece_num:
             if skip_too_long_input:
                 # 这里直接跳过过长的句子
                 skip_input_num += 1
                 continue
             else:
-                tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
+                tokens_a = tokens_a[:max_piece_num]
 
         # The convention in BERT is:
         # (a) For sequence pairs:
@@ -246,21 +273,19 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
         # For classification tasks, the first vector (corresponding to [CLS]) is
         # used as as the "sentence vector". Note that this only makes sense because
         # the entire model is fine-tuned.
-        tokens = tokens_a + [sep_token]
+        input_ids = tokens_a + [sep_token_id]
         if sep_token_extra:
             # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
+            input_ids += [sep_token_id]
+        segment_ids = [sequence_a_segment_id] * len(input_ids)
 
         if cls_token_at_end:
-            tokens = tokens + [cls_token]
+            input_ids = input_ids + [cls_token_id]
             segment_ids = segment_ids + [cls_token_segment_id]
         else:
-            tokens = [cls_token] + tokens
+            input_ids = [cls_token_id] + input_ids
             segment_ids = [cls_token_segment_id] + segment_ids
 
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
         # The mask has 1 for real tokens and 0 for padding tokens. Only real
         # tokens are attended to.
         input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
@@ -272,37 +297,26 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
         if start_pos:
             assert len(start_pos) == len(end_pos)
 
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
+        # 字级别的输入（input_ids，input_mask，segment_ids）不在这里pad，
+        # 而是在collate时pad到batch中最长的序列（见BERTologyDataset.collate）
+        # 这里只对单词的位置做pad：
         pos_padding_length = max_seq_length - len(start_pos)
+        # 由于batched_index_select的限制，position idx的pad不能为-1
+        # 如果为0的话，又容易和CLS重复，
+        # 所以这里选择用max_seq_length-1表示PAD，collate时会被替换为batch中字序列的长度-1
+        # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
         if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-            # 由于batched_index_select的限制，position idx的pad不能为-1
-            # 如果为0的话，又容易和CLS重复，
-            # 所以这里选择用max_seq_length-1表示PAD
-            # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
             start_pos = ([max_seq_length - 1] * pos_padding_length) + start_pos
             end_pos = ([max_seq_length - 1] * pos_padding_length) + end_pos
             assert start_pos[0] == max_seq_length - 1
             assert end_pos[0] == max_seq_length - 1
         else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-            # 由于batched_index_select的限制，position idx的pad不能为-1
-            # 如果为0的话，又容易和CLS重复，
-            # 所以这里选择用max_seq_length-1表示PAD
-            # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
             start_pos = start_pos + ([max_seq_length - 1] * pos_padding_length)
             end_pos = end_pos + ([max_seq_length - 1] * pos_padding_length)
             assert start_pos[-1] == max_seq_length - 1
             assert end_pos[-1] == max_seq_length - 1
         # print(end_pos)
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+        assert len(input_ids) == len(input_mask) == len(segment_ids) <= max_seq_length
         assert len(start_pos) == len(end_pos) == max_seq_length
 
         # if ex_index < 5:
@@ -315,27 +329,68 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
         #     logger.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
         #     logger.info("label: %s (id = %d)" % (example.label, label_id))
 
-        dep_ids = _make_label_target(example.deps, max_seq_length)
+        arcs = _make_arc_list(example.deps)
 
         features.append(
             InputFeatures(input_ids=input_ids,
                           input_mask=input_mask,
                           segment_ids=segment_ids,
-                          dep_ids=dep_ids,
+                          arcs=arcs,
                           start_pos=start_pos,
-                          end_pos=end_pos))
+                          end_pos=end_pos,
+                          sent_id=example.sent_id))
     if skip_input_num > 0:
         print(f'\n>> convert_examples_to_features skip input:{skip_input_num} !!')
     return features
 
 
+def _max_piece_num(max_seq_length, sep_token_extra=False):
+    """
+        一句话最多的word piece数，超过的句子被跳过（skip_too_long_input）或者截断
+    """
+    # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+    special_tokens_count = 3 if sep_token_extra else 2
+    # 为ROOT表示等预留足够的空间(目前至少预留5个位置)
+    special_tokens_count += 3
+    return max_seq_length - special_tokens_count
+
+
+def _wordpiece_cache(args, tokenizer):
+    return WordPieceCache(tokenizer, getattr(args, 'wordpiece_cache_size', 100000))
+
+
 def load_and_cache_examples(args, conllu_file_path, graph_vocab, tokenizer, training=False):
-    word_vocab = tokenizer.vocab if args.encoder_type == 'bertology' else None
-    processor = CoNLLUProcessor(args, graph_vocab, word_vocab)
+    # input_mask在每次运行时随机生成，此时不能使用缓存
+    use_cache = getattr(args, 'use_feature_cache', False) and not (training and args.input_mask)
+    if use_cache:
+        feature_cache = FeatureCache(getattr(args, 'feature_cache_dir', 'dataset/feature_cache'))
+        cache_key = make_cache_key(args, conllu_file_path, graph_vocab, tokenizer,
+                                   conllu_fields=_conllu_fields(training))
+        cached = feature_cache.load(cache_key)
+        if cached is not None:
+            print(f'load features of {conllu_file_path} from cache: {cache_key}')
+            return cached
+    CoNLLU_file, CoNLLU_data = load_conllu_file(conllu_file_path, fields=_conllu_fields(training))
+    features = _chunked_convert_to_features(args, CoNLLU_data, graph_vocab, tokenizer, training=training)
+    data_set = feature_to_dataset(features, **_pad_values(args, tokenizer))
+    if use_cache:
+        feature_cache.save(cache_key, data_set, CoNLLU_file)
+
+    return data_set, CoNLLU_file
+
 
+def _conllu_fields(training):
+    return TRAIN_CONLLU_FIELDS if training else None
+
+
+def _pad_values(args, tokenizer):
+    return {'pad_token': tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            'pad_token_segment_id': 4 if args.encoder_type in ['xlnet'] else 0}
+
+
+def _examples_to_features(args, examples, graph_vocab, tokenizer):
     label_list = graph_vocab.get_labels()
-    examples, CoNLLU_file = processor.get_examples(conllu_file_path, args.max_seq_len, training=training)
-    features = convert_examples_to_features(examples, label_list, args.max_seq_len, tokenizer,
+    return convert_examples_to_features(examples, label_list, args.max_seq_len, tokenizer,
                                             cls_token_at_end=bool(args.encoder_type in ['xlnet']),
                                             # xlnet has a cls token at the end
                                             cls_token=tokenizer.cls_token,
@@ -346,35 +401,163 @@ def load_and_cache_examples(args, conllu_file_path, graph_vocab, tokenizer, trai
                                             # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
                                             pad_on_left=bool(args.encoder_type in ['xlnet']),
                                             # pad on the left for xlnet
-                                            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-                                            pad_token_segment_id=4 if args.encoder_type in ['xlnet'] else 0,
                                             skip_too_long_input=args.skip_too_long_input,
                                             )
+
+
+def _examples_to_dataset(args, examples, graph_vocab, tokenizer):
+    features = _examples_to_features(args, examples, graph_vocab, tokenizer)
     # Convert to Tensors and build dataset
-    data_set = feature_to_dataset(features)
+    return feature_to_dataset(features, **_pad_values(args, tokenizer))
 
-    return data_set, CoNLLU_file
+
+# 预处理时每个（子）进程持有的 (args, graph_vocab, tokenizer, training, processor)，由_init_preprocess_worker设置
+_worker_state = None
+
+
+def _init_preprocess_worker(args, graph_vocab, tokenizer, training):
+    global _worker_state
+    # 每个子进程一个WordPieceCache，在该进程处理的所有chunk之间共享
+    processor = CoNLLUProcessor(args, graph_vocab, _wordpiece_cache(args, tokenizer))
+    _worker_state = (args, graph_vocab, tokenizer, training, processor)
+
+
+def _convert_chunk(chunk):
+    chunk_idx, start_sent_id, CoNLLU_data = chunk
+    args, graph_vocab, tokenizer, training, processor = _worker_state
+    # input_mask的随机数按chunk设置种子，结果与进程数量和调度顺序无关
+    np.random.seed(args.seed + chunk_idx)
+    examples = processor._create_bert_example(CoNLLU_data, 'train' if training else 'dev', args.max_seq_len,
+                                              training=training, start_sent_id=start_sent_id)
+    return _examples_to_features(args, examples, graph_vocab, tokenizer)
+
+
+def _chunked_convert_to_features(args, CoNLLU_data, graph_vocab, tokenizer, training=False):
+    """
+        按固定大小（PREPROCESS_CHUNK_SIZE句）切分，每个chunk完成_create_bert_example和convert_examples_to_features，
+        结果按原始顺序合并；num_preprocess_workers>1时在子进程中转换，否则在主进程中逐个chunk转换，
+        两种情况下chunk的切分和input_mask的随机种子都相同，因此结果与进程数无关
+    """
+    chunks = [(chunk_idx, start, CoNLLU_data[start:start + PREPROCESS_CHUNK_SIZE])
+              for chunk_idx, start in enumerate(range(0, len(CoNLLU_data), PREPROCESS_CHUNK_SIZE))]
+    if getattr(args, 'num_preprocess_workers', 1) <= 1:
+        return _convert_chunks_in_process(args, chunks, graph_vocab, tokenizer, training)
+    features = []
+    with multiprocessing.Pool(getattr(args, 'num_preprocess_workers', 1), initializer=_init_preprocess_worker,
+                              initargs=(args, graph_vocab, tokenizer, training)) as pool:
+        # imap保证结果的顺序与chunks一致
+        for chunk_features in pool.imap(_convert_chunk, chunks):
+            features += chunk_features
+    return features
 
 
-def feature_to_dataset(features):
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
+def _convert_chunks_in_process(args, chunks, graph_vocab, tokenizer, training):
+    global _worker_state
+    # 按chunk设置的种子不影响主进程之后的随机状态（与多进程时一致）
+    rng_state = np.random.get_state()
+    _init_preprocess_worker(args, graph_vocab, tokenizer, training)
+    try:
+        features = []
+        for chunk in chunks:
+            features += _convert_chunk(chunk)
+    finally:
+        _worker_state = None
+        np.random.set_state(rng_state)
+    return features
+
+
+def load_streaming_examples(args, conllu_file_path, graph_vocab, tokenizer, training=False):
+    """
+        流式读取和转换输入，用于无法全部载入内存的超大语料
+        返回的CoNLLFile不会被载入内存，预测结果用CoNLLFile.write_conll_with_edges流式写出
+    :return: (BERTologyIterableDataset, CoNLLFile)
+    """
+    processor = CoNLLUProcessor(args, graph_vocab, _wordpiece_cache(args, tokenizer))
+    CoNLLU_file = CoNLLFile(conllu_file_path)
+
+    def featurize(sents, start_sent_id):
+        examples = processor._create_bert_example(sents, 'train' if training else 'dev', args.max_seq_len,
+                                                  training=training, start_sent_id=start_sent_id)
+        return _examples_to_dataset(args, examples, graph_vocab, tokenizer)
+
+    def count_kept_sents():
+        """
+            不会被skip_too_long_input跳过的句子数，使StreamingDataLoader的batch数（以及warmup、max_train_steps）
+            与实际训练的batch数一致；单词粒度的input_mask会改变句子的长度，此时只是近似值
+        """
+        if not args.skip_too_long_input:
+            return CoNLLU_file.count_sents()
+        max_piece_num = _max_piece_num(args.max_seq_len, sep_token_extra=args.encoder_type in ['roberta'])
+        kept_num = 0
+        sents = CoNLLU_file.iter_get(['word', 'upos', 'deps'])
+        while True:
+            chunk = list(itertools.islice(sents, getattr(args, 'streaming_chunk_size', 1000)))
+            if not chunk:
+                return kept_num
+            # 不做input_mask，只为了得到每句话的word piece数
+            examples = processor._create_bert_example(chunk, 'count', args.max_seq_len)
+            kept_num += sum(len(example.piece_ids) <= max_piece_num for example in examples)
+
+    # 评估时保持原始顺序
+    shuffle_buffer_size = getattr(args, 'shuffle_buffer_size', 10000) if training else 0
+    dataset = BERTologyIterableDataset(lambda: CoNLLU_file.iter_get(['word', 'upos', 'deps']), featurize,
+                                       num_sents_fn=count_kept_sents,
+                                       chunk_size=getattr(args, 'streaming_chunk_size', 1000),
+                                       shuffle_buffer_size=shuffle_buffer_size,
+                                       **_pad_values(args, tokenizer))
+    return dataset, CoNLLU_file
+
+
+def feature_to_dataset(features, pad_token=0, pad_token_segment_id=0):
+    # 字级别的输入长度不一，拼接保存，input_offsets记录每句话的起止位置
+    all_input_ids = torch.tensor([i for f in features for i in f.input_ids], dtype=torch.long)
+    all_input_mask = torch.tensor([m for f in features for m in f.input_mask], dtype=torch.long)
+    all_segment_ids = torch.tensor([i for f in features for i in f.segment_ids], dtype=torch.long)
+    all_input_offsets = torch.tensor([0] + [len(f.input_ids) for f in features], dtype=torch.long).cumsum(0)
     all_start_pos = torch.tensor([t.start_pos for t in features], dtype=torch.long)
     # print([t.end_pos for t in features])
     all_end_pos = torch.tensor([t.end_pos for t in features], dtype=torch.long)
-    all_dep_ids = torch.tensor([t.dep_ids for t in features], dtype=torch.long)
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_start_pos, all_end_pos, all_dep_ids)
+    all_arcs = torch.tensor([arc for t in features for arc in t.arcs], dtype=torch.long).view(-1, 3)
+    all_arc_offsets = torch.tensor([0] + [len(t.arcs) for t in features], dtype=torch.long).cumsum(0)
+    all_sent_ids = torch.tensor([t.sent_id for t in features], dtype=torch.long)
+    dataset = BERTologyDataset(all_input_ids, all_input_mask, all_segment_ids, all_input_offsets,
+                               all_start_pos, all_end_pos, all_arcs, all_arc_offsets, all_sent_ids,
+                               pad_token=pad_token, pad_token_segment_id=pad_token_segment_id)
     return dataset
 
 
-def get_data_loader(dataset, batch_size, evaluation=False):
+def get_data_loader(dataset, batch_size, evaluation=False, batch_budget=None, budget_type='sentences',
+                    num_buckets=10, num_replicas=1, rank=0, seed=0):
+    """
+    :param batch_size: budget_type为sentences时每个batch的句子数
+    :param batch_budget: budget_type为tokens或者word_pairs时每个batch的代价上限（见BucketBatchSampler）
+    :param budget_type: sentences：固定句子数；tokens：按字数预算；word_pairs：按单词对数量预算
+    :param num_replicas: 多进程训练的进程数，>1时每个进程只读取训练数据的1/num_replicas（评估时不切分）
+    :param rank: 当前进程的序号
+    :param seed: 多进程训练时划分数据的随机种子
+    """
+    if isinstance(dataset, BERTologyIterableDataset):
+        assert num_replicas == 1, '流式输入不支持多进程训练'
+        # 流式输入只支持固定句子数的batch，打乱由dataset内部的shuffle buffer完成
+        return StreamingDataLoader(dataset, batch_size=batch_size, collate_fn=dataset.collate)
+    assert isinstance(dataset, BERTologyDataset)
     if evaluation:
-        sampler = SequentialSampler(dataset)
-    else:
-        sampler = RandomSampler(dataset)
-    data_loader = DataLoader(dataset, sampler=sampler, batch_size=batch_size)
-    return data_loader
+        num_replicas, rank = 1, 0
+    if budget_type == 'sentences':
+        if evaluation:
+            sampler = SequentialSampler(dataset)
+        elif num_replicas > 1:
+            # 每个epoch需要调用set_epoch
+            sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank)
+        else:
+            sampler = RandomSampler(dataset)
+        return DataLoader(dataset, sampler=sampler, batch_size=batch_size, collate_fn=dataset.collate)
+    lengths = dataset.input_lengths if budget_type == 'tokens' else dataset.word_lengths
+    # 评估时的batch顺序是确定的，预测结果按照sent_ids恢复原始顺序
+    batch_sampler = BucketBatchSampler(lengths, batch_budget, budget_type=budget_type,
+                                       num_buckets=num_buckets, shuffle=not evaluation,
+                                       num_replicas=num_replicas, rank=rank, seed=seed)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate)
 
 
 def load_bert_tokenizer(model_path, model_type, do_lower_case=True):
@@ -388,19 +571,31 @@ def load_bertology_input(args):
     assert (pathlib.Path(args.saved_model_path) / 'vocab.txt').exists()
     tokenizer = load_bert_tokenizer(args.saved_model_path, args.bertology_type)
     vocab = GraphVocab(args.graph_vocab_file)
-    if args.run_mode == 'train':
+    if args.run_mode == 'train' and is_main_process(args):
         tokenizer.save_pretrained(args.output_model_dir)
+    load_examples = load_streaming_examples if getattr(args, 'streaming_input', False) else load_and_cache_examples
+    # 旧的配置文件中没有以下配置项时，使用固定句子数的batch
+    budget_type = getattr(args, 'batch_budget_type', 'sentences')
+    num_buckets = getattr(args, 'num_length_buckets', 10)
     if args.run_mode in ['dev', 'inference']:
-        dataset, conllu_file = load_and_cache_examples(args, args.input_conllu_path, vocab, tokenizer, training=False)
-        data_loader = get_data_loader(dataset, batch_size=args.eval_batch_size, evaluation=True)
+        dataset, conllu_file = load_examples(args, args.input_conllu_path, vocab, tokenizer, training=False)
+        data_loader = get_data_loader(dataset, batch_size=args.eval_batch_size, evaluation=True,
+                                      batch_budget=args.eval_batch_budget, budget_type=budget_type,
+                                      num_buckets=num_buckets)
         return data_loader, conllu_file
     elif args.run_mode == 'train':
-        train_dataset, train_conllu_file = load_and_cache_examples(args, os.path.join(args.data_dir, args.train_file),
-                                                                   vocab, tokenizer, training=True)
+        train_dataset, train_conllu_file = load_examples(args, os.path.join(args.data_dir, args.train_file),
+                                                         vocab, tokenizer, training=True)
+        # dev数据集一般较小，总是完整载入
         dev_dataset, dev_conllu_file = load_and_cache_examples(args, os.path.join(args.data_dir, args.dev_file),
                                                                vocab, tokenizer, training=False)
-        train_data_loader = get_data_loader(train_dataset, batch_size=args.train_batch_size, evaluation=False)
-        dev_data_loader = get_data_loader(dev_dataset, batch_size=args.eval_batch_size, evaluation=True)
+        train_data_loader = get_data_loader(train_dataset, batch_size=args.train_batch_size, evaluation=False,
+                                            batch_budget=args.train_batch_budget, budget_type=budget_type,
+                                            num_buckets=num_buckets,
+                                            num_replicas=args.world_size, rank=args.rank, seed=args.seed)
+        dev_data_loader = get_data_loader(dev_dataset, batch_size=args.eval_batch_size, evaluation=True,
+                                          batch_budget=args.eval_batch_budget, budget_type=budget_type,
+                                          num_buckets=num_buckets)
         return train_data_loader, train_conllu_file, dev_data_loader, dev_conllu_file
 
 
@@ -435,7 +630,5 @@ if __name__ == '__main__':
         # print(batch[1])
         # start pos:
         # print(batch[3])
-        # labeled target
+        # arcs: [batch内的句子序号, dependent, head, label]
         print(batch[-1])
-        # unlabeled target
-        # print(batch[-1].ge(1).to(batch[-1].dtype))
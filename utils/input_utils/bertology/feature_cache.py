@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+    load_and_cache_examples 的磁盘缓存
+
+    缓存以内容寻址：key由输入文件内容的hash、tokenizer词表以及影响特征的配置参数共同决定，
+    任何一项变化都会得到新的key，因此缓存不需要手动失效。
+    BERTologyDataset的每一列和CoNLLFile的列式数据都以.npy格式保存，
+    加载时使用memory map（copy-on-write），热启动几乎不需要时间，多个进程也可以共享同一份物理内存。
+"""
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import pathlib
+
+import numpy as np
+import torch
+
+from utils.input_utils.conll_file import CoNLLFile
+from utils.input_utils.bertology.bert_dataset import BERTologyDataset
+
+# 缓存格式发生变化时必须修改版本号，使旧的缓存失效
+CACHE_VERSION = 6
+
+
+def _file_sha1(file_path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def make_cache_key(args, conllu_file_path, graph_vocab, tokenizer, conllu_fields=None):
+    """
+        计算缓存的key
+    :param args: 配置参数，使用其中的encoder_type，max_seq_len，root_representation，skip_too_long_input
+    :param conllu_file_path: 输入的CoNLL-U文件
+    :param graph_vocab: 依存标签的vocab，标签id也是特征的一部分
+    :param tokenizer: BERTology tokenizer
+    :param conllu_fields: CoNLLFile载入的字段，None为全部字段
+    :return: 十六进制字符串
+    """
+    sha1 = hashlib.sha1()
+
+    def update(name, value):
+        sha1.update(f'{name}={value}\n'.encode('utf-8'))
+
+    update('version', CACHE_VERSION)
+    update('file', _file_sha1(conllu_file_path))
+    update('tokenizer', type(tokenizer).__name__)
+    update('do_lower_case', getattr(getattr(tokenizer, 'basic_tokenizer', None), 'do_lower_case', None))
+    update('special_tokens', '\t'.join(sorted(tokenizer.all_special_tokens)))
+    for token, idx in tokenizer.vocab.items():
+        update(token, idx)
+    update('labels', '\t'.join(graph_vocab.get_labels()))
+    update('conllu_fields', conllu_fields)
+    for name in ['encoder_type', 'max_seq_len', 'root_representation', 'skip_too_long_input']:
+        update(name, getattr(args, name))
+    return sha1.hexdigest()
+
+
+class FeatureCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = pathlib.Path(cache_dir)
+
+    def _entry_dir(self, key):
+        return self.cache_dir / key
+
+    def load(self, key):
+        """
+            读取缓存，如果缓存不存在则返回None
+        :return: (dataset, CoNLLU_file) 或者 None
+        """
+        entry_dir = self._entry_dir(key)
+        meta_file = entry_dir / 'meta.json'
+        if not meta_file.exists():
+            return None
+        with open(str(meta_file), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['version'] != CACHE_VERSION:
+            return None
+        # mmap_mode='c'：copy-on-write，未被修改的页在多个进程之间共享
+        columns = {name: torch.from_numpy(np.load(str(entry_dir / f'{name}.npy'), mmap_mode='c'))
+                   for name in meta['columns']}
+        dataset = BERTologyDataset.from_columns(columns, meta['pad_values'])
+        conllu_columns = {'fields': meta['conllu_fields'], 'vocabs': meta['conllu_vocabs']}
+        for name in meta['conllu_arrays']:
+            conllu_columns[name] = np.load(str(entry_dir / f'conllu_{name}.npy'), mmap_mode='c')
+        conllu_file = CoNLLFile(input_columns=conllu_columns)
+        return dataset, conllu_file
+
+    def save(self, key, dataset, conllu_file):
+        assert isinstance(dataset, BERTologyDataset)
+        entry_dir = self._entry_dir(key)
+        if entry_dir.exists():
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # 先写到临时文件夹，再原子地rename，避免多个进程同时写入时读到不完整的缓存
+        tmp_dir = self.cache_dir / f'.{key}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        tmp_dir.mkdir()
+        try:
+            for name, tensor in dataset.columns.items():
+                np.save(str(tmp_dir / f'{name}.npy'), tensor.numpy())
+            conllu_columns = conllu_file.to_columns()
+            conllu_arrays = [name for name, value in conllu_columns.items() if isinstance(value, np.ndarray)]
+            for name in conllu_arrays:
+                np.save(str(tmp_dir / f'conllu_{name}.npy'), conllu_columns[name])
+            with open(str(tmp_dir / 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump({'version': CACHE_VERSION,
+                           'columns': list(dataset.columns.keys()),
+                           'pad_values': dataset.pad_values,
+                           'conllu_fields': conllu_columns['fields'],
+                           'conllu_vocabs': conllu_columns['vocabs'],
+                           'conllu_arrays': conllu_arrays}, f, ensure_ascii=False)
+            os.rename(str(tmp_dir), str(entry_dir))
+        except OSError:
+            # 其他进程已经写好了同一个key的缓存
+            if not entry_dir.exists():
+                raise
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(str(tmp_dir), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+
+class WordPieceCache(object):
+    """
+        单词到word piece id的缓存（LRU）
+        句子逐词切分，每个单词只在第一次出现时调用tokenizer，
+        单词的span（start_pos，end_pos）和input_ids都由同一份切分结果得到，二者总是一致的；
+        缓存大小有上限，超过时淘汰最久未使用的单词，因此分词的开销与词表大小而不是语料大小成正比
+    """
+
+    def __init__(self, tokenizer, max_size=100000):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __call__(self, word):
+        """
+        :return: 单词的word piece id，tuple
+        """
+        piece_ids = self._cache.get(word)
+        if piece_ids is not None:
+            self._cache.move_to_end(word)
+            self.hits += 1
+            return piece_ids
+        self.misses += 1
+        piece_ids = tuple(self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(word)))
+        self._cache[word] = piece_ids
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return piece_ids
+
+    def __len__(self):
+        return len(self._cache)
+
+
+if __name__ == '__main__':
+    pass
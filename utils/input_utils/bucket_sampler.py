@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    按照累计句长划分batch
+
+    句子按长度排序后均分为若干个bucket，同一个bucket中的句子长度相近；
+    每个bucket根据其中最长句子的代价确定一个固定的batch size，使得每个batch的代价（PAD之后）不超过预算：
+        tokens：     batch size x 最大字数，对应BERT的计算量
+        word_pairs： batch size x 最大单词数^2，对应biaffine打分和loss的规模
+    bucket的划分和每个bucket的batch size在构造时确定，因此每个epoch的batch数量（__len__）是固定的，
+    warmup、eval_interval、early stop等按step计算的参数不受shuffle影响。
+    多进程训练时（num_replicas > 1），所有进程用相同的随机种子（seed + epoch）划分并打乱batch，
+    再各自取其中的1/num_replicas，batch数量不能整除时重复开头的batch，保证每个进程的batch数相同。
+"""
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+BUDGET_TYPES = ['tokens', 'word_pairs']
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, budget, budget_type='tokens', num_buckets=10, shuffle=True,
+                 num_replicas=1, rank=0, seed=0):
+        """
+        :param lengths: 每句话的长度，budget_type为tokens时是字数，为word_pairs时是单词数（包括ROOT）
+        :param budget: 每个batch的代价上限
+        :param budget_type: tokens 或者 word_pairs
+        :param num_buckets: bucket的数量
+        :param shuffle: 训练时为True，每个epoch在bucket内以及batch之间随机打乱；
+                        评估时为False，batch的顺序是确定的（从短到长）
+        :param num_replicas: 多进程训练的进程数
+        :param rank: 当前进程的序号
+        :param seed: 多进程训练时打乱batch的随机种子，每个epoch为seed + epoch（见set_epoch）
+        """
+        assert budget_type in BUDGET_TYPES, f'illegal batch budget type:{budget_type}'
+        assert budget > 0 and num_buckets > 0
+        assert 0 <= rank < num_replicas
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        lengths = np.asarray(lengths, dtype=np.int64)
+        cost = lengths if budget_type == 'tokens' else lengths * lengths
+        # 稳定排序，长度相同的句子保持原始顺序
+        sorted_idx = np.argsort(lengths, kind='stable')
+        self.buckets = [b for b in np.array_split(sorted_idx, min(num_buckets, max(1, len(lengths)))) if len(b) > 0]
+        # 超过预算的单个句子独占一个batch
+        self.bucket_batch_sizes = [max(1, int(budget // cost[b].max())) for b in self.buckets]
+
+    def _bucket_batches(self, bucket, batch_size):
+        return [bucket[i:i + batch_size].tolist() for i in range(0, len(bucket), batch_size)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = None
+        if self.num_replicas > 1:
+            # 所有进程的划分必须一致，不能使用全局的随机数生成器
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket, batch_size in zip(self.buckets, self.bucket_batch_sizes):
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket), generator=generator).numpy()]
+            batches += self._bucket_batches(bucket, batch_size)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            batches += batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+        return iter(batches)
+
+    def _num_batches(self):
+        return sum((len(b) + bs - 1) // bs for b, bs in zip(self.buckets, self.bucket_batch_sizes))
+
+    def __len__(self):
+        return (self._num_batches() + self.num_replicas - 1) // self.num_replicas
+
+
+if __name__ == '__main__':
+    sampler = BucketBatchSampler([5, 30, 12, 7, 50, 9, 33, 21], budget=60, num_buckets=3, shuffle=False)
+    print(len(sampler))
+    print(list(sampler))
+    for rank in range(2):
+        sampler = BucketBatchSampler([5, 30, 12, 7, 50, 9, 33, 21], budget=60, num_buckets=3, num_replicas=2,
+                                     rank=rank)
+        print(rank, len(sampler), list(sampler))
@@ -3,6 +3,10 @@ A wrapper/loader for the official conll-u format files.
 """
 import os
 import io
+import gzip
+import array
+
+import numpy as np
 
 FIELD_NUM = 10
 
@@ -10,66 +14,207 @@ FIELD_TO_IDX = {'id': 0, 'word': 1, 'lemma': 2, 'upos': 3, 'xpos': 4,
                 'feats': 5, 'head': 6, 'deprel': 7, 'deps': 8,
                 'misc': 9}
 
+FIELD_NAMES = sorted(FIELD_TO_IDX, key=FIELD_TO_IDX.get)
+
 
 class CoNLLFile(object):
+    """
+        CoNLL-U文件的列式存储：
+        每个字段（列）按字典编码为一个int32数组，_vocabs[field]保存编码到字符串的映射；
+        _sent_offsets记录每句话在行序列中的起止位置（长度为句子数+1）；
+        _is_word标记每一行是否为单词（即不是多词token的"1-2"行）。
+        get、set、num_words、write_conll直接在列上操作，不会为每一行构造字符串列表；
+        fields指定只载入部分字段，未载入的字段在写出时为'_'。
+    """
+
     def __init__(
             self,
             filename=None,
             input_str=None,
-            ignore_gapping=True
+            ignore_gapping=True,
+            fields=None,
+            input_columns=None
     ):
         # If ignore_gapping is True, all words that are gap fillers
         # (identified with a period in the sentence index) will be ignored.
         self.ignore_gapping = ignore_gapping
+        # fields: 需要载入的字段，None为全部字段
+        if fields is None:
+            fields = FIELD_NAMES
+        assert all(f in FIELD_TO_IDX for f in fields), f"Unknown fields: {fields}"
+        self._fields = [f for f in FIELD_NAMES if f in fields]
         if filename is not None and not os.path.exists(filename):
             raise Exception("File not found at: " + filename)
         if filename:
             assert filename.endswith('conllu'), "Loaded file must be conllu file."
         if filename is None:
-            assert input_str is not None and len(input_str) > 0
+            assert (input_str is not None and len(input_str) > 0) or input_columns is not None
             self._file = input_str
             self._from_str = True
         else:
             self._file = filename
             self._from_str = False
+        # sents的缓存，修改内容（set等）时清空
+        self._sents_cache = None
+        # input_columns: to_columns()得到的列式数据，用于从预处理缓存中恢复
+        if input_columns is not None:
+            self._set_columns(input_columns)
 
     def load_all(self):
         """ Trigger all lazy initializations so that the file is loaded."""
-        _ = self.sents
-        _ = self.num_words
+        self._load()
+
+    @property
+    def is_loaded(self):
+        return hasattr(self, '_columns')
+
+    def _load(self):
+        if self.is_loaded:
+            return
+        field_idxs = [FIELD_TO_IDX[f] for f in self._fields]
+        codes = {f: array.array('i') for f in self._fields}
+        vocab_index = {f: {} for f in self._fields}
+        is_word = array.array('b')
+        sent_offsets = array.array('q', [0])
+        for sent in self._read_sents():
+            for ln in sent:
+                is_word.append('-' not in ln[0])
+                for f, fid in zip(self._fields, field_idxs):
+                    index = vocab_index[f]
+                    code = index.get(ln[fid])
+                    if code is None:
+                        code = index[ln[fid]] = len(index)
+                    codes[f].append(code)
+            sent_offsets.append(len(is_word))
+        self._columns = {f: np.frombuffer(codes[f], dtype=np.int32).copy() for f in self._fields}
+        self._vocabs = {f: list(vocab_index[f]) for f in self._fields}
+        self._vocab_index = vocab_index
+        self._is_word = np.frombuffer(is_word, dtype=np.int8).astype(np.bool_)
+        self._sent_offsets = np.frombuffer(sent_offsets, dtype=np.int64).copy()
+
+    def _set_columns(self, columns):
+        self._fields = list(columns['fields'])
+        self._columns = {f: np.asarray(columns[f'codes_{f}']) for f in self._fields}
+        self._vocabs = {f: list(columns['vocabs'][f]) for f in self._fields}
+        self._is_word = np.asarray(columns['is_word'])
+        self._sent_offsets = np.asarray(columns['sent_offsets'])
+        self._sents_cache = None
+
+    def to_columns(self):
+        """
+            返回列式数据（numpy数组和字符串列表），便于缓存到磁盘（数组可以memory map）
+            CoNLLFile(input_columns=...)可以从中恢复
+        """
+        self._load()
+        columns = {'fields': list(self._fields),
+                   'vocabs': {f: list(self._vocabs[f]) for f in self._fields},
+                   'is_word': self._is_word,
+                   'sent_offsets': self._sent_offsets}
+        for f in self._fields:
+            columns[f'codes_{f}'] = self._columns[f]
+        return columns
+
+    def _encode(self, field, values):
+        """ 把字符串编码到field的字典中，返回编码数组"""
+        if not hasattr(self, '_vocab_index'):
+            self._vocab_index = {}
+        if field not in self._vocab_index:
+            self._vocab_index[field] = {u: i for i, u in enumerate(self._vocabs[field])}
+        index = self._vocab_index[field]
+        vocab = self._vocabs[field]
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, v in enumerate(values):
+            code = index.get(v)
+            if code is None:
+                code = index[v] = len(vocab)
+                vocab.append(v)
+            codes[i] = code
+        return codes
+
+    def _add_column(self, field):
+        """ 添加一个未载入的字段，所有行都为'_'"""
+        self._columns[field] = np.zeros(len(self._is_word), dtype=np.int32)
+        self._vocabs[field] = ['_']
+        self._fields = [f for f in FIELD_NAMES if f in self._columns]
+
+    def _decode(self, field, rows=None):
+        """ 返回field的字符串（numpy object数组），未载入的字段为'_'"""
+        n = len(self._is_word) if rows is None else len(rows)
+        if field not in self._columns:
+            return np.full(n, '_', dtype=object)
+        codes = self._columns[field] if rows is None else self._columns[field][rows]
+        return np.asarray(self._vocabs[field], dtype=object)[codes]
+
+    def _word_rows(self):
+        """ 所有单词行的行号，以及每句话的单词在其中的起止位置"""
+        word_rows = np.flatnonzero(self._is_word)
+        cum = np.concatenate([[0], np.cumsum(self._is_word, dtype=np.int64)])
+        return word_rows, cum[self._sent_offsets]
 
     def load_conll(self):
         """
         Load data into a list of sentences, where each sentence is a list of lines,
         and each line is a list of conllu fields.
+        注意：返回的是由列式数据新构造的列表，对它的修改不会写回
         """
-        sents, cache = [], []
+        self._load()
+        all_fields = [self._decode(f) for f in FIELD_NAMES]
+        lines = [list(ln) for ln in zip(*all_fields)]
+        return [lines[self._sent_offsets[i]:self._sent_offsets[i + 1]] for i in range(len(self._sent_offsets) - 1)]
+
+    def _read_sents(self):
+        """ Generator over the sentences of the input file (or string), one sentence at a time."""
+        cache = []
         if self._from_str:
             infile = io.StringIO(self.file)
         else:
             infile = open(self.file, encoding='utf-8')
-        while True:
-            line = infile.readline()
-            if len(line) == 0:
-                break
-            line = line.strip()
-            if len(line) == 0:
-                if len(cache) > 0:
-                    sents.append(cache)
-                    cache = []
-            else:
-                if line.startswith('#'):  # skip comment line
-                    continue
-                array = line.split('\t')
-                if self.ignore_gapping and '.' in array[0]:
-                    continue
-                assert len(array) == FIELD_NUM
-                cache += [array]
-        if len(cache) > 0:
-            sents.append(cache)
-        if not self._from_str:
-            infile.close()
-        return sents
+        try:
+            for line in infile:
+                line = line.strip()
+                if len(line) == 0:
+                    if len(cache) > 0:
+                        yield cache
+                        cache = []
+                else:
+                    if line.startswith('#'):  # skip comment line
+                        continue
+                    array = line.split('\t')
+                    if self.ignore_gapping and '.' in array[0]:
+                        continue
+                    assert len(array) == FIELD_NUM
+                    cache += [array]
+            if len(cache) > 0:
+                yield cache
+        finally:
+            if not self._from_str:
+                infile.close()
+
+    def iter_sents(self):
+        """
+            逐句读取，不把整个文件载入内存（用于超大语料的流式处理）
+            如果文件已经载入（或者来自缓存），则遍历由列式数据构造的句子
+        """
+        if self.is_loaded:
+            return iter(self.load_conll())
+        return self._read_sents()
+
+    def iter_get(self, fields):
+        """ Streaming version of get(fields, as_sentences=True): yield the fields of one sentence at a time."""
+        assert isinstance(fields, list), "Must provide field names as a list."
+        assert len(fields) >= 1, "Must have at least one field."
+        if self.is_loaded:
+            yield from self.get(fields, as_sentences=True)
+            return
+        field_idxs = [FIELD_TO_IDX[f.lower()] for f in fields]
+        for sent in self._read_sents():
+            yield _select_fields(sent, field_idxs)
+
+    def count_sents(self):
+        """ Num of sentences, counted without keeping the sentences in memory."""
+        if self.is_loaded:
+            return len(self)
+        return sum(1 for _ in self._read_sents())
 
     @property
     def file(self):
@@ -77,24 +222,24 @@ class CoNLLFile(object):
 
     @property
     def sents(self):
-        if not hasattr(self, '_sents'):
-            self._sents = self.load_conll()
-        return self._sents
+        """
+            逐行的只读形式（兼容旧接口）：句子和行都是tuple，第一次访问时由列式数据构造并缓存，
+            之后的访问（例如在循环中逐句索引）直接返回缓存，set等修改内容的方法会清空缓存；
+            修改内容必须使用set（对这里的行赋值会直接报错，而不是静默地修改一个临时副本）
+        """
+        if self._sents_cache is None:
+            self._sents_cache = tuple(tuple(tuple(ln) for ln in sent) for sent in self.load_conll())
+        return self._sents_cache
 
     def __len__(self):
-        return len(self.sents)
+        self._load()
+        return len(self._sent_offsets) - 1
 
     @property
     def num_words(self):
         """ Num of total words, after multi-word expansion."""
-        if not hasattr(self, '_num_words'):
-            n = 0
-            for sent in self.sents:
-                for ln in sent:
-                    if '-' not in ln[0]:
-                        n += 1
-            self._num_words = n
-        return self._num_words
+        self._load()
+        return int(self._is_word.sum())
 
     def get(self, fields, as_sentences=False):
         """ Get fields from a list of field names. If only one field name is provided, return a list
@@ -103,23 +248,16 @@ class CoNLLFile(object):
         """
         assert isinstance(fields, list), "Must provide field names as a list."
         assert len(fields) >= 1, "Must have at least one field."
-        field_idxs = [FIELD_TO_IDX[f.lower()] for f in fields]
-        results = []
-        for sent in self.sents:
-            cursent = []
-            for ln in sent:
-                if '-' in ln[0]:  # skip
-                    continue
-                if len(field_idxs) == 1:
-                    cursent += [ln[field_idxs[0]]]
-                else:
-                    cursent += [[ln[fid] for fid in field_idxs]]
-
-            if as_sentences:
-                results.append(cursent)
-            else:
-                results += cursent
-        return results
+        self._load()
+        word_rows, word_offsets = self._word_rows()
+        columns = [self._decode(f.lower(), word_rows).tolist() for f in fields]
+        if len(columns) == 1:
+            words = columns[0]
+        else:
+            words = [list(w) for w in zip(*columns)]
+        if not as_sentences:
+            return words
+        return [words[word_offsets[i]:word_offsets[i + 1]] for i in range(len(word_offsets) - 1)]
 
     def set(self, fields, contents):
         """
@@ -130,59 +268,122 @@ class CoNLLFile(object):
         assert isinstance(contents, list), "Must provide contents as a list (one item per line)."
         assert len(fields) >= 1, "Must have at least one field."
         if self.num_words != len(contents):
-            print("Contents must have the same number as the original file.")
-        field_idxs = [FIELD_TO_IDX[f.lower()] for f in fields]
-        cidx = 0
-        for sent in self.sents:
-            for ln in sent:
-                if '-' in ln[0]:
-                    continue
-                if len(field_idxs) == 1:
-                    ln[field_idxs[0]] = contents[cidx]
-                    if fields == ['deps']:
-                        head_value, deprel_value = contents[cidx].split('|')[0].split(':')
-                        ln[FIELD_TO_IDX['head']] = head_value
-                        ln[FIELD_TO_IDX['deprel']] = deprel_value
-                else:
-                    for fid, ct in zip(field_idxs, contents[cidx]):
-                        ln[fid] = ct
-                cidx += 1
+            raise ValueError(f'Contents must have the same number as the original file: '
+                             f'{len(contents)} vs {self.num_words} words')
+        word_rows, _ = self._word_rows()
+        if len(fields) == 1:
+            columns = {fields[0].lower(): contents}
+        else:
+            columns = {f.lower(): list(values) for f, values in zip(fields, zip(*contents))}
+        if list(columns) == ['deps']:
+            # head和deprel取第一条依存弧
+            first_arcs = [deps.split('|')[0].split(':') for deps in contents]
+            columns['head'] = [arc[0] for arc in first_arcs]
+            columns['deprel'] = [arc[1] for arc in first_arcs]
+        for field, values in columns.items():
+            if field not in self._columns:
+                self._add_column(field)
+            self._columns[field][word_rows] = self._encode(field, values)
+        self._sents_cache = None
+        return
+
+    def set_deps_from_edges(self, sent_ids, edges, formatter):
+        """
+            由依存弧的边表设置deps，以及head、deprel（取第一条依存弧），没有逐词、逐弧的python循环
+        :param sent_ids: 有预测结果的句子序号，这些句子中没有依存弧的单词设为'_'，其余句子保持不变
+        :param edges: ndarray，(E x 4)：[句子序号, dependent, head, label_id]，顺序任意
+        :param formatter: DepsFormatter
+        """
+        self._load()
+        word_rows, word_offsets = self._word_rows()
+        sent_ids = np.asarray(sent_ids, dtype=np.int64)
+        # 有预测结果的句子的所有单词在word_rows中的位置
+        sent_starts = word_offsets[sent_ids]
+        sent_sizes = word_offsets[sent_ids + 1] - sent_starts
+        # 拼接每句话的 arange(start, end)
+        sent_begins = np.cumsum(sent_sizes) - sent_sizes
+        predicted = np.repeat(sent_starts - sent_begins, sent_sizes) + np.arange(int(sent_sizes.sum()))
+        keys, columns = formatter.format(word_offsets[edges[:, 0]] + edges[:, 1] - 1, edges[:, 2], edges[:, 3])
+        for field, values in zip(['deps', 'head', 'deprel'], columns):
+            if field not in self._columns:
+                self._add_column(field)
+            column = self._columns[field]
+            column[word_rows[predicted]] = self._encode(field, ['_'])[0]
+            column[word_rows[keys]] = self._encode(field, values.tolist())
+        self._sents_cache = None
+        return
+
+    def write_conll_with_edges(self, batch_edges, filename, formatter):
+        """
+            流式写入预测的依存弧（边表形式），不需要把整个文件载入内存
+        :param batch_edges: 可迭代对象，每个元素为 (batch中每句话的句子序号, 边表)，句子序号必须递增；
+                            边表为ndarray，(E x 4)：[batch内的句子序号, dependent, head, label_id]；
+                            没有预测结果的句子（例如被跳过的过长句子）按原样写出
+        :param formatter: DepsFormatter
+        """
+        def iter_sent_columns():
+            for sent_ids, edges in batch_edges:
+                # 每句话的单词数未知，用 句子序号 x 最大dependent + dependent 作为单词的键
+                stride = int(edges[:, 1].max()) + 1 if len(edges) else 1
+                keys, columns = formatter.format(edges[:, 0] * stride + edges[:, 1], edges[:, 2], edges[:, 3])
+                bounds = np.searchsorted(keys, np.arange(len(sent_ids) + 1) * stride)
+                for i, sent_id in enumerate(sent_ids):
+                    start, end = bounds[i], bounds[i + 1]
+                    yield sent_id, (keys[start:end] - i * stride).tolist(), [c[start:end].tolist() for c in columns]
+
+        sent_columns = iter_sent_columns()
+        next_pred = next(sent_columns, None)
+        field_idxs = [FIELD_TO_IDX['deps'], FIELD_TO_IDX['head'], FIELD_TO_IDX['deprel']]
+        with CoNLLUWriter(filename) as writer:
+            for sent_idx, sent in enumerate(self.iter_sents()):
+                if next_pred is not None and next_pred[0] == sent_idx:
+                    words = [ln for ln in sent if '-' not in ln[0]]
+                    for ln in words:
+                        for fid in field_idxs:
+                            ln[fid] = '_'
+                    _, dependents, columns = next_pred
+                    assert not dependents or dependents[-1] <= len(words), \
+                        "Num of deps does not match the sentence length."
+                    for j, dependent in enumerate(dependents):
+                        for fid, values in zip(field_idxs, columns):
+                            words[dependent - 1][fid] = values[j]
+                    next_pred = next(sent_columns, None)
+                writer.write_sent(sent)
+        assert next_pred is None, f"Sentence {next_pred[0]} not found in the input file."
         return
 
+    def _iter_sent_lines(self):
+        """ 逐句生成各行的字段（tuple），字符串直接取自各列的字典"""
+        self._load()
+        all_fields = [self._decode(f) for f in FIELD_NAMES]
+        offsets = self._sent_offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield zip(*[field[start:end] for field in all_fields])
+
     def write_conll(self, filename):
         """ Write current conll contents to file.
+            逐句写入带缓冲的文件，文件名以.gz结尾时用gzip压缩
         """
-        conll_string = self.conll_as_string()
-        with open(filename, 'w', encoding='utf-8') as outfile:
-            outfile.write(conll_string)
+        with CoNLLUWriter(filename) as writer:
+            for lines in self._iter_sent_lines():
+                writer.write_sent(lines)
         return
 
     def conll_as_string(self):
         """ Return current conll contents as string
         """
-        return_string = ""
-        for sent in self.sents:
-            for ln in sent:
-                return_string += ("\t".join(ln) + "\n")
-            return_string += "\n"
-        return return_string
+        output = io.StringIO()
+        for lines in self._iter_sent_lines():
+            output.write(_format_sent(lines))
+        return output.getvalue()
 
     def write_conll_with_lemmas(self, lemmas, filename):
-        """ Write a new conll file, but use the new lemmas to replace the old ones."""
+        """ Write a new conll file, but use the new lemmas to replace the old ones.
+            新的lemma通过set写回列式数据（多词token行不变），再整体写出
+        """
         assert self.num_words == len(lemmas), "Num of lemmas does not match the number in original data file."
-        lemma_idx = FIELD_TO_IDX['lemma']
-        idx = 0
-        with open(filename, 'w') as outfile:
-            for sent in self.sents:
-                for ln in sent:
-                    if '-' not in ln[0]:  # do not process if it is a mwt line
-                        lm = lemmas[idx]
-                        if len(lm) == 0:
-                            lm = '_'
-                        ln[lemma_idx] = lm
-                        idx += 1
-                    print("\t".join(ln), file=outfile)
-                print("", file=outfile)
+        self.set(['lemma'], [lm if len(lm) > 0 else '_' for lm in lemmas])
+        self.write_conll(filename)
         return
 
     def get_mwt_expansions(self):
@@ -233,7 +434,7 @@ class CoNLLFile(object):
             for ln in sent:
                 idx += 1
                 if "MWT=Yes" not in ln[-1]:
-                    print("{}\t{}".format(idx, "\t".join(ln[1:6] + [str(idx - 1)] + ln[7:])), file=output_file)
+                    print("{}\t{}".format(idx, "\t".join(ln[1:6] + (str(idx - 1),) + ln[7:])), file=output_file)
                 else:
                     # print MWT expansion
                     expanded = [x for x in expansions[count].split(' ') if len(x) > 0]
@@ -256,15 +457,109 @@ class CoNLLFile(object):
         return
 
 
-def load_conllu_file(filename, evaluation=False):
+def _select_fields(sent, field_idxs):
+    """ Select fields of each word in a sentence, after multi-word expansion."""
+    cursent = []
+    for ln in sent:
+        if '-' in ln[0]:  # skip
+            continue
+        if len(field_idxs) == 1:
+            cursent += [ln[field_idxs[0]]]
+        else:
+            cursent += [[ln[fid] for fid in field_idxs]]
+    return cursent
+
+
+class DepsFormatter(object):
+    """
+        把依存弧的边表转换为deps、head、deprel字符串：
+        "head:label"字符串按 (head, label_id) 预先构造成表（head的范围按需扩大），
+        每个单词的deps由np.add.reduceat直接拼接，没有逐词、逐弧的python循环
+    """
+
+    def __init__(self, labels):
+        """
+        :param labels: label_id到依存标签的映射（GraphVocab.get_labels()）
+        """
+        self.labels = np.asarray(labels, dtype=object)
+        self._head_table = np.empty(0, dtype=object)
+        # [head, label_id] -> 'head:label'；单词的第二条及之后的依存弧带上分隔符：'|head:label'
+        self._arc_table = self._sep_arc_table = np.empty((0, len(labels)), dtype=object)
+
+    def _build_tables(self, head_num):
+        if head_num <= len(self._head_table):
+            return
+        head_num = max(head_num, 2 * len(self._head_table), 256)
+        self._head_table = np.asarray([str(h) for h in range(head_num)], dtype=object)
+        arcs = [[f'{h}:{label}' for label in self.labels] for h in range(head_num)]
+        self._arc_table = np.asarray(arcs, dtype=object)
+        self._sep_arc_table = np.asarray([['|' + arc for arc in row] for row in arcs], dtype=object)
+
+    def format(self, word_keys, heads, label_ids):
+        """
+        :param word_keys: 每条弧的dependent所在单词的键（整数，同一个单词的弧键相同）
+        :param heads: 每条弧的head
+        :param label_ids: 每条弧的label_id
+        :return: (有依存弧的单词的键（升序）, [deps, head, deprel])，后三者为object ndarray，head和deprel取第一条依存弧
+        """
+        word_keys, heads, label_ids = np.asarray(word_keys), np.asarray(heads), np.asarray(label_ids)
+        if len(word_keys) == 0:
+            empty = np.empty(0, dtype=object)
+            return word_keys, [empty, empty, empty]
+        # 每个单词的依存弧按head排序
+        order = np.lexsort((heads, word_keys))
+        word_keys, heads, label_ids = word_keys[order], heads[order], label_ids[order]
+        first = np.ones(len(word_keys), dtype=np.bool_)
+        first[1:] = word_keys[1:] != word_keys[:-1]
+        starts = np.flatnonzero(first)
+        self._build_tables(int(heads.max()) + 1)
+        arcs = np.where(first, self._arc_table[heads, label_ids], self._sep_arc_table[heads, label_ids])
+        deps = np.add.reduceat(arcs, starts)
+        return word_keys[starts], [deps, self._head_table[heads[starts]], self.labels[label_ids[starts]]]
+
+
+def _format_sent(lines):
+    return "".join("\t".join(ln) + "\n" for ln in lines) + "\n"
+
+
+class CoNLLUWriter(object):
+    """
+        带缓冲的CoNLL-U写出，逐句写入，不在内存中拼接整个文件；
+        文件名以.gz结尾时透明地使用gzip压缩
+    """
+
+    def __init__(self, filename, buffer_size=1 << 20):
+        filename = str(filename)
+        if filename.endswith('.gz'):
+            self._file = io.TextIOWrapper(io.BufferedWriter(gzip.open(filename, 'wb'), buffer_size),
+                                          encoding='utf-8')
+        else:
+            self._file = open(filename, 'w', encoding='utf-8', buffering=buffer_size)
+
+    def write_sent(self, lines):
+        """ lines: 一句话的各行，每行为字段的序列"""
+        self._file.write(_format_sent(lines))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_conllu_file(filename, evaluation=False, fields=None):
     """
     Conllu file 格式:
         单词序号\t单词\t单词\t词性\t词性\t_(置空)\t父节点序号\t依存弧标签\tdeps(父节点序号:依存弧标签|...)
     :param filename:
     :param evaluation:
+    :param fields: 只载入这些字段（例如训练集只需要word，upos，deps），None为全部字段
     :return:
     """
-    conll_file = CoNLLFile(filename)
+    conll_file = CoNLLFile(filename, fields=fields)
     data = conll_file.get(['word', 'upos', 'deps'], as_sentences=True)
     # data= [
     #             [ #sent1
@@ -6,6 +6,8 @@ import torch
 # from model_utils.optimization import *
 import pytorch_transformers.optimization as huggingfaceOptim  # 避免和torch.optim重名
 from utils.information import debug_print
+from utils.model_utils.sharded_optimizer import ShardedOptimizer
+from utils.model_utils.quantized_adamw import QuantizedAdamW
 
 
 def get_optimizer_old(name, parameters, lr, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
@@ -21,17 +23,56 @@ def get_optimizer_old(name, parameters, lr, betas=(0.9, 0.999), eps=1e-8, weight
         raise Exception("Unsupported optimizer: {}".format(name))
 
 
-def get_optimizer(args, model):
-    args.warmup_steps = math.ceil(args.warmup_prop * args.max_train_steps)
-    if args.optimizer == 'adamw-bertology':
+def build_optimizer(args, optimizer_class, params, **kwargs):
+    """
+        多进程训练并且shard_optimizer_state为True时，每个进程只保存和更新一部分参数的optimizer状态
+    """
+    if getattr(args, 'shard_optimizer_state', False) and getattr(args, 'distributed', False):
+        debug_print(f'\n - Shard optimizer state across {args.world_size} processes')
+        return ShardedOptimizer(params, optimizer_class, **kwargs)
+    return optimizer_class(params, **kwargs)
+
+
+def trainable_parameter_groups(args, named_parameters):
+    """
+        只使用需要训练（requires_grad）的参数构造param groups，被freeze的参数不进入optimizer
+        AdamW对bias和LayerNorm.weight不做weight decay
+    """
+    named_parameters = [(n, p) for n, p in named_parameters if p.requires_grad]
+    if args.optimizer in ['adamw-bertology', 'adamw-torch', 'adamw-8bit']:
         no_decay = ['bias', 'LayerNorm.weight']
-        optimizer_grouped_parameters = [
-            {'params': [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+        return [
+            {'params': [p for n, p in named_parameters if not any(nd in n for nd in no_decay)],
              'weight_decay': args.weight_decay},
-            {'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+            {'params': [p for n, p in named_parameters if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
-        optimizer = huggingfaceOptim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon,
-                                           betas=(args.beta1, args.beta2))
+    return [{'params': [p for _, p in named_parameters]}]
+
+
+def add_parameters_to_optimizer(args, optimizer, scheduler, named_parameters):
+    """
+        训练过程中解冻的参数加入optimizer（optimizer的状态在这些参数第一次更新时才分配）
+        LambdaLR按照构造时的param groups记录了初始学习率和lambda，新的group需要补上，并设置为当前的学习率
+    """
+    for group in trainable_parameter_groups(args, named_parameters):
+        if not group['params']:
+            continue
+        optimizer.add_param_group(group)
+        if scheduler is not None:
+            group = optimizer.param_groups[-1]
+            group.setdefault('initial_lr', group['lr'])
+            scheduler.base_lrs.append(group['initial_lr'])
+            scheduler.lr_lambdas.append(scheduler.lr_lambdas[0])
+            group['lr'] = group['initial_lr'] * scheduler.lr_lambdas[-1](scheduler.last_epoch)
+
+
+def get_optimizer(args, model):
+    args.warmup_steps = math.ceil(args.warmup_prop * args.max_train_steps)
+    # 只包含需要训练的参数，被freeze的参数在解冻时通过add_parameters_to_optimizer加入
+    optimizer_grouped_parameters = trainable_parameter_groups(args, model.named_parameters())
+    if args.optimizer == 'adamw-bertology':
+        optimizer = build_optimizer(args, huggingfaceOptim.AdamW, optimizer_grouped_parameters,
+                                    lr=args.learning_rate, eps=args.adam_epsilon, betas=(args.beta1, args.beta2))
         scheduler = huggingfaceOptim.WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps,
                                                           t_total=args.max_train_steps)
         debug_print('\n - Use Huggingface\'s AdamW Optimizer')
@@ -41,27 +82,28 @@ def get_optimizer(args, model):
         except ImportError as e:
             debug_print(f'torch version: {torch.__version__}')
             raise e
-        no_decay = ['bias', 'LayerNorm.weight']
-        optimizer_grouped_parameters = [
-            {'params': [p for n, p in model.named_parameters() if
-                        not any(nd in n for nd in no_decay) and p.requires_grad], 'weight_decay': args.weight_decay},
-            {'params': [p for n, p in model.named_parameters() if
-                        any(nd in n for nd in no_decay) and p.requires_grad], 'weight_decay': 0.0}
-        ]
-        optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon,
-                          betas=(args.beta1, args.beta2))
+        optimizer = build_optimizer(args, AdamW, optimizer_grouped_parameters,
+                                    lr=args.learning_rate, eps=args.adam_epsilon, betas=(args.beta1, args.beta2))
         scheduler = huggingfaceOptim.WarmupLinearSchedule(optimizer,
                                                           warmup_steps=args.warmup_steps,
                                                           t_total=args.max_train_steps)
+    elif args.optimizer == 'adamw-8bit':
+        # 一阶、二阶动量分块量化为8 bit保存，更新规则与Huggingface的AdamW相同
+        optimizer = build_optimizer(args, QuantizedAdamW, optimizer_grouped_parameters,
+                                    lr=args.learning_rate, eps=args.adam_epsilon, betas=(args.beta1, args.beta2),
+                                    block_size=getattr(args, 'quantization_block_size', 2048))
+        scheduler = huggingfaceOptim.WarmupLinearSchedule(optimizer, warmup_steps=args.warmup_steps,
+                                                          t_total=args.max_train_steps)
+        debug_print('\n - Use AdamW Optimizer with 8-bit blockwise quantized states')
     elif args.optimizer == 'sgd':
-        optimizer = torch.optim.SGD(model.parameters(), lr=args.learning_rate)
+        optimizer = build_optimizer(args, torch.optim.SGD, optimizer_grouped_parameters, lr=args.learning_rate)
         scheduler = None
     elif args.optimizer == 'adagrad':
-        optimizer = torch.optim.Adagrad(model.parameters(), lr=args.learning_rate)
+        optimizer = build_optimizer(args, torch.optim.Adagrad, optimizer_grouped_parameters, lr=args.learning_rate)
         scheduler = None
     elif args.optimizer == 'adam':
-        optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate, betas=args.betas, eps=args.eps,
-                                     weight_decay=args.weight_decay)
+        optimizer = build_optimizer(args, torch.optim.Adam, optimizer_grouped_parameters, lr=args.learning_rate,
+                                    betas=args.betas, eps=args.eps, weight_decay=args.weight_decay)
         scheduler = None
     elif args.rnn_optimizer == 'adamax':
         optimizer = torch.optim.Adamax(model.parameters())  # use default lr
@@ -5,14 +5,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
-def label_smoothed_kl_div_loss(logits, target, class_num, smothing=0.0, reduction='sum'):
+def label_smoothed_kl_div_loss(logits, target, class_num, smothing=0.0, reduction='sum', ignore_index=None):
     """
         函数版本的LabelSmoothedKLDivLoss,两者结果完全一样
-    :param logits:
-    :param target:
+    :param logits: (N x C)
+    :param target: (N)
     :param class_num:
     :param smothing:
-    :param reduction
+    :param reduction: sum；mean（按未被忽略的样本数平均）；none（返回每个样本的loss，被忽略的样本为0）
+    :param ignore_index: target等于ignore_index的样本不计算loss（与CrossEntropyLoss的ignore_index相同）
     :return:
     """
 
@@ -31,10 +32,29 @@ def label_smoothed_kl_div_loss(logits, target, class_num, smothing=0.0, reductio
             true_dist.scatter_(1, true_labels.data.unsqueeze(1), confidence)
         return true_dist
 
-    preds = F.log_softmax(logits)
+    assert reduction in ['sum', 'mean', 'none'], f'illegal reduction:{reduction}'
+    preds = F.log_softmax(logits, dim=-1)
+    if ignore_index is not None:
+        # 被忽略的位置先换成任意合法的标签构造平滑分布，再把这些位置的loss置为0
+        ignore_mask = target.eq(ignore_index)
+        target = target.masked_fill(ignore_mask, 0)
     smoothed_target = smooth_one_hot(target, class_num, smothing)
-    return F.kl_div(preds, smoothed_target, reduction=reduction)
+    loss = F.kl_div(preds, smoothed_target, reduction='none').sum(-1)
+    if ignore_index is not None:
+        loss = loss.masked_fill(ignore_mask, 0)
+    if reduction == 'none':
+        return loss
+    if reduction == 'mean':
+        num = target.numel() if ignore_index is None else torch.sum(~ignore_mask)
+        return loss.sum() / num
+    return loss.sum()
 
 
 if __name__ == '__main__':
-    pass
+    # smothing为0时与带ignore_index的CrossEntropyLoss相同
+    logits = torch.randn(6, 5)
+    target = torch.tensor([1, -1, 3, 0, -1, 4])
+    print(label_smoothed_kl_div_loss(logits, target, 5, 0.0, ignore_index=-1).item(),
+          F.cross_entropy(logits, target, ignore_index=-1, reduction='sum').item())
+    print(label_smoothed_kl_div_loss(logits, target, 5, 0.0, reduction='mean', ignore_index=-1).item(),
+          F.cross_entropy(logits, target, ignore_index=-1).item())
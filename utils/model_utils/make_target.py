@@ -11,8 +11,56 @@
 -------------------------------------------------
 """
 import torch
-from utils.input_utils.deprecated_common import GraphVocab
-from utils.input_utils.conll_file import load_conllu_file
+
+
+def make_graph_target(arcs, batch_size, seq_len):
+    """
+        根据batch中的依存弧边表构造稠密的标签目标矩阵，直接在arcs所在的设备上构造
+    :param arcs: LongTensor，(E x 4)：[batch内的句子序号, dependent, head, label]
+    :param batch_size:
+    :param seq_len: batch中（以单词计）的序列长度，包括ROOT
+    :return: LongTensor，(batch_size x seq_len x seq_len)，[b, dependent, head] 为label id，无依存弧的位置为0
+    """
+    # 句子被截断（skip_too_long_input=false）时，超出seq_len的依存弧写到多出的一行（列）上再丢弃，
+    # 不用布尔索引过滤，避免与device同步
+    graphs = arcs.new_zeros(batch_size, seq_len + 1, seq_len + 1)
+    graphs[arcs[:, 0], arcs[:, 1].clamp(max=seq_len), arcs[:, 2].clamp(max=seq_len)] = arcs[:, 3]
+    return graphs[:, :seq_len, :seq_len]
+
+
+def make_gold_arc_target(arcs, seq_len, ignore_index=-1):
+    """
+        训练时只在gold弧上计算标签：给出gold弧的位置和对应的标签
+    :param arcs: LongTensor，(E x 4)：[batch内的句子序号, dependent, head, label]
+    :param seq_len: batch中（以单词计）的序列长度，包括ROOT
+    :return: pair_index: LongTensor，(E x 3) [batch内的句子序号, dependent, head]；
+             labels: LongTensor，(E)，超出seq_len的依存弧（句子被截断）的标签为ignore_index；
+             与make_graph_target一致，标签为0的位置不是依存弧，也置为ignore_index
+    """
+    in_range = (arcs[:, 1] < seq_len) & (arcs[:, 2] < seq_len) & arcs[:, 3].ge(1)
+    # 不用布尔索引过滤，避免与device同步：超出范围的弧换到合法位置，标签置为ignore_index
+    pair_index = torch.stack([arcs[:, 0], arcs[:, 1].clamp(max=seq_len - 1), arcs[:, 2].clamp(max=seq_len - 1)], 1)
+    labels = arcs[:, 3].masked_fill(~in_range, ignore_index)
+    return pair_index, labels
+
+
+def make_pair_index(sentence_lengths, seq_len, device=None):
+    """
+        batch中所有有效的(dependent, head)位置在展平的 (batch_size x seq_len x seq_len) 矩阵中的下标
+        句长在CPU上已知，下标在CPU上构造后拷贝到device，不需要与device同步
+    :param sentence_lengths: python 列表，每句话的单词数（包括ROOT）
+    :param seq_len: batch中（以单词计）的序列长度
+    :return: LongTensor，(sum(n^2))
+    """
+    lengths = torch.tensor(sentence_lengths, dtype=torch.long)
+    pair_nums = lengths * lengths
+    sent = torch.repeat_interleave(torch.arange(len(sentence_lengths)), pair_nums)
+    # 每个位置在所在句子的 n x n 矩阵中的序号
+    offsets = torch.cumsum(pair_nums, 0) - pair_nums
+    k = torch.arange(int(pair_nums.sum())) - offsets[sent]
+    n = lengths[sent]
+    index = sent * seq_len * seq_len + (k // n) * seq_len + k % n
+    return index.to(device) if device is not None else index
 
 
 def make_unlabeltarget(arcs, sentlens, use_cuda=False):
@@ -74,6 +122,8 @@ def make_discriminator_target(sent_num, task_id, use_cuda=False):
 
 
 if __name__ == '__main__':
+    from utils.input_utils.deprecated_common import GraphVocab
+    from utils.input_utils.conll_file import load_conllu_file
 
     def make_label_target(arcs, max_seq_length):
         graphs = [[0] * max_seq_length for _ in range(max_seq_length)]
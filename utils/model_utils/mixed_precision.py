@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    基于autocast的混合精度训练和推理
+
+    GPU上默认使用fp16并动态缩放loss（GradScaler），避免梯度下溢；CPU上使用bf16，不需要缩放loss；
+    autocast只包住模型的前向计算，loss和解码都在fp32下进行（见BiaffineDependencyTrainer）。
+    autocast需要torch>=1.6（CPU上的bf16需要torch>=1.10），旧版本的torch会退回到fp32并给出提示。
+"""
+import contextlib
+
+import torch
+
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+def _get_autocast(device_type, dtype):
+    """
+        检测当前torch版本支持的autocast，不支持时返回None
+    """
+    if hasattr(torch, 'autocast'):
+        # torch>=1.10
+        return lambda: torch.autocast(device_type=device_type, dtype=dtype)
+    if device_type == 'cuda' and dtype == torch.float16:
+        try:
+            from torch.cuda.amp import autocast
+        except ImportError:
+            return None
+        return autocast
+    return None
+
+
+def _get_grad_scaler():
+    try:
+        from torch.cuda.amp import GradScaler
+    except ImportError:
+        return None
+    return GradScaler()
+
+
+class MixedPrecision(object):
+    def __init__(self, args):
+        """
+        :param args: 使用其中的mixed_precision，amp_dtype（auto/fp16/bf16），device
+        """
+        self.enabled = getattr(args, 'mixed_precision', False)
+        self.dtype = None
+        self.scaler = None
+        self._autocast = None
+        if not self.enabled:
+            return
+        device_type = args.device.type
+        amp_dtype = getattr(args, 'amp_dtype', 'auto')
+        if amp_dtype == 'auto':
+            self.dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+        else:
+            assert amp_dtype in AMP_DTYPES, f'illegal amp dtype:{amp_dtype}'
+            self.dtype = AMP_DTYPES[amp_dtype]
+        self._autocast = _get_autocast(device_type, self.dtype)
+        if self._autocast is None:
+            print(f'autocast({device_type}, {self.dtype}) is not supported by torch {torch.__version__}, '
+                  f'use fp32 instead')
+            self.enabled = False
+            return
+        # bf16的数值范围与fp32相同，只有fp16需要缩放loss
+        if self.dtype == torch.float16 and device_type == 'cuda':
+            self.scaler = _get_grad_scaler()
+            if self.scaler is None:
+                print(f'GradScaler is not supported by torch {torch.__version__}, use fp32 instead')
+                self.enabled = False
+                return
+        print(f'mixed precision: {self.dtype}, loss scaling: {self.scaler is not None}')
+
+    def autocast(self):
+        """
+            包住模型的前向计算
+        """
+        if not self.enabled:
+            return _null_context()
+        return self._autocast()
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer, parameters, max_grad_norm=0):
+        """
+            梯度裁剪并更新参数；使用loss缩放时先还原梯度再裁剪，
+            出现inf/nan时跳过这一步的更新并减小缩放系数
+        """
+        if self.scaler is not None:
+            self.scaler.unscale_(optimizer)
+        if max_grad_norm > 0:
+            torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm)
+        if self.scaler is not None:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
+
+
+if __name__ == '__main__':
+    pass
@@ -16,9 +16,20 @@ import numpy as np
 
 def sdp_decoder(semgraph_probs, sentlens):
     '''
-    semhead_probs type:ndarray, shape:(n,m,m)
+    semgraph_probs type:ndarray, shape:(n,m,m,c)
     '''
     semhead_probs = semgraph_probs.sum(axis=-1)
+    # (n x m x m x c) -> (n x m x m)
+    semrel_preds = np.argmax(semgraph_probs, axis=-1)
+    return sdp_decoder_from_heads(semhead_probs, semrel_preds, sentlens)
+
+
+def sdp_decoder_from_heads(semhead_probs, semrel_preds, sentlens, return_counts=False):
+    '''
+    semhead_probs type:ndarray, shape:(n,m,m)，弧的概率（已经mask掉PAD）
+    semrel_preds type:ndarray, shape:(n,m,m)，每条弧的标签（只用到解码选中的弧）
+    return_counts: 是否同时返回修复的次数统计 n_counts
+    '''
     semhead_preds = np.where(semhead_probs >= 0.5, 1, 0)
     masked_semhead_preds = np.zeros(semhead_preds.shape, dtype=np.int32)
     for i, (sem_preds, length) in enumerate(zip(semhead_preds, sentlens)):
@@ -47,14 +58,86 @@ def sdp_decoder(semgraph_probs, sentlens):
                 semhead_probs[i, j, j] = 0
                 new_head = np.argmax(semhead_probs[i, j, 1:length]) + 1
                 masked_semhead_preds[i, j, new_head] = 1
-    # (n x m x m x c) -> (n x m x m)
-    semrel_preds = np.argmax(semgraph_probs, axis=-1)
     # (n x m x m) (*) (n x m x m) -> (n x m x m)
     semgraph_preds = masked_semhead_preds * semrel_preds
     result = masked_semhead_preds + semgraph_preds
+    if return_counts:
+        return result, n_counts
     return result
 
 
+def sdp_decoder_torch(semgraph_probs, sentlens):
+    '''
+    sdp_decoder的batch版本，在semgraph_probs所在的设备上解码
+    semgraph_probs type:Tensor, shape:(n,m,m,c)
+    '''
+    semhead_probs = semgraph_probs.sum(dim=-1)
+    # (n x m x m x c) -> (n x m x m)
+    semrel_preds = torch.argmax(semgraph_probs, dim=-1)
+    return sdp_decoder_from_heads_torch(semhead_probs, semrel_preds, sentlens)
+
+
+def sdp_decoder_from_heads_torch(semhead_probs, semrel_preds, sentlens, return_counts=False):
+    '''
+    sdp_decoder_from_heads的batch版本，没有逐句、逐词的python循环，结果（包括n_counts）与之完全相同；
+    不修改输入的semhead_probs
+    semhead_probs type:Tensor, shape:(n,m,m)，弧的概率（已经mask掉PAD）
+    semrel_preds type:LongTensor, shape:(n,m,m)，每条弧的标签；为None时只解码无标签弧（有依存弧的位置为1）
+    return_counts: 是否同时返回修复的次数统计 n_counts，其中的值为设备上的0维LongTensor（取值时才与设备同步）
+    return: LongTensor, shape:(n,m,m)，无依存弧为0，否则为标签+1
+    '''
+    n, m, _ = semhead_probs.size()
+    device = semhead_probs.device
+    positions = torch.arange(m, device=device)
+    lengths = torch.as_tensor(sentlens, dtype=torch.long, device=device)
+    # (n x m)：1为句子中的单词（包括ROOT）
+    word_mask = positions.unsqueeze(0) < lengths.unsqueeze(1)
+    semhead_preds = (semhead_probs >= 0.5) & word_mask.unsqueeze(1) & word_mask.unsqueeze(2)
+    # 去掉自环
+    eye = torch.eye(m, dtype=torch.bool, device=device)
+    self_circle = (semhead_preds & eye).sum()
+    semhead_preds = semhead_preds & ~eye
+    # 没有root时补上、有多个root时只保留指向ROOT概率最大的单词
+    n_root = semhead_preds[:, :, 0].sum(dim=-1)
+    fix_root = n_root.ne(1)
+    best_root = torch.argmax(semhead_probs[:, 1:, 0], dim=-1) + 1
+    root_column = positions.unsqueeze(0) == best_root.unsqueeze(1)
+    semhead_preds[:, :, 0] = torch.where(fix_root.unsqueeze(1), root_column, semhead_preds[:, :, 0])
+    # 没有head的单词（ROOT除外）选择概率最大的head（不包括ROOT和自身）
+    no_head = semhead_preds.sum(dim=-1).eq(0) & word_mask
+    no_head[:, 0] = False
+    # 与sdp_decoder_from_heads相同：自身的概率置为0，超出句长的head不参与选择
+    head_probs = semhead_probs.masked_fill(eye, 0).masked_fill(~word_mask.unsqueeze(1), -1)
+    best_head = torch.argmax(head_probs[:, :, 1:], dim=-1) + 1
+    semhead_preds = semhead_preds | (no_head.unsqueeze(2) & (positions.view(1, 1, m) == best_head.unsqueeze(2)))
+    semhead_preds = semhead_preds.long()
+    result = semhead_preds if semrel_preds is None else semhead_preds + semhead_preds * semrel_preds
+    if return_counts:
+        n_counts = {'no_root': n_root.eq(0).sum(), 'multi_root': n_root.gt(1).sum(),
+                    'no_head': no_head.sum(), 'self_circle': self_circle}
+        return result, n_counts
+    return result
+
+
+def semgraph_to_edges(semgraph, sentlens):
+    '''
+    在semgraph所在的设备上把解码结果转换为依存弧的边表，只有边表需要传回CPU，大小与弧的数量成正比
+    与parse_semgraph相同，不包括ROOT作为dependent的弧和超出句长的弧
+    semgraph type:LongTensor, shape:(n,m,m)，sdp_decoder_from_heads_torch的结果
+    return: LongTensor, shape:(E,4)，[句子序号, dependent, head, label]，按(句子序号, dependent, head)排序
+    '''
+    n, m, _ = semgraph.size()
+    positions = torch.arange(m, device=semgraph.device)
+    lengths = torch.as_tensor(sentlens, dtype=torch.long, device=semgraph.device)
+    heads = positions.unsqueeze(0) < lengths.unsqueeze(1)
+    dependents = heads & positions.unsqueeze(0).ge(1)
+    semgraph = semgraph * (dependents.unsqueeze(2) & heads.unsqueeze(1)).long()
+    index = torch.nonzero(semgraph)
+    sent_index, dependent_index, head_index = index.unbind(1)
+    labels = semgraph[sent_index, dependent_index, head_index] - 1
+    return torch.cat([index, labels.unsqueeze(1)], dim=1)
+
+
 def parse_semgraph(semgraph, sentlens):
     semgraph = semgraph.tolist()
     sents = []
@@ -69,3 +152,4 @@ def parse_semgraph(semgraph, sentlens):
             words.append(arc)
         sents.append(words)
     return sents
+
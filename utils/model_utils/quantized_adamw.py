@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    一阶、二阶动量以8 bit分块量化保存的AdamW（纯PyTorch实现，CPU和GPU上都可以运行）
+
+    动量按block_size个元素分块，每块保存一个fp32的absmax，块内的值除以absmax后映射到256个码字中最近的一个：
+        一阶动量（有正负）：0和正负对数均匀分布的码字；
+        二阶动量（非负）：0和对数均匀分布的码字；
+    对数分布的码字能够表示跨越多个数量级的动量，相对误差只有几个百分点。
+    更新时逐段（chunk_size个元素）反量化为fp32，按照AdamW（与pytorch_transformers的AdamW相同）更新后再量化，
+    动量占用的显存约为fp32的1/4；元素数少于min_8bit_size的参数（bias、LayerNorm等）仍使用fp32的动量。
+"""
+import math
+
+import torch
+from torch.optim import Optimizer
+
+
+def _signed_code(num_exponents=6):
+    # 0，正负各127个码字，绝对值在[10^-num_exponents, 1]上对数均匀分布，再补一个1.0凑满256个
+    positive = torch.logspace(-num_exponents, 0, 127)
+    return torch.sort(torch.cat([-positive, torch.zeros(1), positive, torch.ones(1)]))[0]
+
+
+def _unsigned_code(num_exponents=7):
+    # 0和255个在[10^-num_exponents, 1]上对数均匀分布的码字
+    return torch.cat([torch.zeros(1), torch.logspace(-num_exponents, 0, 255)])
+
+
+class BlockwiseQuantizer(object):
+    def __init__(self, code, block_size):
+        self.code = code
+        # 相邻码字的中点，用于查找最近的码字
+        self.midpoints = (code[1:] + code[:-1]) / 2
+        self.block_size = block_size
+
+    def to(self, device):
+        if self.code.device != device:
+            self.code = self.code.to(device)
+            self.midpoints = self.midpoints.to(device)
+        return self
+
+    def quantize(self, x):
+        """
+        :param x: 一维fp32 Tensor，长度为block_size的整数倍
+        :return: (uint8码字序号, 每块的absmax)
+        """
+        blocks = x.view(-1, self.block_size)
+        absmax = blocks.abs().max(1)[0]
+        normalized = blocks / absmax.clamp(min=1e-30).unsqueeze(1)
+        return torch.bucketize(normalized, self.midpoints).to(torch.uint8).view(-1), absmax
+
+    def dequantize(self, indices, absmax, nonzero=False):
+        """
+        :param nonzero: 为True时反量化的值不小于每块能表示的最小非零值（absmax x 最小的正码字）
+        """
+        blocks = self.code[indices.long()].view(-1, self.block_size) * absmax.unsqueeze(1)
+        if nonzero:
+            min_code = self.code[self.code > 0].min()
+            blocks = torch.max(blocks, (absmax * min_code).unsqueeze(1))
+        return blocks.view(-1)
+
+
+class QuantizedAdamW(Optimizer):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0, correct_bias=True,
+                 block_size=2048, min_8bit_size=4096, chunk_size=1 << 22):
+        """
+        :param block_size: 分块量化的块大小
+        :param min_8bit_size: 元素数少于该值的参数使用fp32的动量
+        :param chunk_size: 每次反量化、更新、再量化的元素数（block_size的整数倍），限制临时的fp32显存
+        """
+        if not hasattr(torch, 'bucketize'):
+            raise RuntimeError(f'QuantizedAdamW requires torch.bucketize (torch>=1.6), got torch {torch.__version__}')
+        if lr < 0.0:
+            raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
+        if not 0.0 <= betas[0] < 1.0 or not 0.0 <= betas[1] < 1.0:
+            raise ValueError("Invalid beta parameter: {}".format(betas))
+        assert chunk_size % block_size == 0
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
+        super().__init__(params, defaults)
+        self.block_size = block_size
+        self.min_8bit_size = min_8bit_size
+        self.chunk_size = chunk_size
+        self.signed_quantizer = BlockwiseQuantizer(_signed_code(), block_size)
+        self.unsigned_quantizer = BlockwiseQuantizer(_unsigned_code(), block_size)
+
+    def _init_state(self, p, state):
+        state['step'] = 0
+        if p.numel() < self.min_8bit_size:
+            state['exp_avg'] = torch.zeros_like(p.data)
+            state['exp_avg_sq'] = torch.zeros_like(p.data)
+            return
+        # 补齐到block_size的整数倍
+        padded_size = math.ceil(p.numel() / self.block_size) * self.block_size
+        num_blocks = padded_size // self.block_size
+        state['exp_avg_q'] = torch.full((padded_size,), int(torch.argmin(self.signed_quantizer.code.abs())),
+                                        dtype=torch.uint8, device=p.device)
+        state['exp_avg_absmax'] = torch.zeros(num_blocks, device=p.device)
+        state['exp_avg_sq_q'] = torch.zeros(padded_size, dtype=torch.uint8, device=p.device)
+        state['exp_avg_sq_absmax'] = torch.zeros(num_blocks, device=p.device)
+
+    @staticmethod
+    def _adamw_update(p, grad, exp_avg, exp_avg_sq, group, step_size):
+        beta1, beta2 = group['betas']
+        exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
+        denom = exp_avg_sq.sqrt().add_(group['eps'])
+        p.addcdiv_(exp_avg, denom, value=-step_size)
+        # 与pytorch_transformers的AdamW一致：解耦的weight decay在动量更新之后
+        if group['weight_decay'] > 0.0:
+            p.add_(p, alpha=-group['lr'] * group['weight_decay'])
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data
+                if grad.is_sparse:
+                    raise RuntimeError('QuantizedAdamW does not support sparse gradients')
+                state = self.state[p]
+                if len(state) == 0:
+                    self._init_state(p, state)
+                state['step'] += 1
+                beta1, beta2 = group['betas']
+                step_size = group['lr']
+                if group['correct_bias']:
+                    step_size = step_size * math.sqrt(1.0 - beta2 ** state['step']) / (1.0 - beta1 ** state['step'])
+                if 'exp_avg' in state:
+                    self._adamw_update(p.data, grad, state['exp_avg'], state['exp_avg_sq'], group, step_size)
+                    continue
+                self._quantized_update(p, grad, state, group, step_size)
+        return loss
+
+    def _quantized_update(self, p, grad, state, group, step_size):
+        signed_quantizer = self.signed_quantizer.to(p.device)
+        unsigned_quantizer = self.unsigned_quantizer.to(p.device)
+        flat_p = p.data.view(-1)
+        flat_grad = grad.reshape(-1).float()
+        numel = flat_p.numel()
+        for start in range(0, numel, self.chunk_size):
+            end = min(start + self.chunk_size, numel)
+            # 动量按块保存，chunk的起点总是block_size的整数倍
+            block_start, block_end = start // self.block_size, math.ceil(end / self.block_size)
+            q_start, q_end = block_start * self.block_size, block_end * self.block_size
+            exp_avg = signed_quantizer.dequantize(state['exp_avg_q'][q_start:q_end],
+                                                  state['exp_avg_absmax'][block_start:block_end])
+            # 二阶动量的相对精度（10^-7）比一阶动量（10^-6的平方为10^-12）粗，很小的v会量化为0而m不为0，
+            # m / (sqrt(v) + eps) 会异常大；反量化的v不小于该块能表示的最小非零值（全为0的块仍为0）
+            exp_avg_sq = unsigned_quantizer.dequantize(state['exp_avg_sq_q'][q_start:q_end],
+                                                       state['exp_avg_sq_absmax'][block_start:block_end],
+                                                       nonzero=True)
+            chunk_grad = flat_grad.new_zeros(q_end - q_start)
+            chunk_grad[:end - start] = flat_grad[start:end]
+            # 最后一块中补齐的部分梯度为0，不影响真实参数
+            chunk_p = flat_p.new_zeros(q_end - q_start, dtype=torch.float32)
+            chunk_p[:end - start] = flat_p[start:end]
+            self._adamw_update(chunk_p, chunk_grad, exp_avg, exp_avg_sq, group, step_size)
+            flat_p[start:end] = chunk_p[:end - start]
+            state['exp_avg_q'][q_start:q_end], state['exp_avg_absmax'][block_start:block_end] = \
+                signed_quantizer.quantize(exp_avg)
+            state['exp_avg_sq_q'][q_start:q_end], state['exp_avg_sq_absmax'][block_start:block_end] = \
+                unsigned_quantizer.quantize(exp_avg_sq)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    多进程数据并行训练时切分optimizer的状态（类似ZeRO stage 1）
+
+    DistributedDataParallel训练时每个进程的梯度都已经all-reduce，完全相同；
+    Adam类的optimizer为每个参数保存两个fp32的动量，在每个进程上各保存一份是冗余的。
+    这里把参数按大小均衡地分给各个进程，每个进程只为自己负责的参数保存optimizer状态并更新这些参数，
+    更新之后由负责的进程把参数广播给其他进程。每个进程的optimizer状态约为原来的 1/world_size。
+
+    param_groups中保留所有参数（学习率scheduler、GradScaler.unscale_、梯度裁剪都作用于全部参数），
+    step时把学习率等超参数同步到只包含本进程参数的optimizer上。
+"""
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def partition_parameters(params, world_size, loads=None):
+    """
+        按照参数量把参数均衡地分给各个进程（贪心：从大到小，每次分给当前参数量最少的进程）
+        所有进程的参数顺序相同，因此划分结果也相同
+    :param loads: 各进程已经分到的参数量（原地更新），用于在已有的划分上继续分配新增的参数
+    :return: list，每个参数对应的进程序号
+    """
+    owners = [0] * len(params)
+    if loads is None:
+        loads = [0] * world_size
+    for i in sorted(range(len(params)), key=lambda i: -params[i].numel()):
+        rank = loads.index(min(loads))
+        owners[i] = rank
+        loads[rank] += params[i].numel()
+    return owners
+
+
+class ShardedOptimizer(torch.optim.Optimizer):
+    def __init__(self, params, optimizer_class, rank=None, world_size=None, **defaults):
+        """
+        :param params: 与optimizer_class相同，可以是参数列表或者param groups
+        :param optimizer_class: 实际更新参数的optimizer，例如AdamW
+        :param rank: 当前进程序号，默认从torch.distributed获取
+        :param world_size: 进程数，默认从torch.distributed获取
+        :param defaults: optimizer_class的参数（lr，betas，eps等）
+        """
+        super().__init__(params, defaults)
+        self.rank = dist.get_rank() if rank is None else rank
+        self.world_size = dist.get_world_size() if world_size is None else world_size
+        self._loads = [0] * self.world_size
+        self._param_owners = {}
+        # 每个进程负责的参数，用于广播
+        self._rank_params = [[] for _ in range(self.world_size)]
+        # 只包含本进程参数的optimizer，其param groups对应self.param_groups中的_local_group_index（跳过空的group）
+        self._local_group_index = []
+        local_groups = [self._partition_group(i) for i in range(len(self.param_groups))]
+        self.optimizer = optimizer_class([g for g in local_groups if g is not None], **defaults)
+
+    def _partition_group(self, group_index):
+        """
+            把第group_index个param group的参数分给各个进程（在已有划分的基础上保持均衡）
+        :return: 本进程负责的参数构成的param group，没有则为None
+        """
+        group = self.param_groups[group_index]
+        owners = partition_parameters(group['params'], self.world_size, self._loads)
+        for p, owner in zip(group['params'], owners):
+            self._param_owners[id(p)] = owner
+            if p.requires_grad:
+                self._rank_params[owner].append(p)
+        local_params = [p for p, owner in zip(group['params'], owners) if owner == self.rank]
+        if not local_params:
+            return None
+        self._local_group_index.append(group_index)
+        local_group = {k: v for k, v in group.items() if k != 'params'}
+        local_group['params'] = local_params
+        return local_group
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        assert closure is None, 'ShardedOptimizer does not support closure'
+        # 学习率等超参数由scheduler修改在self.param_groups上
+        for local_group, i in zip(self.optimizer.param_groups, self._local_group_index):
+            for k, v in self.param_groups[i].items():
+                if k != 'params':
+                    local_group[k] = v
+        self.optimizer.step()
+        self._broadcast_parameters()
+
+    def _broadcast_parameters(self):
+        for rank, params in enumerate(self._rank_params):
+            if not params:
+                continue
+            # 每个进程的参数拼成一个Tensor广播，减少通信次数
+            flat = _flatten_dense_tensors([p.data for p in params])
+            dist.broadcast(flat, src=rank)
+            if rank != self.rank:
+                for p, synced in zip(params, _unflatten_dense_tensors(flat, [p.data for p in params])):
+                    p.data.copy_(synced)
+
+    def add_param_group(self, param_group):
+        super().add_param_group(param_group)
+        # 构造完成之后新增的参数（例如训练中解冻的层）在已有划分的基础上继续分给各个进程
+        if hasattr(self, 'optimizer'):
+            local_group = self._partition_group(len(self.param_groups) - 1)
+            if local_group is not None:
+                self.optimizer.add_param_group(local_group)
+
+    def local_state_numel(self):
+        """
+            本进程optimizer状态（动量等，不包括step计数）的元素数量
+        """
+        return sum(v.numel() for state in self.optimizer.state.values() for v in state.values()
+                   if torch.is_tensor(v) and v.dim() > 0)